@@ -12,6 +12,7 @@ sys.path.insert(0, str(Path(__file__).parent))
 from subwindows import *
 from workers import *
 from gui_utils import *
+from pyroics import ICSBatch
 
 # Get the directory of the current Python file
 BASE_DIR = Path(__file__).parent
@@ -579,20 +580,23 @@ class MainWindow(QWidget):
             self.ics.set("slopes", "maskSize", self.subap_masks_params["size"])
         cx = self.subap_masks_params["cx"]
         cy = self.subap_masks_params["cy"]
-        if cx is not None and cy is not None:
-            self.ics.run("slopes", "makeSubApMasks", cx, cy)
-        self.ics.run("slopes", "loadRefSlopes")   # Load defaults from file
-        self.ics.run("loop", "loadIM")
+        with ICSBatch(self.ics) as b:
+            if cx is not None and cy is not None:
+                b.run("slopes", "makeSubApMasks", cx, cy)
+            b.run("slopes", "loadRefSlopes")   # Load defaults from file
+            b.run("loop", "loadIM")
         self.setEnabled(True)
 
     def on_open_loop_clicked(self):
-        self.ics.run("loop", "setGain", 0)
-        self.ics.set("loop", "leakyGain", 0.01)
+        with ICSBatch(self.ics) as b:
+            b.run("loop", "setGain", 0)
+            b.set("loop", "leakyGain", 0.01)
         self.log("open loop")
 
     def on_close_loop_clicked(self):
-        self.ics.run("loop", "setGain", 0.15)
-        self.ics.set("loop", "leakyGain", 0.0)
+        with ICSBatch(self.ics) as b:
+            b.run("loop", "setGain", 0.15)
+            b.set("loop", "leakyGain", 0.0)
         self.log("close loop")
 
     def on_gain_return_pressed(self):
@@ -11,6 +11,7 @@ import threading
 import importlib.util
 import pyRTC.utils as utils
 from pyRTC import *
+from shm_manager import to_wire, from_wire, forget_arrays
 
 from Pyro5.errors import CommunicationError
 import Pyro5.configure
@@ -22,6 +23,11 @@ CONFIG_PATH = Path(__file__).parent.parent / "config"
 ICS_URI_PATH = CONFIG_PATH / "pyrtc_uri.txt"
 PYRTC_CLASS_PATH = Path(__file__).parent.parent.parent / "pyRTC"
 
+# SHMs cleared by reset_shms in addition to those listed in the SHM registry
+RESET_SHM_NAMES = ["wfs", "wfsRaw", "wfc", "wfc2D", "wfcShape", "signal", "signal2D",
+                   "psfShort", "psfLong", "wfsInfo", "loop", "refSlopes", "subApMasks",
+                   "cmat", "m2c", "simInjectedSlopes"]
+
 def get_ics_proxy():
     # Each thread will need its own proxy for the ICS.
     with open(ICS_URI_PATH) as f:
@@ -35,6 +41,42 @@ def get_ics_proxy():
     
     return proxy
 
+class ICSBatch:
+    """Collects get/set/run calls on an ICS (or a proxy to one) and sends them as
+    a single batch() call when the with block ends, instead of one round trip
+    each. Each call returns the index of its result in results.
+
+        with ICSBatch(ics) as b:
+            b.run("loop", "setGain", 0.15)
+            b.set("loop", "leakyGain", 0.0)
+        b.results  # [run result, set result]
+    """
+    def __init__(self, ics):
+        self.ics = ics
+        self.operations = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Nothing is sent if the block raised
+        if exc_type is None and len(self.operations) > 0:
+            self.results = self.ics.batch(self.operations)
+        return False
+
+    def get(self, component_type, property_name):
+        self.operations.append(["get", component_type, property_name])
+        return len(self.operations) - 1
+
+    def set(self, component_type, property_name, value):
+        self.operations.append(["set", component_type, property_name, value])
+        return len(self.operations) - 1
+
+    def run(self, component_type, function, *args):
+        self.operations.append(["run", component_type, function, *args])
+        return len(self.operations) - 1
+
 @Pyro5.api.expose
 class PyroICSSoft:
     """Orchestrates connections to all components. The GUI and other Python
@@ -192,6 +234,7 @@ class PyroICSSoft:
     def run(self, component_type, function, *args):
         if component_type not in self.components:
             return 4
+        args = [from_wire(arg) for arg in args]
             
         # Special Case: Global State Modification
         if function in ["setRoi", "setBinning"] and component_type == "wfs":
@@ -221,14 +264,16 @@ class PyroICSSoft:
             if component is None:
                 return 3
             result = getattr(component, property_name, -1)
-            # convert to list if it's a numpy array for Pyro serialization
-            if isinstance(result, np.ndarray):
-                return result.tolist()
-            return result
+            # Numpy arrays are not serializable by Pyro. Large ones (IM, CM, masks)
+            # are published to shared memory and a handle is returned instead, see
+            # shm_manager.get_array. Small ones are converted to lists.
+            return to_wire(f"ics_{component_type}_{property_name}", result)
     
     def set(self, component_type, property_name, value):
         if component_type not in self.components:
             return 4
+        # Large arrays come as handles to shared memory, see shm_manager.set_array
+        value = from_wire(value)
         with self._locks[component_type]:
             component = self.components[component_type]["instance"]
             if component is None:
@@ -239,6 +284,19 @@ class PyroICSSoft:
     def get_component_class(self, component_type):
         return self.components[component_type]["class"]
     
+    def batch(self, operations):
+        """Apply a list of operations in order in one call, returning their results.
+        Each operation is ["get", component_type, property_name],
+        ["set", component_type, property_name, value] or
+        ["run", component_type, function, *args]. See ICSBatch.
+        """
+        handlers = {"get": self.get, "set": self.set, "run": self.run}
+        results = []
+        for operation in operations:
+            handler = handlers.get(operation[0])
+            results.append(8 if handler is None else handler(*operation[1:]))
+        return results
+    
     def run_and_reset_wfs_shms(self, function, *args):
         # For when the WFS image size changes from ROI or binning. This is significantly
         # faster than shutting down all of the components and reconnecting to them.
@@ -270,9 +328,10 @@ class PyroICSSoft:
     
     def reset_shms(self, shm_names=None):
         if shm_names is None:
-            shm_names = ["wfs", "wfsRaw", "wfc", "wfc2D", "wfcShape", "signal", "signal2D",
-                         "psfShort", "psfLong", "wfsInfo", "loop", "refSlopes", "subApMasks",
-                         "cmat", "m2c", "simInjectedSlopes"]  #list of SHMs to reset
+            #Everything in the SHM registry, plus SHMs created before it existed
+            shm_names = set(RESET_SHM_NAMES) | {entry["name"] for entry in list_shms()}
+            # Including the arrays published by get
+            forget_arrays()
         clear_shms(shm_names)
 
     def reset_wfs_shms(self):
@@ -304,10 +363,7 @@ def try_shutdown(component):
         print(f"Component {component} threw an error during shutdown: {e}")
 
 def reset_shms():
-    shm_names = ["wfs", "wfsRaw", "wfc", "wfc2D", "wfcShape", "signal", "signal2D"
-                 "psfShort", "psfLong", "wfsInfo", "loop", "refSlopes", "subApMasks",
-                 "cmat", "m2c", "simInjectedSlopes"] #list of SHMs to reset
-    clear_shms(shm_names)
+    clear_shms(set(RESET_SHM_NAMES) | {entry["name"] for entry in list_shms()})
 
 if __name__ == "__main__":
     ics = PyroICSSoft()
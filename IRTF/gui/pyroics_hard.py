@@ -6,6 +6,7 @@ import sys
 import threading
 import pyRTC.utils as utils
 from pyRTC import *
+from shm_manager import to_wire, from_wire, forget_arrays
 
 from Pyro5.errors import CommunicationError
 import Pyro5.configure
@@ -17,6 +18,11 @@ CONFIG_PATH = Path(__file__).parent.parent / "config"
 ICS_URI_PATH = CONFIG_PATH / "pyrtc_uri.txt"
 PYRTC_CLASS_PATH = Path(__file__).parent.parent.parent / "pyRTC"
 
+# SHMs cleared by reset_shms in addition to those listed in the SHM registry
+RESET_SHM_NAMES = ["wfs", "wfsRaw", "wfc", "wfc2D", "wfcShape", "signal", "signal2D",
+                   "psfShort", "psfLong", "wfsInfo", "loop", "refSlopes", "subApMasks",
+                   "cmat", "m2c", "simInjectedSlopes"]
+
 LAUNCHER_TIMEOUT = 10.0  # seconds to wait for a component to launch before timing out
 
 def get_ics_proxy():
@@ -90,11 +96,53 @@ class PyroICS:
             config_file = CONFIG_PATH / self.launchers[component_class]["config_path"]
             port = self.ports[component_type]
             launcher = check_config_and_make_launcher(hardware_class, config_file, port)                                    
-            launcher.launch()
+            if not launcher.launch():
+                return 5
 
             self.components[component_type]["instance"] = launcher
             self.components[component_type]["class"] = component_class
             return 0
+
+    def launch_many(self, component_classes):
+        """Launches several components in parallel, each as soon as the components
+        whose SHMs it needs are up (see pyRTC.Pipeline.LAUNCH_DEPENDENCIES).
+        Returns a dict of component class to the same codes as launch().
+        """
+        codes = {}
+        launchers = {}
+        classes = {}
+        for component_class in component_classes:
+            if component_class not in self.launchers:
+                codes[component_class] = 4
+                continue
+            component_type = self.launchers[component_class]["type"]
+            if self.is_connected(component_type) or component_type in launchers:
+                codes[component_class] = 2
+                continue
+            hardware_class = PYRTC_CLASS_PATH / self.launchers[component_class]["class_path"]
+            config_file = CONFIG_PATH / self.launchers[component_class]["config_path"]
+            launchers[component_type] = check_config_and_make_launcher(hardware_class, config_file,
+                                                                       self.ports[component_type])
+            classes[component_type] = component_class
+
+        # Acquire the locks in a predictable alphabetical order to prevent cross-client deadlocks
+        locks = [self._locks[k] for k in sorted(launchers.keys())]
+        for lock in locks:
+            lock.acquire()
+        try:
+            results = launch_all(launchers)
+            for component_type, launched in results.items():
+                component_class = classes[component_type]
+                if launched:
+                    self.components[component_type]["instance"] = launchers[component_type]
+                    self.components[component_type]["class"] = component_class
+                    codes[component_class] = 0
+                else:
+                    codes[component_class] = 5
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        return codes
         
     def shutdown(self, name, timeout=5.0):
         if name not in self.components:
@@ -146,6 +194,7 @@ class PyroICS:
     def run(self, component_type, function, *args):
         if component_type not in self.components:
             return 4
+        args = [from_wire(arg) for arg in args]
             
         # Special Multi-Component Modification Case
         if function in ["setRoi", "setBinning"] and component_type == "wfs":
@@ -164,7 +213,15 @@ class PyroICS:
             component = self.components[component_type]["instance"]
             if component is None:
                 return 3
-            return component.run(function, *args)
+            try:
+                result = component.call(function, *args)
+            except RemoteError as e:
+                print(f"Error while running {function} on {component_type}: {e}")
+                return -1
+            # convert to list if it's a numpy array for Pyro serialization
+            if isinstance(result, np.ndarray):
+                return result.tolist()
+            return result
     
     def get(self, component_type, property_name):
         if component_type not in self.components:
@@ -173,11 +230,15 @@ class PyroICS:
             component = self.components[component_type]["instance"]
             if component is None:
                 return 3
-            return component.getProperty(property_name)
+            result = component.getProperty(property_name)
+            # Large arrays are published to shared memory for Pyro, small ones
+            # converted to lists, see PyroICSSoft.get
+            return to_wire(f"ics_{component_type}_{property_name}", result)
     
     def set(self, component_type, property_name, value):
         if component_type not in self.components:
             return 4
+        value = from_wire(value)
         with self._locks[component_type]:
             component = self.components[component_type]["instance"]
             if component is None:
@@ -188,6 +249,62 @@ class PyroICS:
     def get_component_class(self, component_type):
         return self.components[component_type]["class"]
     
+    def batch(self, operations):
+        """Apply a list of operations in order in one call, returning their results.
+        Each operation is ["get", component_type, property_name],
+        ["set", component_type, property_name, value] or
+        ["run", component_type, function, *args]. See ICSBatch. Consecutive
+        operations on the same component are sent to it as one batch request.
+        """
+        results = []
+        i = 0
+        while i < len(operations):
+            op, component_type = operations[i][0], operations[i][1]
+            # Find the run of operations on this component which it can apply itself
+            j = i
+            while j < len(operations) and operations[j][1] == component_type \
+                    and operations[j][0] in ("get", "set", "run") \
+                    and not (operations[j][0] == "run" and component_type == "wfs"
+                             and operations[j][2] in ["setRoi", "setBinning"]):
+                j += 1
+            if j == i:
+                # Unknown operation, or one which touches several components
+                handler = {"get": self.get, "set": self.set, "run": self.run}.get(op)
+                results.append(8 if handler is None else handler(*operations[i][1:]))
+                i += 1
+                continue
+            results += self._component_batch(component_type, operations[i:j])
+            i = j
+        return results
+
+    def _component_batch(self, component_type, operations):
+        if component_type not in self.components:
+            return [4]*len(operations)
+        with self._locks[component_type]:
+            component = self.components[component_type]["instance"]
+            if component is None:
+                return [3]*len(operations)
+            with component.batch() as b:
+                for operation in operations:
+                    if operation[0] == "get":
+                        b.getProperty(operation[2])
+                    elif operation[0] == "set":
+                        b.setProperty(operation[2], from_wire(operation[3]))
+                    else:
+                        b.call(operation[2], *[from_wire(arg) for arg in operation[3:]])
+        results = []
+        for operation, result in zip(operations, b.results):
+            if operation[0] == "set":
+                result = 0 # set() always reports success
+            elif operation[0] == "get":
+                result = to_wire(f"ics_{component_type}_{operation[2]}", result)
+            elif isinstance(result, RemoteError):
+                result = -1
+            elif isinstance(result, np.ndarray):
+                result = result.tolist() # for Pyro serialization
+            results.append(result)
+        return results
+    
     def run_and_reset_wfs_shms(self, function, *args):
         # For when the WFS image size changes from ROI or binning. This is significantly
         # faster than shutting down all of the components and reconnecting to them.
@@ -201,7 +318,11 @@ class PyroICS:
 
         # Set the WFS binning or ROI
         self.reset_wfs_shms()  # clear the WFS SHMs before changing the size to prevent issues with mismatched sizes
-        result = self.components["wfs"]["instance"].run(function, *args)
+        try:
+            result = self.components["wfs"]["instance"].call(function, *args)
+        except RemoteError as e:
+            print(f"Error while running {function} on wfs: {e}")
+            result = -1
 
         # Reset the WFS SHMs according to the new size
         self.components["wfs"]["instance"].run("initWFSMemory")  # must do this first
@@ -217,9 +338,10 @@ class PyroICS:
     
     def reset_shms(self, shm_names=None):
         if shm_names is None:
-            shm_names = ["wfs", "wfsRaw", "wfc", "wfc2D", "wfcShape", "signal", "signal2D",
-                         "psfShort", "psfLong", "wfsInfo", "loop", "refSlopes", "subApMasks",
-                         "cmat", "m2c", "simInjectedSlopes"]  #list of SHMs to reset
+            #Everything in the SHM registry, plus SHMs created before it existed
+            shm_names = set(RESET_SHM_NAMES) | {entry["name"] for entry in list_shms()}
+            # Including the arrays published by get
+            forget_arrays()
         clear_shms(shm_names)
 
     def reset_wfs_shms(self):
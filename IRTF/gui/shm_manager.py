@@ -1,7 +1,9 @@
+import os
 import time
+import itertools
 import numpy as np
 from multiprocessing.shared_memory import SharedMemory
-from pyRTC.Pipeline import ImageSHM
+from pyRTC.Pipeline import ImageSHM, clear_shms
 
 class SHMConnectionManager:
     def __init__(self, main_name, meta_name, shape, dtype, timeout_seconds=2.5, is_consumer=True):
@@ -81,4 +83,80 @@ class SHMConnectionManager:
     def get_pause_duration(self):
         if self.pause_start_time is None:
             return 0
-        return int(time.time() - self.pause_start_time)
\ No newline at end of file
+        return int(time.time() - self.pause_start_time)
+
+# Arrays with at least this many elements are passed between the GUI and the ICS
+# through shared memory instead of being serialized by Pyro
+BULK_ARRAY_SIZE = 4096
+ARRAY_HANDLE_KEY = "__shm_array__"
+
+_published_arrays = {}  # name -> producer ImageSHM, kept open for readers
+_mapped_arrays = {}     # name -> (handle key, consumer ImageSHM)
+_segment_count = itertools.count(1)
+
+def is_array_handle(value):
+    return isinstance(value, dict) and ARRAY_HANDLE_KEY in value
+
+def publish_array(name, arr):
+    """Write arr into the ImageSHM published as name and return a handle to it,
+    which can be sent through Pyro instead of the array and turned back into it
+    with read_array. The ImageSHM is reused while the shape and dtype stay the
+    same. Otherwise a new one is made under a new segment name, so a reader never
+    keeps a mapping of a segment which was replaced.
+    """
+    arr = np.ascontiguousarray(arr)
+    shm = _published_arrays.get(name)
+    if shm is None or tuple(shm.arr.shape) != arr.shape or shm.arr.dtype != arr.dtype:
+        if shm is not None:
+            clear_shms([shm.name])
+        shm = ImageSHM(f"{name}_{os.getpid()}_{next(_segment_count)}", arr.shape, arr.dtype, consumer=False)
+        _published_arrays[name] = shm
+    shm.write(arr)
+    return {ARRAY_HANDLE_KEY: shm.name, "name": name, "shape": list(arr.shape), "dtype": arr.dtype.str}
+
+def read_array(handle, copy=True):
+    """Map the array a handle from publish_array points to. The mapping is kept
+    for the next handle to the same array. With copy=False the returned array is
+    the shared memory itself, which changes when the array is published again.
+    """
+    key = (handle[ARRAY_HANDLE_KEY], tuple(handle["shape"]), handle["dtype"])
+    mapped_key, shm = _mapped_arrays.get(handle["name"], (None, None))
+    if mapped_key != key:
+        shm = ImageSHM(key[0], key[1], np.dtype(key[2]), consumer=True)
+        _mapped_arrays[handle["name"]] = (key, shm)
+    return shm.read_noblock(SAFE=copy)
+
+def to_wire(name, value):
+    """Prepare a get result or set value for Pyro: large arrays become handles
+    (published as name), smaller ones lists.
+    """
+    if isinstance(value, np.ndarray):
+        if value.size >= BULK_ARRAY_SIZE and not value.dtype.hasobject:
+            return publish_array(name, value)
+        return value.tolist()
+    return value
+
+def from_wire(value, copy=True):
+    """Undo to_wire for handles, anything else is returned as is."""
+    if is_array_handle(value):
+        return read_array(value, copy=copy)
+    return value
+
+def forget_arrays():
+    """Drop the mappings, e.g. after the SHMs were cleared. The arrays are
+    published again under new segment names.
+    """
+    _published_arrays.clear()
+    _mapped_arrays.clear()
+
+def get_array(ics, component_type, property_name):
+    """ics.get for array properties, mapping large arrays from shared memory.
+    Returns a numpy array, or the ICS error code.
+    """
+    value = from_wire(ics.get(component_type, property_name))
+    return np.asarray(value) if isinstance(value, list) else value
+
+def set_array(ics, component_type, property_name, arr):
+    """ics.set for array properties, passing large arrays through shared memory."""
+    return ics.set(component_type, property_name,
+                   to_wire(f"gui_{component_type}_{property_name}", np.asarray(arr)))
@@ -104,10 +104,11 @@ loop.setProperty("IMFile", "/home/whetstone/pyRTC/SHARP_LAB/calib/IM_SH.npy")
 # loop.setProperty("IMFile", "/home/whetstone/pyRTC/SHARP_LAB/calib/OL_DOCRIME.npy")
 # loop.setProperty("IMFile", "/home/whetstone/pyRTC/SHARP_LAB/calib/OL_DOCRIME_CL_docrime.npy")
 # loop.setProperty("IMFile", "/home/whetstone/pyRTC/SHARP_LAB/calib/ESCAPE.npy")
-loop.setProperty("numDroppedModes", 10)
-loop.setProperty("gain",0.1)
-loop.setProperty("leakyGain", 0.021)
-loop.run("loadIM")
+with loop.batch() as b:
+    b.setProperty("numDroppedModes", 10)
+    b.setProperty("gain",0.1)
+    b.setProperty("leakyGain", 0.021)
+    b.run("loadIM")
 time.sleep(0.5)
 # %% Adjust Gains
 # loop.run("setGain",3e-1)
@@ -0,0 +1,627 @@
+"""
+Centroid engines for SHWFS and FELIX subapertures
+"""
+from pyRTC.utils import *
+import numpy as np
+from numba import jit
+
+"""
+Kernels shared by every engine. The subapertures of a frame are copied into a
+preallocated (K, n, n) stack of square windows, the engines write the centroid
+of every window, in window pixels (x along columns, y along rows), and its flux
+into preallocated (K,) arrays, and centroidsToSlopes turns those into the usual
+(2N, N) slopes.
+"""
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def extractSubapertures(image: np.ndarray,
+                        rows: np.ndarray,
+                        cols: np.ndarray,
+                        weights: np.ndarray,
+                        threshold: float,
+                        pixels: np.ndarray,
+                        rowOrigin: int = 0,
+                        colOrigin: int = 0):
+    """
+    Copy the window of each subaperture into pixels, times its weights (the
+    subaperture mask), zeroing the pixels at or below threshold. image may be a 
+    crop of the WFS image starting at (rowOrigin, colOrigin).
+    """
+    K, n, _ = pixels.shape
+    for k in range(K):
+        r0 = rows[k] - rowOrigin
+        c0 = cols[k] - colOrigin
+        for m in range(n):
+            for p in range(n):
+                value = np.float32(image[r0 + m, c0 + p])
+                if value > threshold:
+                    pixels[k, m, p] = weights[k, m, p] * value
+                else:
+                    pixels[k, m, p] = 0
+    return pixels
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def centroidsToSlopes(cx: np.ndarray,
+                      cy: np.ndarray,
+                      flux: np.ndarray,
+                      xOrigin: np.ndarray,
+                      yOrigin: np.ndarray,
+                      xoffset: float,
+                      yoffset: float,
+                      unaberratedSlopes: np.ndarray,
+                      slopes: np.ndarray):
+    """
+    Write the centroids, moved to image coordinates, into the (2N, N) slopes,
+    subaperture k being row k // N, column k % N. Subapertures without flux get
+    zero slopes.
+    """
+    N = slopes.shape[1]
+    for k in range(cx.size):
+        i = k // N
+        j = k % N
+        if flux[k] > 0:
+            slopes[i, j] = xOrigin[k] + cx[k] - xoffset - unaberratedSlopes[i, j]
+            slopes[N+i, j] = yOrigin[k] + cy[k] - yoffset - unaberratedSlopes[N+i, j]
+        else:
+            slopes[i, j] = 0
+            slopes[N+i, j] = 0
+    return slopes
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def centroidCoG(pixels: np.ndarray,
+                cx: np.ndarray,
+                cy: np.ndarray,
+                flux: np.ndarray):
+    """
+    Centre of gravity of each window.
+    """
+    K, n, _ = pixels.shape
+    for k in range(K):
+        total = 0.0
+        sumX = 0.0
+        sumY = 0.0
+        for m in range(n):
+            for p in range(n):
+                value = pixels[k, m, p]
+                total += value
+                sumX += value * p
+                sumY += value * m
+        flux[k] = total
+        if total > 0:
+            cx[k] = sumX / total
+            cy[k] = sumY / total
+    return flux
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def centroidWeightedCoG(pixels: np.ndarray,
+                        windows: np.ndarray,
+                        centerX: np.ndarray,
+                        centerY: np.ndarray,
+                        gain: np.ndarray,
+                        cx: np.ndarray,
+                        cy: np.ndarray,
+                        flux: np.ndarray):
+    """
+    Centre of gravity of each window weighted by windows, a spot-sized window
+    around (centerX, centerY). The weighting shrinks displacements from the center,
+    which gain (> 1) scales back.
+    """
+    K, n, _ = pixels.shape
+    for k in range(K):
+        total = 0.0
+        weighted = 0.0
+        sumX = 0.0
+        sumY = 0.0
+        for m in range(n):
+            for p in range(n):
+                value = pixels[k, m, p]
+                total += value
+                value *= windows[k, m, p]
+                weighted += value
+                sumX += value * p
+                sumY += value * m
+        if weighted > 0:
+            flux[k] = total
+            cx[k] = centerX[k] + gain[k] * (sumX / weighted - centerX[k])
+            cy[k] = centerY[k] + gain[k] * (sumY / weighted - centerY[k])
+        else:
+            flux[k] = 0
+    return flux
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def nthLargest(values: np.ndarray, t: int):
+    """
+    Value which would be at index t if values were sorted in decreasing order.
+    Reorders values.
+    """
+    lo = 0
+    hi = values.size - 1
+    while lo < hi:
+        pivot = values[(lo + hi) // 2]
+        i = lo
+        j = hi
+        while i <= j:
+            while values[i] > pivot:
+                i += 1
+            while values[j] < pivot:
+                j -= 1
+            if i <= j:
+                tmp = values[i]
+                values[i] = values[j]
+                values[j] = tmp
+                i += 1
+                j -= 1
+        if t <= j:
+            hi = j
+        elif t >= i:
+            lo = i
+        else:
+            break
+    return values[t]
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def centroidBrightest(pixels: np.ndarray,
+                      numPixels: int,
+                      scratch: np.ndarray,
+                      cx: np.ndarray,
+                      cy: np.ndarray,
+                      flux: np.ndarray):
+    """
+    Centre of gravity of the numPixels brightest pixels of each window, after
+    subtracting the next brightest value so the cut does not bias the centroid
+    towards the window center. scratch holds n*n values.
+    """
+    K, n, _ = pixels.shape
+    size = n * n
+    for k in range(K):
+        floor = 0.0
+        if numPixels < size:
+            for q in range(size):
+                scratch[q] = pixels[k, q // n, q % n]
+            floor = max(nthLargest(scratch, numPixels), 0.0)
+        total = 0.0
+        sumX = 0.0
+        sumY = 0.0
+        for m in range(n):
+            for p in range(n):
+                value = pixels[k, m, p] - floor
+                if value > 0:
+                    total += value
+                    sumX += value * p
+                    sumY += value * m
+        flux[k] = total
+        if total > 0:
+            cx[k] = sumX / total
+            cy[k] = sumY / total
+    return flux
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def parabolicPeak(minus: float, center: float, plus: float):
+    """
+    Sub-sample offset of the peak of the parabola through three samples.
+    """
+    denominator = minus - 2*center + plus
+    if denominator < 0:
+        return 0.5 * (minus - plus) / denominator
+    return 0.0
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def centroidCorrelation(pixels: np.ndarray,
+                        templates: np.ndarray,
+                        templateX: np.ndarray,
+                        templateY: np.ndarray,
+                        searchRadius: int,
+                        scores: np.ndarray,
+                        cx: np.ndarray,
+                        cy: np.ndarray,
+                        flux: np.ndarray):
+    """
+    Matched filter centroids. Each window is correlated with its template over
+    integer shifts up to searchRadius, the peak is refined with a parabola along
+    each axis and added to the template's centroid (templateX, templateY). scores
+    is (2*searchRadius+1, 2*searchRadius+1).
+    """
+    K, n, _ = pixels.shape
+    S = searchRadius
+    for k in range(K):
+        total = 0.0
+        for m in range(n):
+            for p in range(n):
+                total += pixels[k, m, p]
+        flux[k] = total
+        if total <= 0:
+            continue
+        best = -1.0e300
+        bestA = S
+        bestB = S
+        for a in range(-S, S+1):
+            for b in range(-S, S+1):
+                score = 0.0
+                for m in range(max(0, a), min(n, n + a)):
+                    for p in range(max(0, b), min(n, n + b)):
+                        score += pixels[k, m, p] * templates[k, m - a, p - b]
+                scores[a + S, b + S] = score
+                if score > best:
+                    best = score
+                    bestA = a + S
+                    bestB = b + S
+        dy = float(bestA - S)
+        dx = float(bestB - S)
+        if 0 < bestA < 2*S:
+            dy += parabolicPeak(scores[bestA-1, bestB], best, scores[bestA+1, bestB])
+        if 0 < bestB < 2*S:
+            dx += parabolicPeak(scores[bestA, bestB-1], best, scores[bestA, bestB+1])
+        cx[k] = templateX[k] + dx
+        cy[k] = templateY[k] + dy
+    return flux
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def centroidQuadCell(pixels: np.ndarray,
+                     signs: np.ndarray,
+                     lutQ: np.ndarray,
+                     lutShift: np.ndarray,
+                     cx: np.ndarray,
+                     cy: np.ndarray,
+                     flux: np.ndarray):
+    """
+    Quad-cell centroids. The normalized flux differences between the halves of
+    each window (signs is -1, 0 or 1 for each column/row) are turned into shifts
+    from the window center with the lookup table (lutQ, lutShift).
+    """
+    K, n, _ = pixels.shape
+    center = (n - 1) / 2
+    for k in range(K):
+        total = 0.0
+        diffX = 0.0
+        diffY = 0.0
+        for m in range(n):
+            for p in range(n):
+                value = pixels[k, m, p]
+                total += value
+                diffX += value * signs[p]
+                diffY += value * signs[m]
+        flux[k] = total
+        if total > 0:
+            cx[k] = center + np.interp(diffX / total, lutQ, lutShift)
+            cy[k] = center + np.interp(diffY / total, lutQ, lutShift)
+    return flux
+
+def gaussianSpot(n, x, y, fwhm):
+    """
+    (n, n) Gaussian of the given FWHM centered on pixel coordinates (x, y).
+    """
+    sigma = fwhm / (2*np.sqrt(2*np.log(2)))
+    coords = np.arange(n)
+    return (np.exp(-(coords[None, :] - x)**2/(2*sigma**2))
+            * np.exp(-(coords[:, None] - y)**2/(2*sigma**2))).astype(np.float32)
+
+class SubapertureStack:
+    """
+    The square windows centroid engines work on, one per subaperture, with the
+    buffers they are computed into. Built with the geometry, so nothing is
+    allocated per frame.
+
+    Attributes
+    ----------
+    rows, cols : numpy.ndarray
+        (K,) image row and column of each window's first pixel.
+    weights : numpy.ndarray
+        (K, n, n) subaperture mask over each window.
+    xOrigin, yOrigin : numpy.ndarray
+        (K,) slope coordinate of each window's first pixel.
+    pixels : numpy.ndarray
+        (K, n, n) float32 windows of the current frame.
+    cx, cy, flux : numpy.ndarray
+        (K,) centroids, in window pixels, and flux of the current frame.
+    state : dict
+        Whatever the engine precomputed for these windows, see CentroidEngine.prepare.
+    """
+
+    def __init__(self, rows, cols, weights, xOrigin, yOrigin) -> None:
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.weights = np.ascontiguousarray(weights, dtype=np.float32)
+        self.xOrigin = np.asarray(xOrigin, dtype=np.float64)
+        self.yOrigin = np.asarray(yOrigin, dtype=np.float64)
+        self.numSubAps, self.windowSize = self.weights.shape[0], self.weights.shape[1]
+        self.pixels = np.zeros_like(self.weights)
+        self.cx = np.zeros(self.numSubAps)
+        self.cy = np.zeros(self.numSubAps)
+        self.flux = np.zeros(self.numSubAps)
+        self.state = {}
+        return
+
+    def extract(self, image, threshold, out=None, origin=(0, 0)):
+        """
+        Copy the subapertures of image into the stack (or out), see extractSubapertures. 
+        origin is the position of image in the WFS image, if it is a crop.
+        """
+        if out is None:
+            out = self.pixels
+        return extractSubapertures(image, self.rows, self.cols, self.weights, threshold, out,
+                                   origin[0], origin[1])
+
+def felixSubapertureStack(masks, xvals, yvals):
+    """
+    SubapertureStack of FELIX subaperture masks. Every window is the size of the
+    largest mask's bounding box, moved inside the image where needed.
+    """
+    numMasks, H, W = masks.shape
+    boxes = []
+    for mask in masks:
+        rows, cols = np.nonzero(mask)
+        if rows.size == 0:
+            boxes.append((0, 0, 0, 0))
+        else:
+            boxes.append((rows.min(), cols.min(), rows.max() - rows.min() + 1, cols.max() - cols.min() + 1))
+    n = max(1, min(max(max(h, w) for _, _, h, w in boxes), H, W))
+    rows = np.array([min(r0, H - n) for r0, _, _, _ in boxes])
+    cols = np.array([min(c0, W - n) for _, c0, _, _ in boxes])
+    weights = np.stack([mask[r0:r0+n, c0:c0+n] != 0 for mask, r0, c0 in zip(masks, rows, cols)])
+    xvals, yvals = np.asarray(xvals), np.asarray(yvals)
+    return SubapertureStack(rows, cols, weights, xvals[cols], yvals[rows])
+
+def shwfsSubapertureStack(imageShape, numRegions, spacing, regionSize, offsetX, offsetY):
+    """
+    SubapertureStack of a regular grid of SHWFS subapertures, laid out as in
+    computeSlopesSHWFSOptimNumba. Subapertures running off the image are left
+    empty, so their slopes are zero.
+    """
+    i, j = np.divmod(np.arange(numRegions*numRegions), numRegions)
+    rows = np.round(spacing * i).astype(np.int64) + offsetY
+    cols = np.round(spacing * j).astype(np.int64) + offsetX
+    weights = np.ones((rows.size, regionSize, regionSize), dtype=np.float32)
+    outside = (rows < 0) | (cols < 0) | (rows + regionSize > imageShape[0]) | (cols + regionSize > imageShape[1])
+    weights[outside] = 0
+    rows[outside] = 0
+    cols[outside] = 0
+    origin = -(regionSize // 2)
+    return SubapertureStack(rows, cols, weights, np.full(rows.size, origin), np.full(rows.size, origin))
+
+class CentroidEngine:
+    """
+    A centroiding algorithm working on a SubapertureStack. Engines are registered
+    in CENTROID_ENGINES under the name used for the centroidEngine config key.
+
+    Anything depending only on the windows and the reference frame (reference
+    windows, templates, lookup tables) is computed by prepare into stack.state,
+    when the geometry is built. compute runs on every frame, on the pixels already
+    extracted, and must not allocate.
+
+    Config
+    ------
+    centroidFWHM : float, optional
+        FWHM of the spots in pixels, for the model spots used before a reference
+        frame is set. Default 3.0.
+    """
+
+    def __init__(self, conf) -> None:
+        self.conf = conf
+        self.spotFWHM = setFromConfig(conf, "centroidFWHM", 3.0)
+        self.referenceImage = None
+        return
+
+    def setReference(self, image):
+        """
+        Set (or clear, with None) the WFS frame reference windows are taken from.
+        Takes effect when the stacks are next prepared.
+        """
+        self.referenceImage = None if image is None else np.array(image, dtype=np.float32)
+        return
+
+    def referenceWindows(self, stack):
+        """
+        The reference frame's windows, None if no (matching) reference frame is set.
+        """
+        if self.referenceImage is None:
+            return None
+        H, W = self.referenceImage.shape
+        if stack.rows.max(initial=0) + stack.windowSize > H or stack.cols.max(initial=0) + stack.windowSize > W:
+            print("Centroid reference frame does not cover the subapertures, using model spots")
+            return None
+        return stack.extract(self.referenceImage, 0.0, out=np.zeros_like(stack.pixels))
+
+    def referenceCentroids(self, stack, windows):
+        """
+        Centre of gravity of each reference window, the window center where empty.
+        """
+        cx = np.full(stack.numSubAps, (stack.windowSize - 1)/2)
+        cy = cx.copy()
+        flux = np.zeros(stack.numSubAps)
+        centroidCoG(windows, cx, cy, flux)
+        return cx, cy
+
+    def prepare(self, stack):
+        """
+        Precompute what compute needs for stack into stack.state.
+        """
+        return
+
+    def compute(self, stack):
+        """
+        Compute stack.cx, stack.cy and stack.flux from stack.pixels.
+        """
+        raise NotImplementedError
+
+class CoGEngine(CentroidEngine):
+    """
+    Thresholded centre of gravity, as computed directly from the image by the
+    SHWFS and FELIX slope kernels.
+    """
+
+    def compute(self, stack):
+        centroidCoG(stack.pixels, stack.cx, stack.cy, stack.flux)
+        return
+
+class WeightedCoGEngine(CentroidEngine):
+    """
+    Centre of gravity weighted by a Gaussian window around each reference spot,
+    which keeps the noise of the pixels away from the spot out of the centroid.
+    The windows are cached with the stack. The weighting shrinks the measured
+    displacements by sigma_w^2/(sigma_w^2 + sigma_s^2) for Gaussian spots, which
+    is corrected for with the spot size measured on the reference frame (or
+    centroidFWHM).
+
+    Config
+    ------
+    centroidWindowFWHM : float, optional
+        FWHM of the weighting window in pixels. Default 2*centroidFWHM.
+    """
+
+    def __init__(self, conf) -> None:
+        super().__init__(conf)
+        self.windowFWHM = setFromConfig(conf, "centroidWindowFWHM", 2*self.spotFWHM)
+        return
+
+    def prepare(self, stack):
+        n = stack.windowSize
+        sigmaW2 = (self.windowFWHM / (2*np.sqrt(2*np.log(2))))**2
+        sigmaS2 = np.full(stack.numSubAps, (self.spotFWHM / (2*np.sqrt(2*np.log(2))))**2)
+        reference = self.referenceWindows(stack)
+        if reference is None:
+            centerX = np.full(stack.numSubAps, (n - 1)/2)
+            centerY = centerX.copy()
+        else:
+            centerX, centerY = self.referenceCentroids(stack, reference)
+            #Spot size from the second moments of the reference spots
+            coords = np.arange(n)
+            flux = reference.sum(axis=(1, 2))
+            lit = flux > 0
+            varX = np.einsum("kmp,kp->k", reference, (coords[None, :] - centerX[:, None])**2)
+            varY = np.einsum("kmp,km->k", reference, (coords[None, :] - centerY[:, None])**2)
+            sigmaS2[lit] = 0.5*(varX[lit] + varY[lit])/flux[lit]
+        windows = np.stack([gaussianSpot(n, x, y, self.windowFWHM) for x, y in zip(centerX, centerY)])
+        stack.state["windows"] = windows * (stack.weights > 0)
+        stack.state["centerX"] = centerX
+        stack.state["centerY"] = centerY
+        stack.state["gain"] = 1 + sigmaS2/sigmaW2
+        return
+
+    def compute(self, stack):
+        state = stack.state
+        centroidWeightedCoG(stack.pixels, state["windows"], state["centerX"], state["centerY"],
+                            state["gain"], stack.cx, stack.cy, stack.flux)
+        return
+
+class BrightestPixelsEngine(CentroidEngine):
+    """
+    Centre of gravity of the brightest pixels of each subaperture only, which
+    adapts the threshold to the flux of each spot.
+
+    Config
+    ------
+    centroidNumPixels : int, optional
+        Number of pixels used. Default 9.
+    """
+
+    def __init__(self, conf) -> None:
+        super().__init__(conf)
+        self.numPixels = setFromConfig(conf, "centroidNumPixels", 9)
+        return
+
+    def prepare(self, stack):
+        stack.state["scratch"] = np.zeros(stack.windowSize**2, dtype=np.float32)
+        return
+
+    def compute(self, stack):
+        centroidBrightest(stack.pixels, self.numPixels, stack.state["scratch"],
+                          stack.cx, stack.cy, stack.flux)
+        return
+
+class CorrelationEngine(CentroidEngine):
+    """
+    Correlation (matched filter) centroiding against the reference frame's spots,
+    or model spots at the window centers without one. Uses every pixel of the
+    spot, so it holds up at low flux and for extended spots.
+
+    Config
+    ------
+    centroidSearchRadius : int, optional
+        Largest shift from the template searched, in pixels. Default 2.
+    """
+
+    def __init__(self, conf) -> None:
+        super().__init__(conf)
+        self.searchRadius = setFromConfig(conf, "centroidSearchRadius", 2)
+        return
+
+    def prepare(self, stack):
+        n = stack.windowSize
+        templates = self.referenceWindows(stack)
+        if templates is None:
+            templates = np.stack([gaussianSpot(n, (n - 1)/2, (n - 1)/2, self.spotFWHM)]*stack.numSubAps)
+            templates *= (stack.weights > 0)
+        templateX, templateY = self.referenceCentroids(stack, templates)
+        stack.state["templates"] = np.ascontiguousarray(templates, dtype=np.float32)
+        stack.state["templateX"] = templateX
+        stack.state["templateY"] = templateY
+        stack.state["scores"] = np.zeros((2*self.searchRadius + 1, 2*self.searchRadius + 1))
+        return
+
+    def compute(self, stack):
+        state = stack.state
+        centroidCorrelation(stack.pixels, state["templates"], state["templateX"], state["templateY"],
+                            self.searchRadius, state["scores"], stack.cx, stack.cy, stack.flux)
+        return
+
+class QuadCellEngine(CentroidEngine):
+    """
+    Quad-cell centroiding: only the flux balance between the halves of each
+    subaperture is measured, linearized with a lookup table computed for
+    Gaussian spots of FWHM centroidFWHM. Cheapest and least noisy for small
+    displacements, but the response depends on the spot size.
+
+    Config
+    ------
+    centroidLUTSize : int, optional
+        Number of entries in the linearization lookup table. Default 257.
+    """
+
+    def __init__(self, conf) -> None:
+        super().__init__(conf)
+        self.lutSize = setFromConfig(conf, "centroidLUTSize", 257)
+        return
+
+    def prepare(self, stack):
+        n = stack.windowSize
+        center = (n - 1)/2
+        signs = np.sign(np.arange(n) - center).astype(np.float32)
+        #Response to a spot moved along x, the same along y
+        shifts = np.linspace(-n/2, n/2, self.lutSize)
+        q = np.array([np.sum(gaussianSpot(n, center + s, center, self.spotFWHM) * signs[None, :])
+                      / np.sum(gaussianSpot(n, center + s, center, self.spotFWHM)) for s in shifts])
+        #np.interp needs increasing samples, drop the saturated ends
+        keep = np.concatenate([[True], np.diff(q) > 1e-9])
+        stack.state["signs"] = signs
+        stack.state["lutQ"] = q[keep]
+        stack.state["lutShift"] = shifts[keep]
+        return
+
+    def compute(self, stack):
+        state = stack.state
+        centroidQuadCell(stack.pixels, state["signs"], state["lutQ"], state["lutShift"],
+                         stack.cx, stack.cy, stack.flux)
+        return
+
+CENTROID_ENGINES = {
+    "cog": CoGEngine,
+    "wcog": WeightedCoGEngine,
+    "brightest": BrightestPixelsEngine,
+    "correlation": CorrelationEngine,
+    "quadcell": QuadCellEngine,
+}
+
+def register_centroid_engine(name, engineClass):
+    """
+    Make a CentroidEngine subclass selectable with centroidEngine: name.
+    """
+    CENTROID_ENGINES[name.lower()] = engineClass
+    return
+
+def make_centroid_engine(name, conf):
+    """
+    Construct the engine registered under name, with conf (the slopes config).
+    """
+    name = name.lower()
+    if name not in CENTROID_ENGINES:
+        raise ValueError(f"Unknown centroid engine {name}, expected one of {list(CENTROID_ENGINES)}")
+    return CENTROID_ENGINES[name](conf)
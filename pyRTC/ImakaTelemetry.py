@@ -1,7 +1,7 @@
 """Builds on Telemetry.py to generate multi-extension FITS files following
 imaka telemetry format.
 """
-from pyRTC.Pipeline import ImageSHM, work
+from pyRTC.Pipeline import ImageSHM, ImageSHMGroup, work
 from pyRTC.utils import *
 from pyRTC.pyRTCComponent import *
 import os
@@ -145,10 +145,11 @@ class ImakaTelemetry(pyRTCComponent):
         return fname
 
     def recordData(self, saveWFSImages):
-        """Listens for data over the specified number of loop iterations. Since
-        not all parameters may update every iteration, it uses non-blocking reads
-        except for the loop parameters, which will update every time the loop
-        counter needs to be incremented.
+        """Listens for data over the specified number of loop iterations. Each
+        iteration blocks on the loop parameters, then reads the slopes, DM 
+        commands and WFS images of that same iteration as one snapshot (matched 
+        by the WFS frame they came from). Parameters which do not change every 
+        iteration (m2c, cmat, refSlopes) use non-blocking reads.
         """
         self._cancel_recording.clear()  # reset before starting
 
@@ -161,6 +162,11 @@ class ImakaTelemetry(pyRTCComponent):
         cmatShm, cmatDims, cmatDtype = initExistingShm("cmat")
         refSlopesShm, refSlopesDims, refSlopesDtype = initExistingShm("refSlopes")
 
+        iterationShms = [loopShm, signalShm, wfc2DShm, wfsShm]
+        if saveWFSImages:
+            iterationShms.append(wfsRaw)
+        iteration = ImageSHMGroup(iterationShms)
+
         cumulativeWFSFrame = np.zeros(wfsDims, dtype=wfsDtype)
         cumulativeSlopes = np.zeros(signalDims, dtype=signalDtype)
         cumulativeCommands = np.zeros((2, self.n_channels), dtype='f4')
@@ -173,15 +179,13 @@ class ImakaTelemetry(pyRTCComponent):
                 return
             
             # block here because it will update with each loop iteration
-            self.loopParams.append( loopShm.read() )
-
-            # do not block for all of the below, e.g., refSlopes may not be updated
-            # between loop iterations
-            slopes = signalShm.read_noblock()
+            snapshot = iteration.read()
+            loopParams, slopes, cmds, wfsImage = snapshot.frames[:4]
+            self.loopParams.append(loopParams)
             self.slopes.append([slopes])
             cumulativeSlopes += slopes
 
-            cmds = wfc2DShm.read_noblock()
+            # do not block for these, they are not updated between loop iterations
             m2c = m2cShm.read_noblock()
             cmat = cmatShm.read_noblock()
             #cmdsRaw = wfcShapeShm.read_noblock() (64, 288)
@@ -194,14 +198,17 @@ class ImakaTelemetry(pyRTCComponent):
 
             refSlopes = refSlopesShm.read_noblock()
 
-            wfsImage = wfsShm.read_noblock()
             self.slopeOffsets.append([refSlopes.flatten()])
             cumulativeWFSFrame += wfsImage
 
             if saveWFSImages:
-                self.wfsImagesRaw.append( [wfsRaw.read_noblock()] )
+                self.wfsImagesRaw.append( [snapshot.frames[4]] )
                 self.wfsImages.append([wfsImage])
 
+        if iteration.inconsistentSnapshots > 0:
+            print(f"ImakaTelemetry could not match {iteration.inconsistentSnapshots} of "
+                  f"{iteration.numSnapshots} loop iterations to their slopes, commands and images.")
+
         self.avgWfsPixels.append( cumulativeWFSFrame / self.numIter )
         self.avgSlopes.append( cumulativeSlopes / self.numIter )
         self.avgCommands.append( cumulativeCommands / self.numIter )
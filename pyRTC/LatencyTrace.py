@@ -0,0 +1,92 @@
+"""
+Pipeline latency tracing
+"""
+from pyRTC.Pipeline import ImageSHM
+import numpy as np
+import time
+
+
+class LatencyTrace:
+    """
+    A shared memory table recording when each pipeline stage finished with each
+    WFS frame, which any process can stamp into.
+
+    The table (the "latencyTrace" SHM) has one row per stage in STAGES, each holding
+    TRACE_DEPTH (frame id, CLOCK_MONOTONIC ns) entries. A stage stamps entry
+    frameId % TRACE_DEPTH of its row, where frameId is the id of the raw WFS frame
+    its output came from (the upstream frame id propagated through the ImageSHMs).
+    Each row is only written by its own stage, so no locking is needed. The frame id
+    is cleared while an entry is rewritten, so readers never pair an id with the
+    wrong timestamp.
+
+    Stages:
+    - expose: WavefrontSensor.expose published the frame
+    - slopes: SlopesProcess.computeSignal published the signal
+    - loop: Loop.sendToWfc published the correction of a closed loop iteration
+    - wfc: WavefrontCorrector.sendToHardware computed the new shape
+    """
+
+    STAGES = ["expose", "slopes", "loop", "wfc"]
+    STAGE_INDEX = {stage: i for i, stage in enumerate(STAGES)}
+    TRACE_DEPTH = 4096
+    SHM_NAME = "latencyTrace"
+
+    def __init__(self) -> None:
+        self.shm = ImageSHM(self.SHM_NAME, (len(self.STAGES), self.TRACE_DEPTH, 2), np.int64)
+        self.table = self.shm.arr
+        return
+
+    def stamp(self, stage, frameId):
+        """
+        Record that stage finished with frame frameId now.
+        """
+        if frameId <= 0:
+            return
+        entry = self.table[self.STAGE_INDEX[stage], frameId % self.TRACE_DEPTH]
+        entry[0] = 0
+        entry[1] = time.monotonic_ns()
+        entry[0] = frameId
+        return
+
+    def newestFrame(self, stage):
+        """
+        Newest frame id stamped by stage, 0 if none.
+        """
+        return int(self.table[self.STAGE_INDEX[stage], :, 0].max())
+
+    def timestamps(self, frameIds):
+        """
+        Return the (len(STAGES), len(frameIds)) timestamps in ns of the given frames,
+        -1 where a stage has no (or no longer has a) stamp for a frame.
+        """
+        frameIds = np.asarray(frameIds, dtype=np.int64)
+        entries = self.table[:, frameIds % self.TRACE_DEPTH]
+        times = entries[..., 1].copy()
+        #Re-check the ids after copying the times, in case an entry was rewritten
+        valid = (entries[..., 0] == frameIds) & (self.table[:, frameIds % self.TRACE_DEPTH, 0] == frameIds)
+        times[~valid] = -1
+        return times
+
+    def latencies(self, frameIds, stages=None):
+        """
+        Per stage and total latencies in ns for the frames every stage has stamped.
+
+        Parameters
+        ----------
+        frameIds : array_like
+            Frame ids to look up.
+        stages : list of str, optional
+            Stages to use, in pipeline order. Defaults to STAGES.
+
+        Returns
+        -------
+        stageLatencies : numpy.ndarray
+            (len(stages)-1, N) time between consecutive stages.
+        totalLatency : numpy.ndarray
+            (N,) time from the first to the last stage.
+        """
+        if stages is None:
+            stages = self.STAGES
+        times = self.timestamps(frameIds)[[self.STAGE_INDEX[s] for s in stages]]
+        times = times[:, (times >= 0).all(axis=0)]
+        return np.diff(times, axis=0), times[-1] - times[0]
@@ -4,11 +4,12 @@ os.environ["OPENBLAS_NUM_THREADS"] = "1"
 os.environ["MKL_NUM_THREADS"] = "1" 
 os.environ["VECLIB_MAXIMUM_THREADS"] = "1" 
 os.environ["NUMEXPR_NUM_THREADS"] = "1" 
-os.environ['NUMBA_NUM_THREADS'] = '1'
+os.environ.setdefault('NUMBA_NUM_THREADS', '1') # the slopes may need more, see SlopesProcess
 
 from pyRTC.Pipeline import *
 from pyRTC.utils import *
 from pyRTC.pyRTCComponent import *
+from pyRTC.Reconstruction import *
 
 import time
 import numpy as np
@@ -17,27 +18,6 @@ import time
 from numba import jit
 from functools import wraps
 
-@jit(nopython=True, nogil=True, cache=True, fastmath=True)
-def leakyIntegratorNumba(slopes: np.ndarray, 
-                         resconstructionMatrix: np.ndarray, 
-                         oldCorrection: np.ndarray,
-                         correction: np.ndarray,
-                         leak: np.float32,
-                         numActiveModes: int) -> np.ndarray:
-    
-    # Perform the matrix-vector multiplication using np.dot
-    correction = np.dot(resconstructionMatrix, slopes)
-    
-    # Apply the leaky integrator formula with an unrolled loop
-    for i in range(numActiveModes + 1):
-        correction[i] = (1 - leak) * oldCorrection[i] - correction[i]
-    
-    # Zero out the rest of the correction vector
-    for i in range(numActiveModes + 1, correction.size):
-        correction[i] = 0.0
-    
-    return correction
-
 def leakIntegratorGPU(slopes:np.ndarray, 
                                 resconstructionMatrix:torch.tensor, 
                                 oldCorrection:np.ndarray,
@@ -73,6 +53,10 @@ def loop_iter(func):
     @wraps(func)
     def wrapper(self, *args, **kwargs):
         
+        result = func(self, *args, **kwargs)
+
+        #Written once the iteration is done, stamped with the WFS frame it used, so
+        #readers of "loop" can match it with the slopes and commands of the iteration
         wfsInfo = self.wfsInfoShm.read_noblock()
         self.loopParams.write( np.array(
             [
@@ -82,9 +66,7 @@ def loop_iter(func):
                 wfsInfo[0], # dt since last frame
                 wfsInfo[1] # absolute time
             ],
-            dtype=self.loopParamsDtype) )
-        
-        result = func(self, *args, **kwargs)
+            dtype=self.loopParamsDtype), upstreamId=self.signalShm.lastUpstreamId )
         self.loopCounter += 1
 
         return result
@@ -276,6 +258,8 @@ class Loop(pyRTCComponent):
 
         self.IM = np.zeros((self.signalSize, self.numModes),dtype=self.signalDType)
         self.CM = np.zeros((self.numModes, self.signalSize),dtype=self.signalDType)
+        #Reconstructed modes for the in place integrators
+        self.integratorScratch = np.zeros(self.numModes, dtype=self.CM.dtype)
         self.gain = setFromConfig(self.conf, "gain", 0.1)
         self.leakyGain = setFromConfig(self.conf, "leakyGain", 0.0)
         self.perturbAmp = 0
@@ -339,9 +323,18 @@ class Loop(pyRTCComponent):
         return
 
     def start(self):
+        #Only one process may write the wfc SHM, e.g. a SlopesProcess running the fused reconstruction
+        if not self.wfcShm.claimWriter():
+            print(f"wfc is being written by PID {self.wfcShm.otherWriter()}, not starting the loop")
+            return -1
         self.bufferCount = 0
         return super().start()
 
+    def stop(self):
+        super().stop()
+        self.wfcShm.releaseWriter()
+        return
+
     def setGain(self, gain):
         """
         Set the integrator gain. Only needed for certain integrators.
@@ -387,13 +380,40 @@ class Loop(pyRTCComponent):
             self.playbackBuffer = pb
         return
 
+    def averageSignal(self, numFrames):
+        """
+        Average numFrames new signal frames, after burning the first new one since
+        the DM may have been moving during its exposure. With a RingImageSHM signal
+        the frames are consecutive, otherwise frames the loop misses are skipped.
+        """
+        if isinstance(self.signalShm, RingImageSHM):
+            self.signalShm.skipToLatest()
+            dropped = self.signalShm.droppedFrames
+            readSignal = self.signalShm.readNext
+        else:
+            readSignal = lambda: self.signalShm.read(RELEASE_GIL = True)
+        readSignal()
+        avg = np.zeros(self.signalShape, dtype=self.IM.dtype)
+        for n in range(numFrames):
+            avg += readSignal()
+        avg /= numFrames
+        if isinstance(self.signalShm, RingImageSHM) and self.signalShm.droppedFrames > dropped:
+            logging.log(level=logging.WARNING, msg=f"{self.name}: Dropped {self.signalShm.droppedFrames - dropped} signal frames while averaging")
+        return avg
+
     def pushPullIM(self):
         """
         Compute the interaction matrix using the push-pull method.
         """
-        self.IM *= 0 
+        #Measured into a new matrix, so a cancelled job leaves the IM as it was
+        IM = np.zeros_like(self.IM)
         #For each mode
         for i in range(self.numActiveModes):#range(self.numModes):
+            try:
+                self.reportProgress(i/self.numActiveModes)
+            except JobCancelled:
+                self.flatten()
+                raise
             #Reset the correction
             correction = self.flat.copy()
             #Plus amplitude
@@ -402,13 +422,8 @@ class Loop(pyRTCComponent):
             self.sendToWfc(correction)
             #Add some delay to ensure one-to-one
             time.sleep(self.hardwareDelay)
-            #Burn the first new image since we were moving the DM during the exposure
-            self.signalShm.read(RELEASE_GIL = True)
             #Average out N new WFS frames
-            tmp_plus = np.zeros_like(self.IM[:,i])
-            for n in range(self.numItersIM):
-                tmp_plus += self.signalShm.read(RELEASE_GIL = True)
-            tmp_plus /= self.numItersIM
+            tmp_plus = self.averageSignal(self.numItersIM)
 
             #Minus amplitude
             correction[i] = -self.pokeAmp
@@ -416,17 +431,13 @@ class Loop(pyRTCComponent):
             self.sendToWfc(correction)
             #Add some delay to ensure one-to-one
             time.sleep(self.hardwareDelay)
-            #Burn the first new image since we were moving the DM during the exposure
-            self.signalShm.read(RELEASE_GIL = True)
             #Average out N new WFS frames
-            tmp_minus = np.zeros_like(self.IM[:,i])
-            for n in range(self.numItersIM):
-                tmp_minus += self.signalShm.read(RELEASE_GIL = True)
-            tmp_minus /= self.numItersIM
+            tmp_minus = self.averageSignal(self.numItersIM)
 
             #Compute the normalized difference
-            self.IM[:,i] = (tmp_plus-tmp_minus)/(2*self.pokeAmp)
+            IM[:,i] = (tmp_plus-tmp_minus)/(2*self.pokeAmp)
 
+        self.IM = IM
         return
     
     def docrimeIM(self, lag=0):
@@ -461,7 +472,15 @@ class Loop(pyRTCComponent):
         lagNum = lag
         oldCorrection = np.zeros_like(correction)
         
-        for i in range(self.numItersIM * (lag+1)):
+        numIters = self.numItersIM * (lag+1)
+        for i in range(numIters):
+            try:
+                self.reportProgress(i/numIters)
+            except JobCancelled:
+                self.docrimeCross = np.zeros_like(self.docrimeCross)
+                self.docrimeAuto = np.zeros_like(self.docrimeAuto)
+                self.flatten()
+                raise
 
             isLagStep = lagNum < lag
             if isLagStep:
@@ -628,7 +647,7 @@ class Loop(pyRTCComponent):
         newCorrection = self.updateCorrectionPOL(correction=currentCorrection, 
                                                  slopes=residual_slopes)
         newCorrection[self.numActiveModes:] = 0
-        self.sendToWfc(newCorrection)
+        self.sendToWfc(newCorrection, upstreamId=self.signalShm.lastUpstreamId)
         return
 
     @loop_iter
@@ -637,13 +656,15 @@ class Loop(pyRTCComponent):
         Standard integrator.
         """
         slopes = self.signalShm.read(SAFE=False, RELEASE_GIL = self.RELEASE_GIL)
-        newCorrection = leakyIntegratorNumba(slopes, 
-                         self.gCM, 
-                         self.wfcShm.read_noblock(SAFE=False).squeeze(),
-                         self.nullCorrection,
-                         np.float32(0),#No leak
-                         self.numActiveModes)
-        self.sendToWfc(newCorrection, slopes=slopes)
+        #Integrate straight into the wfc SHM, which holds the current correction
+        with self.wfcShm.writing() as newCorrection:
+            leakyIntegratorInPlaceNumba(slopes, 
+                             self.gCM, 
+                             newCorrection.reshape(-1),
+                             self.integratorScratch,
+                             np.float32(0),#No leak
+                             self.numActiveModes)
+            self.sendToWfc(newCorrection, slopes=slopes, upstreamId=self.signalShm.lastUpstreamId)
         return
     
     @loop_iter
@@ -652,17 +673,19 @@ class Loop(pyRTCComponent):
         Leaky integrator.
         """
         slopes = self.signalShm.read(SAFE=False, RELEASE_GIL = self.RELEASE_GIL)
-        newCorrection = leakyIntegratorNumba(slopes, 
-                         self.gCM, 
-                         self.wfcShm.read_noblock(SAFE=False).squeeze(),
-                         self.nullCorrection,
-                         np.float32(self.leakyGain),
-                         self.numActiveModes)
-    
-        # Add in commands from playback buffer
-        idx = self.loopCounter % len(self.playbackBuffer)
-        newCorrection += self.pbGain * self.playbackBuffer[idx]
-        self.sendToWfc(newCorrection, slopes=slopes)
+        #Integrate straight into the wfc SHM, which holds the current correction
+        with self.wfcShm.writing() as newCorrection:
+            leakyIntegratorInPlaceNumba(slopes, 
+                             self.gCM, 
+                             newCorrection.reshape(-1),
+                             self.integratorScratch,
+                             np.float32(self.leakyGain),
+                             self.numActiveModes)
+        
+            # Add in commands from playback buffer
+            idx = self.loopCounter % len(self.playbackBuffer)
+            newCorrection += self.pbGain * self.playbackBuffer[idx]
+            self.sendToWfc(newCorrection, slopes=slopes, upstreamId=self.signalShm.lastUpstreamId)
         return
     
     def pidIntegratorPOL(self):
@@ -724,7 +747,7 @@ class Loop(pyRTCComponent):
         newCorrection = np.clip(newCorrection, *self.absoluteLimits)
         
         #Apply new correction to mirror
-        self.sendToWfc(newCorrection, slopes = slopes)
+        self.sendToWfc(newCorrection, slopes = slopes, upstreamId=self.signalShm.lastUpstreamId)
 
         # Save state for next iteration
         self.previousWfError = wfError
@@ -752,7 +775,7 @@ class Loop(pyRTCComponent):
         newCorrection = (1-self.gain)*currentCorrection - np.dot(self.gCM,s_pol_pred)
 
         newCorrection[self.numActiveModes:] = 0
-        self.sendToWfc(newCorrection)
+        self.sendToWfc(newCorrection, upstreamId=self.signalShm.lastUpstreamId)
 
     @loop_iter
     def linearPredictIntegrator(self):
@@ -779,7 +802,7 @@ class Loop(pyRTCComponent):
         newCorrection = (1-self.leakyGain)*oldCorrection - extrapolatedDelta 
 
         # send absolute modal vector to mirror
-        self.sendToWfc(newCorrection, slopes=slopes)
+        self.sendToWfc(newCorrection, slopes=slopes, upstreamId=self.signalShm.lastUpstreamId)
 
         # Update buffer
         self.buffer = np.roll(self.buffer,1,axis=0)
@@ -795,10 +818,20 @@ class Loop(pyRTCComponent):
         self.numDroppedModes = numDroppedModes
         self.computeCM() # recompute CM to reflect new number of active modes
 
-    def sendToWfc(self, correction, slopes=None):
+    def sendToWfc(self, correction, slopes=None, upstreamId=-1):
+        """
+        Write correction to the wfc SHM. Closed loop iterations pass the upstreamId 
+        of the signal they used, which is traced. Anything else (pokes, flatten) 
+        keeps the default, -1.
+        """
 
+        #Another process (see start) is closing the loop on the wfc SHM
+        if self.wfcShm.otherWriter() > 0:
+            print(f"wfc is being written by PID {self.wfcShm.otherWriter()}, not sending")
+            return -1
         #Get an initial slope reading to set shapes
-        correction = correction.reshape(self.wfcShape)
+        if correction.shape != tuple(self.wfcShape):
+            correction = correction.reshape(self.wfcShape)
         #correction[self.numActiveModes:] = 0 - I think this needs to stay here for DO-CRIME
         if self.clDocrime and isinstance(slopes, np.ndarray):
 
@@ -821,7 +854,7 @@ class Loop(pyRTCComponent):
                 correction = randShape
 
             #Send our new pertubation to the WFC
-            self.wfcShm.write(correction)
+            self.wfcShm.write(correction, upstreamId=upstreamId)
 
             #Correlate Current response with old correction by delay time
             self.docrimeCross += slopes@self.docrimeBuffer[0].T
@@ -830,7 +863,9 @@ class Loop(pyRTCComponent):
             self.numItersDC += 1
 
         else:
-            self.wfcShm.write(correction)
+            self.wfcShm.write(correction, upstreamId=upstreamId)
+        if upstreamId >= 0:
+            self.traceFrame("loop", upstreamId)
         return
 
     def solveDocrime(self):
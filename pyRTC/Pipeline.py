@@ -11,9 +11,20 @@ import socket
 import json 
 import struct
 import logging
+import tempfile
+import mmap
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError, wait as wait_futures
+from collections import namedtuple, deque
+from contextlib import contextmanager
 
 from pyRTC.utils import *
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 try:
     import torch
     # Mapping dictionary
@@ -61,10 +72,204 @@ def work(obj, functionName, affinity):
             time.sleep(1e-3)
     return
 
+#Per frame header fields of an ImageSHM, timestamp is CLOCK_MONOTONIC in ns
+FrameInfo = namedtuple("FrameInfo", ["frameId", "upstreamId", "timestamp"])
+
+class SHMRegistry:
+    """
+    A directory of every ImageSHM created by a producer, recording its name, dtype, 
+    shape, number of ring slots, producer PID, creation time and last write time.
+
+    The entries are a numpy structured array in a single fixed size shared memory 
+    segment, so any process can discover every stream with one mapping instead of 
+    probing <name>_meta segments. Adding and removing entries is serialised with a 
+    lock file, the last write time is updated lock free by the producer.
+    """
+
+    NAME = "pyRTCRegistry"
+    MAX_ENTRIES = 256
+    MAX_DIMS = 8
+    DTYPE = np.dtype([("name", "S64"),
+                      ("dtype", "S16"),
+                      ("ndim", np.int64),
+                      ("shape", np.int64, (MAX_DIMS,)),
+                      ("numSlots", np.int64),
+                      ("pid", np.int64),
+                      ("created", np.float64),
+                      ("lastWrite", np.float64)])
+
+    def __init__(self) -> None:
+        self.lockFile = os.path.join(tempfile.gettempdir(), self.NAME + ".lock")
+        with self.lock():
+            try:
+                self.shm = shared_memory.SharedMemory(name=self.NAME, create=True, 
+                                                      size=self.DTYPE.itemsize*self.MAX_ENTRIES)
+            except FileExistsError:
+                self.shm = shared_memory.SharedMemory(name=self.NAME)
+        if sys.platform != 'win32':
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.entries = np.ndarray((self.MAX_ENTRIES,), dtype=self.DTYPE, buffer=self.shm.buf)
+        return
+
+    @contextmanager
+    def lock(self):
+        """
+        Hold the registry lock (a no-op where fcntl is unavailable).
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(self.lockFile, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def find(self, name):
+        """
+        Index of the entry for name, -1 if there is none.
+        """
+        index = np.flatnonzero(self.entries["name"] == name.encode())
+        return int(index[0]) if index.size > 0 else -1
+
+    def register(self, name, shape, dtype, numSlots=1):
+        """
+        Add (or replace) the entry for name, owned by this process. Returns its index, 
+        -1 if it could not be added.
+        """
+        if len(shape) > self.MAX_DIMS or len(name.encode()) > self.DTYPE["name"].itemsize:
+            logging.log(level=logging.WARNING, msg=f"{name}: Cannot add to the SHM registry")
+            return -1
+        with self.lock():
+            index = self.find(name)
+            if index < 0:
+                free = np.flatnonzero(self.entries["name"] == b"")
+                if free.size == 0:
+                    logging.log(level=logging.WARNING, msg=f"{name}: SHM registry is full")
+                    return -1
+                index = int(free[0])
+            paddedShape = list(shape) + [0]*(self.MAX_DIMS - len(shape))
+            self.entries[index] = (name.encode(), np.dtype(dtype).str.encode(), len(shape), paddedShape, 
+                                   numSlots, os.getpid(), time.time(), 0.0)
+        return index
+
+    def unregister(self, name):
+        with self.lock():
+            index = self.find(name)
+            if index >= 0:
+                self.entries[index] = np.zeros((), dtype=self.DTYPE)
+        return
+
+    def entryToDict(self, entry):
+        ndim = int(entry["ndim"])
+        return {"name": entry["name"].decode(),
+                "dtype": np.dtype(entry["dtype"].decode()),
+                "shape": [int(x) for x in entry["shape"][:ndim]],
+                "numSlots": int(entry["numSlots"]),
+                "pid": int(entry["pid"]),
+                "created": float(entry["created"]),
+                "lastWrite": float(entry["lastWrite"])}
+
+    def lookup(self, name):
+        """
+        The entry for name as a dict, None if there is none.
+        """
+        index = self.find(name)
+        if index < 0:
+            return None
+        return self.entryToDict(self.entries[index].copy())
+
+    def list(self):
+        """
+        Every entry, as a list of dicts.
+        """
+        entries = self.entries[self.entries["name"] != b""].copy()
+        return [self.entryToDict(entry) for entry in entries]
+
+#Opened on first use, one per process
+_registry = None
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = SHMRegistry()
+    return _registry
+
 class ImageSHM:
+    """
+    A numpy array backed by a named shared memory segment, with an associated
+    <name>_meta segment describing it.
+
+    The first 10 float64 entries of the metadata hold the legacy layout read by the
+    viewers: [count, lastWriteTime, size, dtype, shape...]. The remaining entries are
+    interpreted as int64 header fields (see the *_IDX constants).
+
+    When NOTIFY is True and the platform supports it, readers block on a futex word
+    in the metadata segment which every write() bumps, instead of sleep-polling.
+    Set NOTIFY to False (or shmNotify: False in a component config) to fall back
+    to polling.
+
+    Writes are protected by a sequence counter (seqlock): the writer makes it odd
+    before touching the data and even once done. Safe reads retry until they copy
+    a frame with the same, even, sequence number before and after, so a reader in
+    another process never returns a half written frame. readRetries counts how
+    many times this reader had to retry. The sequence counter is not updated 
+    atomically, so an SHM must only have one writing process at a time. Processes 
+    writing an SHM they did not create (e.g. the Loop and the fused reconstruction 
+    of a SlopesProcess both write "wfc") take turns with claimWriter().
+
+    Producers can avoid the copy in write() by computing straight into the SHM: 
+    acquire_write_buffer() returns the SHM backed array (holding the current frame) 
+    and marks a write as in progress, commit() publishes it. Metadata, the sequence 
+    counter and reader notification are only updated on commit. If the frame cannot 
+    be finished, abort_write() ends the write without publishing it, writing() does 
+    so when the code computing the frame raises.
+
+    Every write is stamped with a frame id (incremented in the SHM, so shared by all 
+    writers), a CLOCK_MONOTONIC timestamp in ns and an upstream frame id: the id of 
+    the frame at the start of the pipeline (e.g. the raw WFS frame) this one was 
+    computed from. Stages pass on the lastUpstreamId of their input, stages with no 
+    input default to their own frame id. frameInfo() returns these fields without 
+    copying the frame, and every read records them in lastFrameId/lastUpstreamId.
+    """
 
-    METADATA_SIZE = 10
-    def __init__(self, name, shape, dtype, gpuDevice=None, consumer=True) -> None:
+    METADATA_SIZE = 32
+    LEGACY_METADATA_SIZE = 10
+    #int64 header fields, stored after the legacy float64 metadata
+    NOTIFY_IDX = 10
+    SEQ_IDX = 11
+    #Number of frame slots, >1 for a RingImageSHM
+    NUM_SLOTS_IDX = 12
+    #Number of frames committed to a RingImageSHM
+    WRITE_INDEX_IDX = 13
+    FRAME_ID_IDX = 14
+    UPSTREAM_ID_IDX = 15
+    TIMESTAMP_IDX = 16
+    #How the producer prepared the data segment, a combination of the MEMORY_* flags
+    MEMORY_FLAGS_IDX = 17
+    MEMORY_PREFAULTED = 1
+    MEMORY_LOCKED = 2
+    MEMORY_HUGE_PAGES = 4
+    #PID of the process holding the write claim, 0 if none (see claimWriter)
+    WRITER_PID_IDX = 18
+    #Use event driven wakeups where available
+    NOTIFY = True
+    #Touch every page of the data segment when it is mapped
+    PREFAULT = False
+    #mlock the data segment so it is never swapped out
+    LOCK_MEMORY = False
+    #Ask for the data segment to be backed by transparent huge pages
+    HUGE_PAGES = False
+    #Longest single futex wait before re-checking for new data (seconds)
+    NOTIFY_WAIT_SLICE = 0.1
+    #Give up on a consistent read after this many attempts (e.g. the writer died mid-write)
+    MAX_READ_RETRIES = 100000
+    numSlots = 1
+    #Bytes a subclass keeps after the array in the data segment
+    extraBytes = 0
+
+    def __init__(self, name, shape, dtype, gpuDevice=None, consumer=True, notify=None) -> None:
 
         self.name = name
         self.dtype = dtype
@@ -74,16 +279,34 @@ class ImageSHM:
         self.metadata = np.zeros(self.METADATA_SIZE, dtype=np.float64)
         self.count = 0
         self.lastWriteTime = 0
-        self.lastReadTime = 0
+        self.lastSeenId = 0
+        self.lastFrameId = -1
+        self.lastUpstreamId = -1
+        self.lastWrittenId = -1
+        self.registryIndex = -1
+        self.readRetries = 0
+        self.writeBuffer = None
+        self.writeOpen = False
+        self.memoryFlags = 0
         self.areData = not ("meta" in name)
         self.gpuDevice = gpuDevice
+        self.gpuScratch = None
+        if notify is None:
+            notify = ImageSHM.NOTIFY
+        self.notify = notify and FUTEX_AVAILABLE
 
         try:
-            self.shm = shared_memory.SharedMemory(name= name, create=True, size=self.arr.nbytes)
+            self.shm = shared_memory.SharedMemory(name= name, create=True, size=self.arr.nbytes + self.extraBytes)
             print(f"Creating New Shared Memory Object {self.name}")
         except:
             self.shm = shared_memory.SharedMemory(name=name)
             print(f"Opening Existing Shared Memory Object {self.name}")
+            #A producer may find a smaller segment left over from a previous layout
+            if not consumer and self.shm.size < self.arr.nbytes + self.extraBytes:
+                logging.log(level=logging.WARNING, msg=f"{self.name}: Existing shared memory is too small, recreating")
+                self.shm.close()
+                self.shm.unlink()
+                self.shm = shared_memory.SharedMemory(name= name, create=True, size=self.arr.nbytes + self.extraBytes)
 
         #Doesn't work in windows
         if sys.platform != 'win32':
@@ -93,16 +316,24 @@ class ImageSHM:
         #If we are not opening a metadata shm
         if self.areData:
             #Create/Open an associated metadata SHM 
-            try:
-                self.metadataShm = shared_memory.SharedMemory(name= name+"_meta", create=True, size=self.metadata.nbytes)
-                print(f"Creating New Shared Memory Object {self.name}"+"_meta")
-            except:
-                self.metadataShm = shared_memory.SharedMemory(name= name+"_meta")
-                print(f"Opening Existing Shared Memory Object {self.name}"+"_meta")
-            if sys.platform != 'win32':
-                resource_tracker.unregister(self.metadataShm._name, 'shared_memory')
+            self.metadataShm = self.openMetadataShm()
             self.metadata = np.ndarray(self.metadata.shape, dtype=self.metadata.dtype, buffer=self.metadataShm.buf)
+            #Integer view of the same segment for the header fields
+            self.header = np.ndarray(self.metadata.shape, dtype=np.int64, buffer=self.metadataShm.buf)
+            #32 bit futex word used to wake blocked readers
+            self.notifyWord = np.ndarray((1,), dtype=np.int32, buffer=self.metadataShm.buf, 
+                                         offset=self.NOTIFY_IDX*self.header.itemsize)
+            self.notifyAddress = self.notifyWord.ctypes.data
             self.updateMetadata(FULL_UPDATE=True)
+            #Only frames written from now on are new
+            self.markSeen()
+            self.memoryFlags = self.prepareMemory(consumer)
+            if not consumer:
+                #A previous producer may have died mid-write, leaving the sequence odd
+                self.header[self.SEQ_IDX] += self.header[self.SEQ_IDX] & 1
+                self.header[self.NUM_SLOTS_IDX] = self.numSlots
+                self.header[self.MEMORY_FLAGS_IDX] = self.memoryFlags
+                self.registerProducer(shape)
 
             if self.gpuDevice is not None:
                 self.torchDtype = dtype_mapping.get(self.dtype, None)
@@ -120,6 +351,98 @@ class ImageSHM:
 
         self.close()
 
+    def prepareMemory(self, consumer):
+        """
+        Apply HUGE_PAGES, PREFAULT and LOCK_MEMORY to this process' mapping of the 
+        data segment, so the real-time loop does not page fault or get swapped out. 
+        Returns the MEMORY_* flags which took effect.
+
+        Huge pages are requested with madvise(MADV_HUGEPAGE), which only has an 
+        effect when /sys/kernel/mm/transparent_hugepage/shmem_enabled allows it and 
+        the segment holds at least one huge page. They are reported only then, and 
+        if the mapping is prefaulted, only if the kernel actually mapped some huge 
+        pages. A producer prefaults by rewriting one byte per page, consumers only 
+        read, so they never race with the producer's writes.
+        """
+        flags = 0
+        hugePages = False
+        if self.HUGE_PAGES:
+            hugePageSize = shmem_huge_page_size()
+            if hugePageSize == 0 or self.shm.size < hugePageSize:
+                logging.log(level=logging.WARNING, msg=f"{self.name}: No huge pages, shmem_enabled does not allow them or the segment is smaller than one")
+            else:
+                try:
+                    self.shm._mmap.madvise(mmap.MADV_HUGEPAGE)
+                    hugePages = True
+                except (AttributeError, OSError) as e:
+                    logging.log(level=logging.WARNING, msg=f"{self.name}: Could not request huge pages: {e}")
+        if self.PREFAULT or self.LOCK_MEMORY:
+            pages = np.ndarray((self.shm.size,), dtype=np.uint8, buffer=self.shm.buf)
+            if self.PREFAULT:
+                touched = pages[::mmap.PAGESIZE]
+                if consumer:
+                    touched.sum()
+                else:
+                    touched[:] = touched
+                del touched
+                flags |= self.MEMORY_PREFAULTED
+                #The pages are mapped now, check what the kernel gave us
+                if hugePages and mapped_huge_page_bytes(pages.ctypes.data) == 0:
+                    logging.log(level=logging.WARNING, msg=f"{self.name}: Huge pages were requested but none are mapped")
+                    hugePages = False
+            if self.LOCK_MEMORY:
+                if mlock_memory(pages.ctypes.data, pages.nbytes):
+                    flags |= self.MEMORY_LOCKED
+                else:
+                    logging.log(level=logging.WARNING, msg=f"{self.name}: Could not lock shared memory, check ulimit -l")
+            del pages
+        if hugePages:
+            flags |= self.MEMORY_HUGE_PAGES
+        return flags
+
+    def memoryStatus(self):
+        """
+        How the producer prepared its mapping of the data segment, as a dict of 
+        prefaulted, locked and hugePages.
+        """
+        flags = int(self.header[self.MEMORY_FLAGS_IDX])
+        return {"prefaulted": bool(flags & self.MEMORY_PREFAULTED),
+                "locked": bool(flags & self.MEMORY_LOCKED),
+                "hugePages": bool(flags & self.MEMORY_HUGE_PAGES)}
+
+    def registerProducer(self, shape):
+        """
+        Add this SHM to the SHMRegistry as produced by this process.
+        """
+        try:
+            registry = get_registry()
+            self.registryIndex = registry.register(self.name, tuple(shape), self.arr.dtype, self.numSlots)
+            self.registryLastWrite = registry.entries["lastWrite"]
+        except Exception as e:
+            logging.log(level=logging.WARNING, msg=f"{self.name}: Could not register in the SHM registry: {e}")
+        return
+
+    def openMetadataShm(self):
+        """
+        Create or open the <name>_meta segment. Segments left over from an older, 
+        smaller metadata layout are recreated.
+        """
+        metaName = self.name + "_meta"
+        try:
+            metadataShm = shared_memory.SharedMemory(name=metaName, create=True, size=self.metadata.nbytes)
+            print(f"Creating New Shared Memory Object {metaName}")
+        except FileExistsError:
+            metadataShm = shared_memory.SharedMemory(name=metaName)
+            print(f"Opening Existing Shared Memory Object {metaName}")
+            if metadataShm.size < self.metadata.nbytes:
+                logging.log(level=logging.WARNING, msg=f"{metaName}: Stale metadata layout, recreating")
+                metadataShm.close()
+                metadataShm.unlink()
+                metadataShm = shared_memory.SharedMemory(name=metaName, create=True, size=self.metadata.nbytes)
+        if sys.platform != 'win32':
+            resource_tracker.unregister(metadataShm._name, 'shared_memory')
+        return metadataShm
+
     def createGPUMemSHM(self):
 
         # Create a GPU tensor
@@ -267,7 +590,92 @@ class ImageSHM:
         self.shm.close()
         return
 
-    def write(self, arr):
+    def acquire_write_buffer(self):
+        """
+        Return the array to compute the next frame into, which holds the current 
+        frame. Readers see the new frame once commit() is called.
+
+        For GPU SHMs this is a CPU scratch copy, published through write() on commit.
+        """
+        if self.gpuDevice is not None:
+            if not isinstance(self.gpuScratch, np.ndarray):
+                self.gpuScratch = np.empty_like(self.arr)
+            np.copyto(self.gpuScratch, self.arr)
+            self.writeBuffer = self.gpuScratch
+        else:
+            self.beginWrite()
+            self.writeBuffer = self.arr
+        return self.writeBuffer
+
+    def commit(self, upstreamId=None):
+        """
+        Publish the frame computed into the buffer from acquire_write_buffer().
+        """
+        if self.writeBuffer is None:
+            logging.log(level=logging.ERROR, msg=f"{self.name}: commit() called without acquire_write_buffer()")
+            return -1
+        if self.writeBuffer is not self.arr:
+            buffer, self.writeBuffer = self.writeBuffer, None
+            return self.write(buffer, upstreamId=upstreamId)
+        self.endWrite(upstreamId)
+        return 1
+
+    def abort_write(self):
+        """
+        End a write started by acquire_write_buffer() without publishing a new frame, 
+        so readers stop waiting for it. The buffer may have been partly overwritten, 
+        it keeps the id of the previous frame. Does nothing if no write is open.
+        """
+        self.writeBuffer = None
+        if self.areData and self.writeOpen:
+            self.header[self.SEQ_IDX] += 1
+            self.writeOpen = False
+        return
+
+    @contextmanager
+    def writing(self):
+        """
+        acquire_write_buffer() for a with block: yields the buffer, and calls 
+        abort_write() if the block raises before commit().
+        """
+        buffer = self.acquire_write_buffer()
+        try:
+            yield buffer
+        except BaseException:
+            self.abort_write()
+            raise
+
+    def claimWriter(self):
+        """
+        Claim the SHM as the only process writing it, until releaseWriter(). Returns 
+        False if another running process holds the claim.
+        """
+        with get_registry().lock():
+            if self.otherWriter() > 0:
+                return False
+            self.header[self.WRITER_PID_IDX] = os.getpid()
+        return True
+
+    def releaseWriter(self):
+        with get_registry().lock():
+            if self.header[self.WRITER_PID_IDX] == os.getpid():
+                self.header[self.WRITER_PID_IDX] = 0
+        return
+
+    def otherWriter(self):
+        """
+        PID of another running process holding the write claim, 0 if there is none.
+        """
+        pid = int(self.header[self.WRITER_PID_IDX])
+        if pid in (0, os.getpid()) or not psutil.pid_exists(pid):
+            return 0
+        return pid
+
+    def write(self, arr, upstreamId=None):
+
+        #The producer computed straight into the SHM
+        if self.writeBuffer is not None and arr is self.writeBuffer:
+            return self.commit(upstreamId)
 
         #Check if we are a GPU shm
         if self.gpuDevice is not None:
@@ -283,9 +691,12 @@ class ImageSHM:
                 #copy the tensor to the GPU shm
                 self.shmGPU.copy_(arr)
                 #copy a CPU numpy version to the CPU shm
-                np.copyto(self.arr, arr.detach().cpu().numpy())
+                cpuArr = arr.detach().cpu().numpy()
+                self.beginWrite()
+                np.copyto(self.arr, cpuArr)
             elif isinstance(arr, np.ndarray):
                 #copy a CPU numpy version to the CPU shm
+                self.beginWrite()
                 np.copyto(self.arr, arr)
                 #copy the tensor to the GPU shm
                 tensor = torch.from_numpy(arr)
@@ -299,25 +710,108 @@ class ImageSHM:
                 logging.log(level=logging.ERROR, msg=f"{self.name}: Writing Wrong size array to SHM. Expecting {self.arr.shape}, Got {arr.shape}")
                 return -1
             #Copy to SHM
+            self.beginWrite()
             np.copyto(self.arr, arr)
 
         #Update metadata
+        self.endWrite(upstreamId)
+
+        #Return Success
+        return 1
+
+    def beginWrite(self):
+        """
+        Mark the data as being modified (odd sequence number).
+        """
+        if self.areData and not self.writeOpen:
+            self.header[self.SEQ_IDX] += 1
+            self.writeOpen = True
+        return
+
+    def endWrite(self, upstreamId=None):
+        """
+        Update the metadata, mark the data as consistent (even sequence number)
+        and wake up any waiting readers.
+        """
         self.count += 1
         self.lastWriteTime = time.time()
+        self.writeBuffer = None
         if self.areData:
+            self.stampFrame(upstreamId)
             self.updateMetadata()
+            if self.registryIndex >= 0:
+                self.registryLastWrite[self.registryIndex] = self.lastWriteTime
+            if self.writeOpen:
+                self.header[self.SEQ_IDX] += 1
+                self.writeOpen = False
+            self.notifyReaders()
+        return
 
-        #Return Success
-        return 1
+    def stampFrame(self, upstreamId=None):
+        """
+        Give the frame being written the next frame id, a timestamp and its upstream 
+        frame id (its own id if None).
+        """
+        frameId = int(self.header[self.FRAME_ID_IDX]) + 1
+        self.header[self.FRAME_ID_IDX] = frameId
+        self.header[self.UPSTREAM_ID_IDX] = frameId if upstreamId is None else upstreamId
+        self.header[self.TIMESTAMP_IDX] = time.monotonic_ns()
+        self.lastWrittenId = frameId
+        return frameId
+
+    def frameInfo(self):
+        """
+        Return the FrameInfo of the newest frame, without reading the frame itself.
+        """
+        for attempt in range(self.MAX_READ_RETRIES):
+            seq = self.header[self.SEQ_IDX]
+            info = FrameInfo(*(int(x) for x in self.header[self.FRAME_ID_IDX:self.TIMESTAMP_IDX+1]))
+            if not (seq & 1) and self.header[self.SEQ_IDX] == seq:
+                return info
+        return info
+
+    def notifyReaders(self):
+        """
+        Wake any readers blocked on this SHM. Must be called after the metadata
+        has been updated.
+        """
+        if FUTEX_AVAILABLE:
+            self.notifyWord[0] += 1
+            futex_wake(self.notifyAddress)
+        return
+
+    def holdNotify(self, timeout=None):
+        """
+        Block on the SHM's futex word until a new write is seen or timeout elapses.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            #Read the word before checking, so a write in between makes the wait return
+            word = int(self.notifyWord[0])
+            if self.checkNew():
+                return
+            waitTime = self.NOTIFY_WAIT_SLICE
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                waitTime = min(waitTime, remaining)
+            futex_wait(self.notifyAddress, word, waitTime)
     
     def hold(self, timeout=None, RELEASE_GIL = True):
+        #Seconds as any real number (e.g. a numpy scalar), raises if it is not one
+        if timeout is not None:
+            timeout = float(timeout)
+        if self.notify and self.areData:
+            self.holdNotify(timeout=timeout)
+            return
         if timeout is None:
             while not self.checkNew():
                 if RELEASE_GIL:
                     time.sleep(1e-5)
                 else:
                     precise_delay(5)
-        elif isinstance(timeout, float) or isinstance(timeout,int):
+        else:
             start = time.time()
             while not self.checkNew() and (time.time() - start) < timeout:
                 if RELEASE_GIL:
@@ -342,22 +836,77 @@ class ImageSHM:
         if SAFE:
             #If the user asks to read the GPU shm
             if GPU and self.gpuDevice is not None:
+                self.lastFrameId = int(self.header[self.FRAME_ID_IDX])
+                self.lastUpstreamId = int(self.header[self.UPSTREAM_ID_IDX])
                 return self.shmGPU.clone()
+            elif self.areData:
+                return self.readConsistent()
             else:
                 arr = np.copy(self.arr)
                 return arr
         else:##EXPERIMENTAL if not safe, return the raw shm memory
+            if self.areData:
+                self.lastFrameId = int(self.header[self.FRAME_ID_IDX])
+                self.lastUpstreamId = int(self.header[self.UPSTREAM_ID_IDX])
             if GPU and self.gpuDevice is not None:
                 return self.shmGPU
             else:
                 return self.arr
 
+
+    def readConsistent(self, out=None, region=None):
+        """
+        Copy the SHM into out (allocated if None), retrying until the copy was not
+        overlapped by a write. If region (a tuple of slices) is given, only that part
+        of the SHM is copied.
+        """
+        src = self.arr if region is None else self.arr[region]
+        if out is None:
+            out = np.empty_like(src)
+        for attempt in range(self.MAX_READ_RETRIES):
+            seq = self.header[self.SEQ_IDX]
+            #A write is in progress, let the writer finish
+            if seq & 1:
+                self.readRetries += 1
+                time.sleep(0)
+                continue
+            np.copyto(out, src)
+            frameId = int(self.header[self.FRAME_ID_IDX])
+            upstreamId = int(self.header[self.UPSTREAM_ID_IDX])
+            if self.header[self.SEQ_IDX] == seq:
+                self.lastFrameId, self.lastUpstreamId = frameId, upstreamId
+                return out
+            self.readRetries += 1
+        logging.log(level=logging.WARNING, msg=f"{self.name}: Could not get a consistent read after {self.MAX_READ_RETRIES} attempts")
+        return out
     
+    def readUpstream(self, upstreamId, out=None):
+        """
+        Copy the frame computed from upstream frame upstreamId into out (allocated 
+        if None). Returns None if the SHM does not hold that frame (yet, or anymore).
+        """
+        if out is None:
+            out = np.empty_like(self.arr)
+        for attempt in range(self.MAX_READ_RETRIES):
+            seq = self.header[self.SEQ_IDX]
+            if seq & 1:
+                self.readRetries += 1
+                time.sleep(0)
+                continue
+            if self.header[self.UPSTREAM_ID_IDX] != upstreamId:
+                return None
+            np.copyto(out, self.arr)
+            frameId = int(self.header[self.FRAME_ID_IDX])
+            if self.header[self.SEQ_IDX] == seq:
+                self.lastFrameId, self.lastUpstreamId = frameId, upstreamId
+                return out
+            self.readRetries += 1
+        return None
+
     def checkNew(self):
         
         if self.areData:
-            # metadata = np.copy(self.metadata)
-            if self.metadata[1] != self.lastReadTime:
+            if self.header[self.FRAME_ID_IDX] != self.lastSeenId:
                 self.markSeen()
                 return True
         else: #If we are just reading a meta data object directly
@@ -365,7 +914,8 @@ class ImageSHM:
         return False
     
     def markSeen(self):
-        self.lastReadTime = self.metadata[1]
+        if self.areData:
+            self.lastSeenId = self.header[self.FRAME_ID_IDX]
         return
 
     def updateMetadata(self, FULL_UPDATE=False):
@@ -382,151 +932,1193 @@ class ImageSHM:
         # np.copyto(self.metadata, metadata)
         return
     
+class RingImageSHM(ImageSHM):
+    """
+    An ImageSHM which keeps the last numSlots frames written to it instead of only 
+    the newest one.
+
+    Every write() is given a frame index (the write index, counting from 0 when the 
+    producer is created) and goes to slot index % numSlots. Each frame is written 
+    twice, to its slot and to a mirror slot numSlots further along, so the last K 
+    frames are always contiguous and readBatch() can return them as one view.
+
+    Each instance keeps its own cursor (the index of the next frame it will read), 
+    so any number of consumers can read the ring at their own pace. Frames that were 
+    overwritten before a consumer got to them are added to its droppedFrames count. 
+    One slot is kept free for the frame being written, so at most numSlots-1 frames 
+    are buffered.
+
+    read() and read_noblock() return the newest frame and the legacy metadata 
+    describes a single frame, so existing readers of the SHM keep working. The 
+    FrameInfo of every slot is kept in a small table after the frames.
+    """
+
+    def __init__(self, name, shape, dtype, numSlots, gpuDevice=None, consumer=True, notify=None) -> None:
+
+        if numSlots < 2:
+            raise ValueError(f"{name}: A RingImageSHM needs at least 2 slots")
+        if gpuDevice is not None:
+            logging.log(level=logging.WARNING, msg=f"{name}: RingImageSHM does not support GPU memory. Defaulting to CPU")
+        self.numSlots = int(numSlots)
+        self.frameShape = tuple(shape)
+        self.frameSize = int(np.prod(self.frameShape))*np.dtype(dtype).itemsize
+        #FrameInfo table, 8 byte aligned after the slots
+        framesBytes = 2*self.numSlots*self.frameSize
+        self.slotInfoOffset = -(-framesBytes//8)*8
+        self.extraBytes = self.slotInfoOffset - framesBytes + self.numSlots*len(FrameInfo._fields)*8
+        #Slots plus their mirrors
+        super().__init__(name, (2*self.numSlots,) + self.frameShape, dtype, consumer=consumer, notify=notify)
+        self.slotInfo = np.ndarray((self.numSlots, len(FrameInfo._fields)), dtype=np.int64, 
+                                   buffer=self.shm.buf, offset=self.slotInfoOffset)
+
+        self.droppedFrames = 0
+        self.frameIndex = -1
+        self.batchStart = -1
+        if consumer:
+            #Only frames written from now on are new to us
+            self.cursor = int(self.header[self.WRITE_INDEX_IDX])
+        else:
+            self.header[self.WRITE_INDEX_IDX] = 0
+            self.cursor = 0
+        return
+
+    def write(self, arr, upstreamId=None):
+
+        #The producer computed straight into the next slot
+        if self.writeBuffer is not None and arr is self.writeBuffer:
+            return self.commit(upstreamId)
+        #If you didn't write a numpy array
+        if not isinstance(arr, np.ndarray): 
+            return -1
+        #If you wrote the wrong shape
+        if arr.shape != self.frameShape:
+            logging.log(level=logging.ERROR, msg=f"{self.name}: Writing Wrong size array to SHM. Expecting {self.frameShape}, Got {arr.shape}")
+            return -1
+        index = int(self.header[self.WRITE_INDEX_IDX])
+        slot = index % self.numSlots
+        self.beginWrite()
+        np.copyto(self.arr[slot], arr)
+        np.copyto(self.arr[slot + self.numSlots], arr)
+        self.endWrite(upstreamId)
+
+        #Return Success
+        return 1
+
+    def acquire_write_buffer(self):
+        """
+        Return the slot the next frame goes into. It holds the oldest frame in the 
+        ring, not the newest.
+        """
+        self.beginWrite()
+        self.writeBuffer = self.arr[self.writeIndex() % self.numSlots]
+        return self.writeBuffer
+
+    def commit(self, upstreamId=None):
+        """
+        Publish the frame computed into the buffer from acquire_write_buffer().
+        """
+        if self.writeBuffer is None:
+            logging.log(level=logging.ERROR, msg=f"{self.name}: commit() called without acquire_write_buffer()")
+            return -1
+        slot = self.writeIndex() % self.numSlots
+        np.copyto(self.arr[slot + self.numSlots], self.arr[slot])
+        self.endWrite(upstreamId)
+        return 1
+
+    def registerProducer(self, shape):
+        return super().registerProducer(self.frameShape)
+
+    def stampFrame(self, upstreamId=None):
+        """
+        Stamp the frame being written, record its FrameInfo in its slot and advance 
+        the write index.
+        """
+        frameId = super().stampFrame(upstreamId)
+        index = self.writeIndex()
+        self.slotInfo[index % self.numSlots] = self.header[self.FRAME_ID_IDX:self.TIMESTAMP_IDX+1]
+        self.header[self.WRITE_INDEX_IDX] = index + 1
+        return frameId
+
+    def frameInfo(self, index=None):
+        """
+        Return the FrameInfo of frame index (the newest frame if None), or None if 
+        it is no longer in the ring.
+        """
+        if index is None:
+            index = self.writeIndex() - 1
+        info = FrameInfo(*(int(x) for x in self.slotInfo[index % self.numSlots]))
+        if index < 0 or not self.isValid(index):
+            return None
+        return info
+
+    def recordFrameInfo(self, index):
+        """
+        Set lastFrameId and lastUpstreamId from the slot table.
+        """
+        info = self.slotInfo[index % self.numSlots]
+        self.lastFrameId = int(info[0])
+        self.lastUpstreamId = int(info[1])
+        return
+
+    def writeIndex(self):
+        """
+        Number of frames committed to the ring, i.e. the index of the next frame.
+        """
+        return int(self.header[self.WRITE_INDEX_IDX])
+
+    def isValid(self, index):
+        """
+        Whether frame index is still intact, i.e. the producer has not started to 
+        overwrite its slot. Check after copying out of a view into the ring.
+        """
+        #Read the sequence first so a write finishing in between errs on the safe side
+        inProgress = int(self.header[self.SEQ_IDX]) & 1
+        started = int(self.header[self.WRITE_INDEX_IDX]) + inProgress
+        return 0 <= index and started - index <= self.numSlots
+
+    def oldestIndex(self, writeIndex):
+        """
+        Oldest frame which is safe to read when writeIndex frames have been written.
+        """
+        return max(writeIndex - self.numSlots + 1, 0)
+
+    def skipToLatest(self):
+        """
+        Move the cursor past every frame written so far, so readNext() waits for 
+        the next write.
+        """
+        self.cursor = self.writeIndex()
+        self.markSeen()
+        return
+
+    def readNext(self, timeout=None, SAFE=True):
+        """
+        Read the frame after the last one this instance read, blocking until it is 
+        written. If the producer has lapped this reader, skip to the oldest frame 
+        still in the ring and count the skipped frames in droppedFrames.
+
+        Returns None if timeout (seconds) elapses first. The index of the returned 
+        frame is stored in frameIndex.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        writeIndex = self.writeIndex()
+        #The producer was restarted
+        if writeIndex < self.cursor:
+            self.cursor = writeIndex
+        while writeIndex <= self.cursor:
+            if deadline is None:
+                self.hold()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.hold(timeout=remaining)
+            writeIndex = self.writeIndex()
+
+        for attempt in range(self.MAX_READ_RETRIES):
+            oldest = self.oldestIndex(writeIndex)
+            if self.cursor < oldest:
+                self.droppedFrames += oldest - self.cursor
+                self.cursor = oldest
+            frame = self.arr[self.cursor % self.numSlots]
+            self.recordFrameInfo(self.cursor)
+            if not SAFE:
+                break
+            frame = np.copy(frame)
+            if self.isValid(self.cursor):
+                break
+            #Lapped while copying, retry from the new oldest frame
+            self.readRetries += 1
+            writeIndex = self.writeIndex()
+
+        self.frameIndex = self.cursor
+        self.cursor += 1
+        self.markSeen()
+        return frame
+
+    def readBatch(self, numFrames=None):
+        """
+        Return consecutive frames, oldest first, as one zero-copy view of shape 
+        (K,) + shape, and move the cursor past the newest frame.
+
+        With numFrames=None the batch holds every frame written since this instance 
+        last read (older frames no longer in the ring are counted in droppedFrames). 
+        Otherwise it holds the last numFrames frames, at most numSlots-1. The index 
+        of the first frame is stored in batchStart. The view is only valid until the 
+        producer laps it, copy it or check isValid(batchStart) after using it.
+        """
+        writeIndex = self.writeIndex()
+        oldest = self.oldestIndex(writeIndex)
+        if numFrames is None:
+            start = min(self.cursor, writeIndex)
+            if start < oldest:
+                self.droppedFrames += oldest - start
+                start = oldest
+        else:
+            start = max(writeIndex - numFrames, oldest)
+        slot = start % self.numSlots
+
+        self.batchStart = start
+        self.cursor = writeIndex
+        self.markSeen()
+        return self.arr[slot:slot + writeIndex - start]
+
+    def read_noblock(self, SAFE=True, GPU=False):
+
+        #Mark that we have seen the shm before
+        self.markSeen()
+        for attempt in range(self.MAX_READ_RETRIES):
+            index = max(self.writeIndex() - 1, 0)
+            frame = self.arr[index % self.numSlots]
+            self.recordFrameInfo(index)
+            if not SAFE:
+                return frame
+            frame = np.copy(frame)
+            if self.isValid(index):
+                return frame
+            self.readRetries += 1
+        logging.log(level=logging.WARNING, msg=f"{self.name}: Could not get a consistent read after {self.MAX_READ_RETRIES} attempts")
+        return frame
+
+    def readUpstream(self, upstreamId, out=None):
+        """
+        Copy the newest frame in the ring computed from upstream frame upstreamId 
+        into out (allocated if None). Returns None if the ring does not hold it.
+        """
+        if out is None:
+            out = np.empty(self.frameShape, dtype=self.arr.dtype)
+        writeIndex = self.writeIndex()
+        for index in range(writeIndex - 1, self.oldestIndex(writeIndex) - 1, -1):
+            slot = index % self.numSlots
+            if self.slotInfo[slot, 1] == upstreamId:
+                np.copyto(out, self.arr[slot])
+                if not self.isValid(index) or self.slotInfo[slot, 1] != upstreamId:
+                    return None
+                self.recordFrameInfo(index)
+                return out
+        return None
+
+    def updateMetadata(self, FULL_UPDATE=False):
+
+        #Describe a single frame, so readers that don't know about the ring still work
+        self.metadata[0] = self.count
+        self.metadata[1] = self.lastWriteTime
+        if FULL_UPDATE:
+            self.metadata[2] = self.frameSize
+            self.metadata[3] = dtype_to_float(self.arr.dtype)
+            for i in range(self.LEGACY_METADATA_SIZE - 4):
+                self.metadata[i+4] = self.frameShape[i] if i < len(self.frameShape) else 0
+        return
+
+#Result of ImageSHMGroup.snapshot()
+GroupSnapshot = namedtuple("GroupSnapshot", ["frames", "upstreamId", "consistent"])
+
+class ImageSHMGroup:
+    """
+    Reads several ImageSHMs as one snapshot of the same loop iteration.
+
+    The frames of a snapshot all carry the same upstream frame id, i.e. they were 
+    all computed from the same WFS frame. Streams which have not produced that frame 
+    yet are waited for (up to timeout), RingImageSHMs are searched for it, and if a 
+    single slot SHM has already moved past it the snapshot moves on to the newest 
+    upstream id. If no matching set is found before the timeout the newest frames 
+    are returned with consistent False.
+
+    Frames are copied into buffers owned by the group, so a snapshot does not 
+    allocate unless copy is True. SHMs that are not stamped per loop iteration 
+    (e.g. cmat, refSlopes) should be read on their own.
+    """
+
+    def __init__(self, shms, timeout=1e-3) -> None:
+        """
+        Parameters
+        ----------
+        shms : list of ImageSHM
+            The SHMs to read together. read() blocks on the first one.
+        timeout : float, optional
+            Default time (seconds) to wait for the streams to line up. Default 1 ms.
+        """
+        self.shms = list(shms)
+        self.timeout = timeout
+        self.frames = [np.empty(shm.frameShape if isinstance(shm, RingImageSHM) else shm.arr.shape, 
+                                dtype=shm.arr.dtype) for shm in self.shms]
+        self.numSnapshots = 0
+        self.inconsistentSnapshots = 0
+        return
+
+    def upstreamIds(self):
+        """
+        Upstream id of the newest frame of each SHM, -1 for an empty ring.
+        """
+        ids = []
+        for shm in self.shms:
+            info = shm.frameInfo()
+            ids.append(-1 if info is None else info.upstreamId)
+        return ids
+
+    def snapshot(self, upstreamId=None, timeout=None, copy=True):
+        """
+        Read every SHM at upstream frame id upstreamId (the newest one any of them 
+        has reached if None).
+
+        Parameters
+        ----------
+        upstreamId : int, optional
+            Upstream frame id to read.
+        timeout : float, optional
+            Time (seconds) to wait for the streams to line up, defaults to self.timeout.
+        copy : bool, optional
+            Return copies of the frames rather than the group's buffers, which the 
+            next snapshot overwrites. Default True.
+
+        Returns
+        -------
+        GroupSnapshot
+            (frames, upstreamId, consistent), upstreamId being the id read.
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        target = max(self.upstreamIds()) if upstreamId is None else upstreamId
+        done = [False]*len(self.shms)
+        consistent = False
+        while True:
+            for i, shm in enumerate(self.shms):
+                if not done[i]:
+                    done[i] = shm.readUpstream(target, out=self.frames[i]) is not None
+            if all(done):
+                consistent = True
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            ids = self.upstreamIds()
+            missing = [i for i in range(len(self.shms)) if not done[i]]
+            #A stream no longer holds the target, start again from the newest frame
+            if any(ids[i] > target for i in missing):
+                target = max(ids)
+                done = [False]*len(self.shms)
+                continue
+            #Otherwise wait for a stream which is behind
+            self.shms[missing[0]].hold(timeout=remaining)
+
+        if not consistent:
+            self.inconsistentSnapshots += 1
+            for i, shm in enumerate(self.shms):
+                if not done[i]:
+                    np.copyto(self.frames[i], shm.read_noblock())
+        self.numSnapshots += 1
+        frames = [np.copy(f) for f in self.frames] if copy else self.frames
+        return GroupSnapshot(frames, target, consistent)
+
+    def read(self, timeout=None, copy=True):
+        """
+        Block until the first SHM is written, then snapshot() the group at its 
+        upstream frame id.
+        """
+        first = self.shms[0]
+        first.hold()
+        info = first.frameInfo()
+        return self.snapshot(upstreamId=None if info is None else info.upstreamId, 
+                             timeout=timeout, copy=copy)
+
+def unlink_shm(name):
+    """
+    Unlink the shared memory segment name, if it exists.
+    """
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return False
+    shm.close()
+    shm.unlink()
+    return True
+
 def clear_shms(names):
     
+    registry = get_registry()
     for n in names:
-        shm = ImageSHM(n,(1,),np.uint8)
-        shm.shm.unlink()
-        shm = ImageSHM(n+"_meta",(1,),np.uint8)
-        shm.shm.unlink()
-        try:
-            shm = ImageSHM(n+"_gpu_handle",(1,),np.uint8)
-            shm.shm.unlink()
-        except:
-            pass
+        for suffix in ["", "_meta", "_gpu_handle"]:
+            unlink_shm(n + suffix)
+        registry.unregister(n)
 
+def list_shms():
+    """
+    Every registered ImageSHM, as dicts with name, dtype, shape, numSlots, pid, 
+    created and lastWrite. Entries whose producer has exited are included, see 
+    clear_stale_shms().
+    """
+    return get_registry().list()
+
+def clear_stale_shms():
+    """
+    Unlink every registered ImageSHM whose producer process is no longer running. 
+    Returns the names of the cleared SHMs.
+    """
+    stale = [entry["name"] for entry in list_shms() if not psutil.pid_exists(entry["pid"])]
+    clear_shms(stale)
+    return stale
+
+
+#Printed by a Listener, with its TCP port or unix socket path, once it accepts connections
+READY_MESSAGE = "PYRTC_READY"
+#Unix sockets are only available on posix systems, TCP is used elsewhere
+UNIX_SOCKETS_AVAILABLE = hasattr(socket, "AF_UNIX")
+
+def unix_socket_path(name):
+    """
+    Path of the unix socket a component called name listens on.
+    """
+    return os.path.join(tempfile.gettempdir(), f"pyRTC_{name}.sock")
+
+#RPC messages between hardwareLauncher and Listener are framed as a length prefix, a
+#compact JSON header, then the raw bytes of every numpy array in the message, in the
+#order the header refers to them
+FRAME_PREFIX = struct.Struct("!Q")
+#Send the frame in one call below this size, to avoid small writes
+FRAME_JOIN_SIZE = 65536
+
+def encode_message(message):
+    """
+    Split message into a JSON serialisable header, in which numpy arrays are replaced 
+    by {"__ndarray__": index, "dtype", "shape"} placeholders, and the list of arrays.
+    """
+    arrays = []
+    def encode(value):
+        if isinstance(value, np.ndarray):
+            if value.dtype.hasobject:
+                return encode(value.tolist())
+            arrays.append(np.ascontiguousarray(value))
+            return {"__ndarray__": len(arrays) - 1, "dtype": value.dtype.str, "shape": list(value.shape)}
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, dict):
+            return {k: encode(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [encode(v) for v in value]
+        return value
+    return encode(message), arrays
+
+def send_message(sock, message):
+    """
+    Send message (a dict which may hold numpy arrays) as one frame.
+    """
+    header, arrays = encode_message(message)
+    headerBytes = json.dumps(header, separators=(",", ":")).encode()
+    buffers = [FRAME_PREFIX.pack(len(headerBytes)) + headerBytes]
+    buffers += [memoryview(arr.reshape(-1).view(np.uint8)) for arr in arrays]
+    if sum(len(b) for b in buffers) < FRAME_JOIN_SIZE:
+        sock.sendall(b"".join(buffers))
+    else:
+        for b in buffers:
+            sock.sendall(b)
+    return
+
+def recv_exact(sock, numBytes):
+    """
+    Receive exactly numBytes bytes into a new bytearray.
+    """
+    buf = bytearray(numBytes)
+    view = memoryview(buf)
+    received = 0
+    while received < numBytes:
+        n = sock.recv_into(view[received:], numBytes - received)
+        if n == 0:
+            raise ConnectionError("Socket closed mid message")
+        received += n
+    return buf
+
+def recv_message(sock):
+    """
+    Receive one frame sent by send_message. Arrays are received straight into their 
+    own (writable) buffers.
+    """
+    (headerLength,) = FRAME_PREFIX.unpack(recv_exact(sock, FRAME_PREFIX.size))
+    header = json.loads(recv_exact(sock, headerLength))
+    #Arrays follow in the order encode_message found them, which a walk in the same order reproduces
+    def decode(value):
+        if isinstance(value, dict):
+            if "__ndarray__" in value:
+                dtype = np.dtype(value["dtype"])
+                shape = tuple(value["shape"])
+                data = recv_exact(sock, int(np.prod(shape, dtype=np.int64))*dtype.itemsize)
+                return np.frombuffer(data, dtype=dtype).reshape(shape)
+            return {k: decode(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [decode(v) for v in value]
+        return value
+    return decode(header)
+
+class RemoteError(Exception):
+    """
+    Raised by hardwareLauncher.call when the component failed to run the function 
+    (or did not answer in time).
+    """
+    pass
 
 class hardwareLauncher:
+    """
+    Launches a component in its own process and controls it over a socket (see 
+    Listener).
+
+    Every request is tagged with an id and matched to its reply by a receiver 
+    thread, so any number of requests can be in flight. getPropertyAsync, 
+    setPropertyAsync and runAsync return concurrent.futures.Future objects 
+    resolving to what getProperty, setProperty and run would return (-1 on 
+    failure); in asyncio code await asyncio.wrap_future(future). run only 
+    reports whether the function ran (1 or -1), call returns what it returned 
+    and raises RemoteError if it failed. The component 
+    applies requests in the order they were sent, so a batch of requests can be 
+    sent back to back and waited on together, costing one round trip.
+
+    Long functions (calibrations, dark frames, ...) can instead be started as a 
+    job with startJob, which returns a job id straight away. The job's progress 
+    can then be polled with jobStatus, waited on with waitJob or stopped with 
+    cancelJob, while the component keeps serving other requests.
+    """
 
-    def __init__(self, hardwareFile, configFile, port, timeout=None) -> None:
+    def __init__(self, hardwareFile, configFile, port, timeout=None, socketPath=None) -> None:
+        """
+        Parameters
+        ----------
+        hardwareFile : str
+            Script which runs the component (calling launchComponent).
+        configFile : str
+            Path to the pyRTC config.
+        port : int
+            TCP port for the component to listen on.
+        timeout : float, optional
+            Seconds to wait for each reply, None to wait forever.
+        socketPath : str, optional
+            Listen on this unix socket instead of TCP. A component can also pick 
+            a unix socket itself with rpcTransport: unix in its config.
+        """
         self.hardwareFile = hardwareFile
         #self.command = ["python", hardwareFile, "-c", f"{configFile}", "-p", f"{port}"]
         # In case python is aliased to a different version
-        self.command = [sys.executable, hardwareFile, "-c", f"{configFile}", "-p", f"{port}"]
+        #Unbuffered, so what the component prints is forwarded as it happens (see readOutput)
+        self.command = [sys.executable, "-u", hardwareFile, "-c", f"{configFile}", "-p", f"{port}"]
+        if socketPath is not None:
+            self.command += ["-s", socketPath]
         self.running = False
         # Client configuration
         self.host = '127.0.0.1'  # localhost
         self.port = port
+        #Set from the ready message if the process listens on a unix socket
+        self.socketPath = None
         self.timeout = timeout
+        self.requestId = 0
+        self.pendingReplies = {}
+        self.sendLock = threading.Lock()
 
         return
 
-    def launch(self, max_attempts=15):
+    def launch(self, max_attempts=15, readyTimeout=30.0):
+            """
+            Start the process and connect to it once its Listener reports it is 
+            ready (bound and accepting), which is also once the component has 
+            created its SHMs. Returns True on success.
+
+            Parameters
+            ----------
+            max_attempts : int, optional
+                Connection attempts once the process is ready. Default 15.
+            readyTimeout : float, optional
+                Seconds to wait for the process to become ready. Default 30.
+            """
             if not self.running:
                 print(f"Launching Process: {self.hardwareFile}")
                 # remove stdin=PIPE to avoid hanging if process is forcefully stopped
                 self.process = Popen(self.command, stdout=PIPE, text=True, bufsize=1) 
                 self.running = True
-
-                # Create a socket object
-                self.processSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                print(f"Waiting for Process at {self.host}:{self.port}")
-                
-                connected = False
-                restTime = 2
-                attempts = 0
-
-                while not connected and attempts < max_attempts:
-                    # 1. Fail Fast: Check if the process died prematurely
+                self.ready = threading.Event()
+                self.outputLines = deque(maxlen=100)
+                self.outputThread = threading.Thread(target=self.readOutput, daemon=True)
+                self.outputThread.start()
+
+                # 1. Wait for the ready message, failing fast if the process dies
+                deadline = time.monotonic() + readyTimeout
+                while not self.ready.wait(timeout=0.05):
                     if self.process.poll() is not None:
                         print(f"Process terminated unexpectedly with return code {self.process.returncode}.")
-                        self.running = False
-                        self.processSocket.close()
-                        return False
-                    
-                    time.sleep(restTime)
+                        return self.abortLaunch()
+                    if time.monotonic() > deadline:
+                        print(f"Process was not ready after {readyTimeout} seconds. Shutting down.")
+                        return self.abortLaunch()
+
+                address = self.socketPath if self.socketPath is not None else f"{self.host}:{self.port}"
+                print(f"Connecting to Process at {address}")
+                for attempt in range(max_attempts):
                     try:
                         # Connect to the server
-                        self.processSocket.connect((self.host, self.port))
-                        connected = True
-                    except Exception as e:
-                        attempts += 1
-                        print(f"Connection failed: {e}")
-                        print(f"Retrying in {restTime} seconds... (Attempt {attempts}/{max_attempts})")
-
-                # 2. Timeout Fallback: If we hit max attempts without connecting
-                if not connected:
+                        if self.socketPath is not None:
+                            self.processSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                            self.processSocket.connect(self.socketPath)
+                        else:
+                            self.processSocket = socket.create_connection((self.host, self.port))
+                        break
+                    except OSError as e:
+                        print(f"Connection failed: {e} (Attempt {attempt+1}/{max_attempts})")
+                        time.sleep(0.1)
+                else:
                     print("Failed to connect to the process after maximum attempts. Shutting down.")
-                    self.running = False
-                    self.processSocket.close()
-                    
-                    # Terminate the unresponsive process if it is still alive
-                    if self.process.poll() is None:
-                        self.process.terminate()
-                    return False
-
-                # Set timeout if provided
-                if isinstance(self.timeout, float) or isinstance(self.timeout, int):
-                    self.processSocket.settimeout(self.timeout)
+                    return self.abortLaunch()
+
+                self.startReceiver()
 
                 print("Connected")
                 return True
             
             return True
+
+    def readOutput(self):
+        """
+        Read the process' stdout until it exits, so it never blocks on a full pipe. 
+        The ready message sets ready (and the port the Listener is bound to). Other 
+        lines are kept in outputLines until then, and printed (prefixed with the 
+        component's file name) once the process is ready.
+        """
+        for line in self.process.stdout:
+            if line.startswith(READY_MESSAGE):
+                address = line[len(READY_MESSAGE):].strip()
+                if address.isdigit():
+                    self.port = int(address)
+                else:
+                    self.socketPath = address
+                for outputLine in self.outputLines:
+                    self.forwardOutput(outputLine)
+                self.ready.set()
+            elif self.ready.is_set():
+                self.forwardOutput(line.rstrip())
+            else:
+                self.outputLines.append(line.rstrip())
+        return
+
+    def forwardOutput(self, line):
+        print(f"[{os.path.splitext(os.path.basename(self.hardwareFile))[0]}] {line}", flush=True)
+        return
+
+    def abortLaunch(self):
+        self.running = False
+        #Once ready, the output has already been forwarded
+        if len(self.outputLines) > 0 and not self.ready.is_set():
+            print(f"Last output of {self.hardwareFile}:")
+            print("\n".join(self.outputLines))
+        # Terminate the unresponsive process if it is still alive
+        if self.process.poll() is None:
+            self.process.terminate()
+        return False
     
+    def startReceiver(self):
+        """
+        Start the thread which hands replies from the connected process to the 
+        requests waiting for them.
+        """
+        if self.processSocket.family == socket.AF_INET:
+            self.processSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.receiver = threading.Thread(target=self.receive, daemon=True)
+        self.receiver.start()
+        return
+
+    def receive(self):
+        while True:
+            try:
+                reply = recv_message(self.processSocket)
+            except (OSError, ValueError):
+                break
+            requestId = reply.get("id") if isinstance(reply, dict) else None
+            future = self.pendingReplies.pop(requestId, None)
+            if future is not None:
+                self.resolve(future, reply)
+        #The connection is gone, fail every request still waiting
+        with self.sendLock:
+            pending, self.pendingReplies = self.pendingReplies, {}
+        for future in pending.values():
+            self.resolve(future, None)
+        return
+
+    def resolve(self, future, reply):
+        """
+        Complete a Future from submit() with its reply, None if there is none.
+        """
+        try:
+            future.set_result(future.unpack(reply))
+        except RemoteError as e:
+            future.set_exception(e)
+        return
+
+    def submit(self, message, unpack=None):
+        """
+        Send a request without waiting for the reply. Returns a Future for the 
+        value writeAndRead would return, or unpack(reply) if given.
+        """
+        future = Future()
+        future.unpack = self.replyValue if unpack is None else unpack
+        if not self.running:
+            self.resolve(future, None)
+            return future
+        with self.sendLock:
+            self.requestId += 1
+            message["id"] = self.requestId
+            #So a caller giving up on the reply can forget() it
+            future.requestId, future.launcher = self.requestId, self
+            self.pendingReplies[self.requestId] = future
+            try:
+                send_message(self.processSocket, message)
+            except OSError:
+                self.pendingReplies.pop(self.requestId, None)
+                self.resolve(future, None)
+        return future
+
+    def result(self, future, timeout=None):
+        """
+        Wait for a Future from submit(), -1 if it times out. Waits up to timeout 
+        seconds, the launcher's timeout if None.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self.forget(future)
+            return -1
+
+    def forget(self, future):
+        """
+        Stop waiting for the reply of a Future from submit(), e.g. after a timeout, 
+        so it is not kept in pendingReplies. A late reply is dropped.
+        """
+        with self.sendLock:
+            self.pendingReplies.pop(getattr(future, "requestId", None), None)
+        return
+
     def shutdown(self):
         message = {"type": "shutdown"}
         return self.writeAndRead(message)
 
     def getProperty(self, property):
-        message = {"type": "get", "property": property}
-        return self.writeAndRead(message)
+        return self.result(self.getPropertyAsync(property))
     
     def setProperty(self, property, value):
+        return self.result(self.setPropertyAsync(property, value))
+
+    def run(self, function, *args, timeout = None):
+        return self.result(self.runAsync(function, *args), timeout=timeout)
+
+    def call(self, function, *args, timeout = None):
+        """
+        Run function(*args) in the component and return what it returned. Raises 
+        RemoteError if it could not be run or timed out.
+        """
+        future = self.callAsync(function, *args)
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self.forget(future)
+            raise RemoteError(f"{function} timed out")
+
+    def getPropertyAsync(self, property):
+        message = {"type": "get", "property": property}
+        return self.submit(message)
+
+    def setPropertyAsync(self, property, value):
         message = {"type": "set", "property": property, "value": value}
+        return self.submit(message)
+
+    def runAsync(self, function, *args):
+        message = {"type": "run", "function": function, "args": list(args)}
+        return self.submit(message)
+
+    def callAsync(self, function, *args):
+        message = {"type": "run", "function": function, "args": list(args)}
+        return self.submit(message, unpack=self.returnValue)
+
+    def startJob(self, function, *args):
+        """
+        Start function(*args) on its own thread in the process. Returns the job id, 
+        -1 on failure.
+        """
+        message = {"type": "start_job", "function": function, "args": list(args)}
         return self.writeAndRead(message)
 
-    def run(self, function, *args, timeout = None):
-        message = {"type": "run", "function": function}
-        for i, arg in enumerate(args):
-            message[f"arg_{i+1}"] = arg
+    def jobStatus(self, jobId):
+        """
+        Returns a dict with the job's state ("running", "done", "failed" or 
+        "cancelled"), progress (0 to 1), return value and error message, -1 on 
+        failure. The component forgets the job once it has returned its final 
+        status, later calls return -1.
+        """
+        message = {"type": "job_status", "job": jobId}
         return self.writeAndRead(message)
 
-    def writeAndRead(self,message):
-        if self.running:
-            self.write(message)
-            reply = self.read()
-            #If there are issues with the reply format
-            if type(reply) != type(dict()) or "status" not in reply.keys():
-                return -1
-            #If there was an issue on the process end
-            if reply["status"] == 'BAD':
+    def cancelJob(self, jobId):
+        """
+        Ask a job to stop the next time it reports its progress. Returns its status.
+        """
+        message = {"type": "cancel_job", "job": jobId}
+        return self.writeAndRead(message)
+
+    def waitJob(self, jobId, timeout=None, pollInterval=0.05, callback=None):
+        """
+        Poll a job until it is no longer running, or for at most timeout seconds.
+
+        Parameters
+        ----------
+        jobId : int
+            Id returned by startJob.
+        timeout : float, optional
+            Seconds to wait, None to wait forever.
+        pollInterval : float, optional
+            Seconds between polls. Default 0.05.
+        callback : callable, optional
+            Called with every status polled, e.g. to update a progress bar.
+
+        Returns
+        -------
+        dict or int
+            The last status polled, -1 on failure.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            status = self.jobStatus(jobId)
+            if not isinstance(status, dict):
                 return -1
-            #If our request went through
-            if reply["status"] == 'OK':
-                #If the reply came with a property to return
-                if "property" in reply.keys():
-                    return reply["property"]
-                #Otherwise just return OK
-                else:
-                    return 1
+            if callback is not None:
+                callback(status)
+            if status["state"] != Job.RUNNING:
+                return status
+            if deadline is not None and time.monotonic() >= deadline:
+                return status
+            time.sleep(pollInterval)
+
+    def batch(self):
+        """
+        Collect getProperty/setProperty/run/call calls and send them as one request when 
+        the with block ends. The process applies them in order, the results are in 
+        the batch's results list (in call order) afterwards:
+
+            with wfc.batch() as b:
+                b.setProperty("gain", 0.3)
+                b.run("loadIM")
+                b.getProperty("gain")
+            gain = b.results[2]
+        """
+        return RequestBatch(self)
+
+    def submitBatch(self, requests, unpackers=None):
+        """
+        Send a list of request messages as one batch request. Returns a Future for 
+        the list of their results, each one given by replyValue or its entry of 
+        unpackers. A RemoteError raised by an unpacker is returned as the result.
+        """
+        requests = list(requests)
+        if unpackers is None:
+            unpackers = [self.replyValue]*len(requests)
+        def unpackResult(unpack, reply):
+            try:
+                return unpack(reply)
+            except RemoteError as e:
+                return e
+        def unpack(reply):
+            replies = reply.get("replies") if isinstance(reply, dict) and reply.get("status") == "OK" else None
+            if not isinstance(replies, list) or len(replies) != len(requests):
+                replies = [None]*len(requests)
+            return [unpackResult(u, r) for u, r in zip(unpackers, replies)]
+        return self.submit({"type": "batch", "requests": requests}, unpack=unpack)
+
+    def writeAndRead(self,message):
+        return self.result(self.submit(message))
+
+    def replyValue(self, reply):
+        #If there are issues with the reply format
+        if type(reply) != type(dict()) or "status" not in reply.keys():
+            return -1
+        #If there was an issue on the process end
+        if reply["status"] == 'BAD':
+            return -1
+        #If our request went through
+        if reply["status"] == 'OK':
+            #If the reply came with a property to return
+            if "property" in reply.keys():
+                return reply["property"]
+            #Otherwise just return OK
+            else:
+                return 1
         #default is a fail
         return -1
 
-    def write(self, message):
-        message = json.dumps(message)
-        self.processSocket.send(message.encode())
+    def returnValue(self, reply):
+        """
+        The return value of the function a "run" reply is for. Raises RemoteError 
+        if it failed.
+        """
+        if not isinstance(reply, dict):
+            raise RemoteError("No reply from the component")
+        if reply.get("status") != 'OK' or "return" not in reply:
+            raise RemoteError(reply.get("error", "The component could not run the function"))
+        return reply["return"]
+
+class RequestBatch:
+    """
+    getProperty/setProperty/run/call calls collected by hardwareLauncher.batch(). Each 
+    call returns the index its result will have in results.
+    """
+
+    def __init__(self, launcher) -> None:
+        self.launcher = launcher
+        self.requests = []
+        #Request index to the unpacker of its reply, for call
+        self.unpackers = {}
+        self.results = None
         return
-    
-    def read(self):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        #Nothing is sent if the block raised
+        if excType is None:
+            self.results = self.send()
+        return False
+
+    def add(self, message):
+        self.requests.append(message)
+        return len(self.requests) - 1
+
+    def getProperty(self, property):
+        return self.add({"type": "get", "property": property})
+
+    def setProperty(self, property, value):
+        return self.add({"type": "set", "property": property, "value": value})
+
+    def run(self, function, *args):
+        return self.add({"type": "run", "function": function, "args": list(args)})
+
+    def call(self, function, *args):
+        """
+        As run, but the result is what the function returned, or the RemoteError 
+        if it failed (see hardwareLauncher.call).
+        """
+        index = self.add({"type": "run", "function": function, "args": list(args)})
+        self.unpackers[index] = self.launcher.returnValue
+        return index
+
+    def send(self):
+        """
+        Send the collected calls and wait for their results.
+        """
+        if len(self.requests) == 0:
+            return []
+        unpackers = [self.launcher.replyValue]*len(self.requests)
+        for index, unpack in self.unpackers.items():
+            unpackers[index] = unpack
+        results = self.launcher.result(self.launcher.submitBatch(self.requests, unpackers))
+        return results if isinstance(results, list) else [-1]*len(self.requests)
+
+#Components whose SHMs a component opens when it starts, by config key
+LAUNCH_DEPENDENCIES = {
+    "slopes": ["wfs"],
+    "loop": ["wfs", "wfc", "slopes"],
+    "tel": ["wfs", "wfc", "slopes", "loop"],
+}
+
+def launch_all(launchers, dependencies=None):
+    """
+    Launch several components in parallel, each one as soon as the components it 
+    depends on are ready, so start up takes as long as the slowest chain of 
+    dependencies rather than the sum of every launch.
+
+    Parameters
+    ----------
+    launchers : dict
+        Config key (e.g. "wfs") to the hardwareLauncher for it.
+    dependencies : dict, optional
+        Config key to the keys it depends on. Defaults to LAUNCH_DEPENDENCIES. 
+        Dependencies which are not in launchers are assumed to be running already.
+
+    Returns
+    -------
+    dict
+        Config key to whether it launched. Components whose dependencies failed 
+        are not launched.
+    """
+    if dependencies is None:
+        dependencies = LAUNCH_DEPENDENCIES
+    required = {name: [d for d in dependencies.get(name, []) if d in launchers] for name in launchers}
+    #Refuse dependency cycles, they would never launch
+    resolved = set()
+    while len(resolved) < len(required):
+        free = [name for name in required if name not in resolved and set(required[name]) <= resolved]
+        if len(free) == 0:
+            raise ValueError(f"Dependency cycle between {sorted(set(required) - resolved)}")
+        resolved.update(free)
+
+    finished = {name: threading.Event() for name in launchers}
+    results = {}
+    def launchWhenReady(name):
+        for d in required[name]:
+            finished[d].wait()
+        if all(results[d] for d in required[name]):
+            results[name] = launchers[name].launch()
+        else:
+            print(f"Not launching {name}, a component it depends on failed to launch")
+            results[name] = False
+        finished[name].set()
+
+    threads = [threading.Thread(target=launchWhenReady, args=(name,)) for name in launchers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def wait_all(futures, timeout=None):
+    """
+    Wait for a batch of requests (Futures from hardwareLauncher) sent to one or 
+    more components. Returns their results in order, -1 for those not done within 
+    timeout.
+    """
+    futures = list(futures)
+    wait_futures(futures, timeout=timeout)
+    for f in futures:
+        if not f.done() and hasattr(f, "launcher"):
+            f.launcher.forget(f)
+    return [f.result() if f.done() else -1 for f in futures]
+
+class JobCancelled(Exception):
+    """
+    Raised by report_progress inside a job which has been asked to cancel.
+    """
+    pass
+
+_jobContext = threading.local()
+
+def current_job():
+    """
+    The Job running in this thread, None outside of a job.
+    """
+    return getattr(_jobContext, "job", None)
+
+def report_progress(fraction):
+    """
+    Report the fraction (0 to 1) of the job running in this thread which is done, 
+    raising JobCancelled if the job has been asked to cancel. Does nothing outside 
+    of a job, so long routines can call it however they are run.
+    """
+    job = current_job()
+    if job is not None:
+        job.progress = min(max(float(fraction), 0.0), 1.0)
+        if job.cancelRequested.is_set():
+            raise JobCancelled(job.function)
+    return
+
+class Job:
+    """
+    A component function run on its own thread by a Listener (a start_job 
+    request). The function reports its progress and notices cancellation through 
+    report_progress.
+    """
+
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, jobId, function, args, name="") -> None:
+        self.id = jobId
+        self.function = function.__name__
+        self.name = name
+        self.state = self.RUNNING
+        self.progress = 0.0
+        self.result = None
+        self.error = ""
+        self.cancelRequested = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(function, args), daemon=True)
+        return
+
+    def start(self):
+        self.thread.start()
+        return
+
+    def run(self, function, args):
+        _jobContext.job = self
         try:
-            reply = self.processSocket.recv(4096).decode()
-            return json.loads(reply)
-        except socket.timeout:
-            return -1
-        
-    
+            result = function(*args)
+            try:
+                json.dumps(encode_message(result)[0])
+            except TypeError:
+                #Only sent back if it can be
+                result = None
+            self.result = result
+            self.progress = 1.0
+            self.state = self.DONE
+        except JobCancelled:
+            self.state = self.CANCELLED
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            logging.log(level=logging.ERROR, msg=f"{self.name}: job {self.id} ({self.function}) failed, {self.error}")
+            self.state = self.FAILED
+        finally:
+            _jobContext.job = None
+        return
+
+    def cancel(self):
+        """
+        Ask the job to stop at its next report_progress call.
+        """
+        self.cancelRequested.set()
+        return
+
+    def status(self):
+        return {"id": self.id, "function": self.function, "state": self.state, 
+                "progress": self.progress, "return": self.result, "error": self.error}
 
 class Listener:
+    """
+    Serves a component's properties and functions to the hardwareLauncher which 
+    spawned it.
+
+    Requests are applied in order by a worker thread, so a function taking many 
+    frames does not stop the listener from reading. get requests are answered 
+    straight away while a run request is executing (e.g. to poll status during a 
+    long measurement), unless earlier requests are still waiting, so a get always 
+    sees the sets sent before it. Replies carry the id of their request.
+
+    A start_job request runs a function on its own thread (a Job) and replies 
+    straight away with the job's id, which job_status and cancel_job requests 
+    then refer to. Those are always answered straight away. A job is forgotten 
+    once a reply has carried its final status, and at most MAX_FINISHED_JOBS 
+    finished jobs are kept waiting for that.
+    """
 
-    def __init__(self, hardware, port) -> None:
+    MAX_FINISHED_JOBS = 100
+
+    def __init__(self, hardware, port, socketPath=None) -> None:
+        """
+        Parameters
+        ----------
+        hardware : object
+            The component to serve.
+        port : int
+            TCP port to listen on (the next free one, see bind_socket).
+        socketPath : str, optional
+            Listen on this unix socket instead, where available.
+        """
         self.hardware = hardware
         self.running = True
         self.keyCharacter = '$'
         self.host = '127.0.0.1'  # localhost
         self.port = port
-
-        server_socket = bind_socket(self.host, self.port)
+        self.socketPath = socketPath if UNIX_SOCKETS_AVAILABLE else None
+
+        if self.socketPath is not None:
+            #Left over from a process which did not shut down cleanly
+            if os.path.exists(self.socketPath):
+                os.unlink(self.socketPath)
+            server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server_socket.bind(self.socketPath)
+        else:
+            server_socket = bind_socket(self.host, self.port)
 
         # # Create a socket object
         # server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -539,78 +2131,222 @@ class Listener:
         # Listen for incoming connections
         server_socket.listen()
         print(f"{hardware.name}: Awaiting RTC connection")
+        #Tell the launcher we are ready, and where (bind_socket may have moved the port)
+        if self.socketPath is not None:
+            print(f"{READY_MESSAGE} {self.socketPath}", flush=True)
+        else:
+            self.port = server_socket.getsockname()[1]
+            print(f"{READY_MESSAGE} {self.port}", flush=True)
         #Connect to the RTC process that spawned you
         self.RTCsocket, self.RTCaddress = server_socket.accept()
+        server_socket.close()
+        if self.socketPath is None:
+            self.RTCsocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         self.OKMessage = {"status": "OK"}
         self.BadMessage = {"status": "BAD"}
 
+        self.sendLock = threading.Lock()
+        self.requests = deque()
+        self.requestsChanged = threading.Condition()
+        self.currentRequestType = None
+        self.jobs = {}
+        self.lastJobId = 0
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+
         return
     
     def listen(self):
 
         #Read request from the RTC
         request = self.read()
-        if "type" not in request:
-            self.write(self.BadMessage)
+        if not isinstance(request, dict) or "type" not in request:
+            self.reply(request, self.BadMessage)
+            return
 
+        with self.requestsChanged:
+            answerNow = request["type"] == "get" and len(self.requests) == 0 \
+                        and self.currentRequestType in (None, "run")
+            answerNow = answerNow or request["type"] in ("job_status", "cancel_job")
+            if not answerNow and request["type"] != "shutdown":
+                self.requests.append(request)
+                self.requestsChanged.notify_all()
+                return
+            #Shut down once everything sent before has been applied
+            while request["type"] == "shutdown" and (self.requests or self.currentRequestType is not None):
+                self.requestsChanged.wait()
+        self.handle(request)
+        return
+
+    def work(self):
+        while True:
+            with self.requestsChanged:
+                while not self.requests:
+                    self.requestsChanged.wait()
+                request = self.requests.popleft()
+                self.currentRequestType = request["type"]
+            self.handle(request)
+            with self.requestsChanged:
+                self.currentRequestType = None
+                self.requestsChanged.notify_all()
+
+    def handle(self, request):
+        message = self.execute(request)
+        try:
+            self.reply(request, message)
+        except TypeError:
+            #Something in the reply (e.g. a property or return value) cannot be sent
+            print(f"{self.hardware.name}: Cannot send the reply to a {request['type']} request")
+            self.reply(request, self.unsendableReply(request))
+        return
+
+    def unsendableReply(self, request):
+        """
+        Reply to request when its reply cannot be sent. A function which ran is 
+        still reported as run, without its return value.
+        """
+        if request["type"] == "run":
+            return dict(self.OKMessage, error=f"{request.get('function')}: Cannot send the return value")
+        return self.BadMessage
+
+    def execute(self, request):
+        """
+        Apply request, returning the reply message.
+        """
         #Sort behaviour by request type
-        requestType = request["type"]
+        requestType = request.get("type")
         if requestType == "shutdown":
+            #Give running jobs the chance to stop cleanly first
+            jobs = list(self.jobs.values())
+            for job in jobs:
+                job.cancel()
+            for job in jobs:
+                job.thread.join(timeout=1.0)
             try:
                 self.hardware.__del__()
                 self.running = False
-                self.write(self.OKMessage)
+                return self.OKMessage
             except:
-                self.write(self.BadMessage)
+                return self.BadMessage
         elif requestType == "get":
             try:
                 propertyName = request["property"]
                 property = getattr(self.hardware, propertyName)
                 message = self.OKMessage.copy()
                 message["property"] = property
-                self.write(message)
+                return message
             except:
-                self.write(self.BadMessage)
+                return self.BadMessage
         elif requestType == "set":
             try:
                 propertyName = request["property"]
                 propertyValue = request["value"]
                 property = getattr(self.hardware, propertyName)
-                setattr(self.hardware, propertyName, type(property)(propertyValue))
-                self.write(self.OKMessage)
+                if isinstance(property, np.ndarray):
+                    propertyValue = np.asarray(propertyValue, dtype=property.dtype)
+                else:
+                    propertyValue = type(property)(propertyValue)
+                setattr(self.hardware, propertyName, propertyValue)
+                return self.OKMessage
             except:
-                self.write(self.BadMessage)
+                return self.BadMessage
         elif requestType == "run":
             try:
                 functionName = request["function"]
-                args = []
-                for i in range(0, len(request.keys())-2):
-                    arg = request[f"arg_{i+1}"]
-                    args.append(arg)
+                args = request.get("args", [])
                 function = getattr(self.hardware, functionName)
-                if len(args) > 0:
-                    function(*args)
-                else:
-                    function()
-                self.write(self.OKMessage)
+                result = function(*args)
+            except Exception as e:
+                return dict(self.BadMessage, error=f"{request.get('function')}: {e!r}")
+            #The status and the return value are separate, None and -1 are valid returns
+            message = self.OKMessage.copy()
+            message["return"] = result
+            return message
+        elif requestType == "batch":
+            #Apply every request in order and reply with all the results at once
+            replies = []
+            for subRequest in request.get("requests", []):
+                if not isinstance(subRequest, dict) or subRequest.get("type") in ("shutdown", "batch"):
+                    replies.append(self.BadMessage)
+                    continue
+                reply = self.execute(subRequest)
+                try:
+                    json.dumps(encode_message(reply)[0])
+                except TypeError:
+                    print(f"{self.hardware.name}: Cannot send the reply to a {subRequest['type']} request")
+                    reply = self.unsendableReply(subRequest)
+                replies.append(reply)
+            message = self.OKMessage.copy()
+            message["replies"] = replies
+            return message
+        elif requestType == "start_job":
+            try:
+                function = getattr(self.hardware, request["function"])
+                job = Job(self.lastJobId+1, function, request.get("args", []), name=self.hardware.name)
             except:
-                self.write(self.BadMessage)
+                return self.BadMessage
+            self.lastJobId = job.id
+            #Drop the oldest finished jobs nobody asked about
+            finished = [j.id for j in list(self.jobs.values()) if j.state != Job.RUNNING]
+            for jobId in finished[:max(0, len(finished) - self.MAX_FINISHED_JOBS)]:
+                self.jobs.pop(jobId, None)
+            self.jobs[job.id] = job
+            job.start()
+            message = self.OKMessage.copy()
+            message["property"] = job.id
+            return message
+        elif requestType in ("job_status", "cancel_job"):
+            job = self.jobs.get(request.get("job"))
+            if job is None:
+                return self.BadMessage
+            if requestType == "cancel_job":
+                job.cancel()
+            message = self.OKMessage.copy()
+            message["property"] = job.status()
+            #Its final status is only reported once
+            if message["property"]["state"] != Job.RUNNING:
+                self.jobs.pop(job.id, None)
+            return message
         else:
-            self.write(self.BadMessage)
+            return self.BadMessage
+
+    def close(self):
+        self.RTCsocket.close()
+        if self.socketPath is not None and os.path.exists(self.socketPath):
+            os.unlink(self.socketPath)
+        return
+
+    def reply(self, request, message):
+        if isinstance(request, dict) and "id" in request:
+            message = dict(message, id=request["id"])
+        self.write(message)
+        return
 
     def write(self, message):
-        message = json.dumps(message)
-        self.RTCsocket.send(message.encode())
+        with self.sendLock:
+            send_message(self.RTCsocket, message)
         return
     
     def read(self):
-        reply = self.RTCsocket.recv(4096).decode()
-        return json.loads(reply)
+        return recv_message(self.RTCsocket)
     
 def initExistingShm(shmName, gpuDevice=None):
-    #Read wfc metadata and open a stream to the shared memory
+    entry = get_registry().lookup(shmName)
+    if entry is not None:
+        shmDims, shmDType, numSlots = entry["shape"], entry["dtype"], entry["numSlots"]
+    else:
+        shmDims, shmDType, numSlots = readShmMetadata(shmName)
+    if numSlots > 1:
+        shm = RingImageSHM(shmName, shmDims, shmDType, numSlots, gpuDevice=gpuDevice, consumer=True)
+    else:
+        shm = ImageSHM(shmName, shmDims, shmDType, gpuDevice=gpuDevice, consumer=True)
+    return shm, shmDims, shmDType
+
+def readShmMetadata(shmName):
+    #Fall back to the <name>_meta segment for SHMs missing from the registry
     shmMeta = ImageSHM(shmName+"_meta", (ImageSHM.METADATA_SIZE,), np.float64).read_noblock()
+    numSlots = int(shmMeta.view(np.int64)[ImageSHM.NUM_SLOTS_IDX])
     shmDType = float_to_dtype(shmMeta[3])
     shmSize = int(shmMeta[2]//shmDType.itemsize)
     shmDims = []
@@ -618,8 +2354,7 @@ def initExistingShm(shmName, gpuDevice=None):
     while int(shmMeta[4+i]) > 0:
         shmDims.append(int(shmMeta[4+i]))
         i += 1
-    shm = ImageSHM(shmName, shmDims, shmDType, gpuDevice=gpuDevice, consumer=True)
-    return shm, shmDims, shmDType
+    return shmDims, shmDType, numSlots
 
 
 def launchComponent(component, confKey, start = True):
@@ -630,11 +2365,15 @@ def launchComponent(component, confKey, start = True):
     # Add command-line argument for the config file
     parser.add_argument("-c", "--config", required=True, help="Path to the config file")
     parser.add_argument("-p", "--port", required=True, help="Port for communication")
+    parser.add_argument("-s", "--socket", default=None, help="Unix socket path for communication, instead of the port")
 
     # Parse command-line arguments
     args = parser.parse_args()
 
     conf = read_yaml_file(args.config)[confKey]
+    socketPath = args.socket
+    if socketPath is None and setFromConfig(conf, "rpcTransport", "tcp") == "unix":
+        socketPath = unix_socket_path(setFromConfig(conf, "name", confKey))
 
     set_affinity_and_priority("", setFromConfig(conf, "affinity", 0))
 
@@ -643,7 +2382,7 @@ def launchComponent(component, confKey, start = True):
     if start:
         obj.start()
     
-    l = Listener(obj, port= int(args.port))
+    l = Listener(obj, port= int(args.port), socketPath=socketPath)
     while l.running:
         l.listen()
-        time.sleep(1e-3)
+    l.close()
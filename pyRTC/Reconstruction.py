@@ -0,0 +1,50 @@
+"""
+Integrators turning slopes into modal corrections, shared by Loop and the fused 
+reconstruction of SlopesProcess. Importing this module has no side effects (in 
+particular on numba's thread pool).
+"""
+import numpy as np
+from numba import jit
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def leakyIntegratorNumba(slopes: np.ndarray, 
+                         resconstructionMatrix: np.ndarray, 
+                         oldCorrection: np.ndarray,
+                         correction: np.ndarray,
+                         leak: np.float32,
+                         numActiveModes: int) -> np.ndarray:
+    
+    # Perform the matrix-vector multiplication using np.dot
+    correction = np.dot(resconstructionMatrix, slopes)
+    
+    # Apply the leaky integrator formula with an unrolled loop
+    for i in range(numActiveModes + 1):
+        correction[i] = (1 - leak) * oldCorrection[i] - correction[i]
+    
+    # Zero out the rest of the correction vector
+    for i in range(numActiveModes + 1, correction.size):
+        correction[i] = 0.0
+    
+    return correction
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def leakyIntegratorInPlaceNumba(slopes: np.ndarray, 
+                                resconstructionMatrix: np.ndarray, 
+                                correction: np.ndarray,
+                                scratch: np.ndarray,
+                                leak: np.float32,
+                                numActiveModes: int) -> np.ndarray:
+    """
+    Same as leakyIntegratorNumba, but updates correction (holding the old correction, 
+    e.g. the wfc SHM buffer) in place. scratch holds the reconstructed modes.
+    """
+    np.dot(resconstructionMatrix, slopes, scratch)
+
+    numUpdated = min(numActiveModes + 1, correction.size)
+    for i in range(numUpdated):
+        correction[i] = (1 - leak) * correction[i] - scratch[i]
+
+    for i in range(numUpdated, correction.size):
+        correction[i] = 0.0
+
+    return correction
@@ -7,18 +7,19 @@ os.environ["OPENBLAS_NUM_THREADS"] = "1"
 os.environ["MKL_NUM_THREADS"] = "1" 
 os.environ["VECLIB_MAXIMUM_THREADS"] = "1" 
 os.environ["NUMEXPR_NUM_THREADS"] = "1" 
-os.environ['NUMBA_NUM_THREADS'] = '1'
 
 from pyRTC.Pipeline import *
 from pyRTC.utils import *
 from pyRTC.pyRTCComponent import *
+from pyRTC.Centroiding import *
+from pyRTC.Reconstruction import *
 from astropy.io import fits
 import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 import time
-from numba import jit
-import sched
+import numba
+from numba import jit, prange
 
 try:
     import torch
@@ -211,6 +212,83 @@ def computeSlopesSHWFSOptimNumba(image:np.ndarray,
     
     return slopes
 
+"""
+Parallel versions of the kernels above, splitting the pixels (PYWFS) or the 
+subapertures (SHWFS) between numba threads (see numbaThreads). They gather the 
+pupils through precomputed pixel indices and write into preallocated output. 
+See pyRTCView/benchmarkSlopes.py for how they compare.
+"""
+@jit(nopython=True, nogil=True, cache=True, fastmath=True, parallel=True)
+def computeSlopesPYWFSParallel(image:np.ndarray,
+                               p1Idx:np.ndarray,
+                               p2Idx:np.ndarray,
+                               p3Idx:np.ndarray,
+                               p4Idx:np.ndarray,
+                               slopes:np.ndarray,
+                               refSlopes:np.ndarray,
+                               ):
+    # image is flat, pNIdx are the flat indices of the pixels of pupil N
+    numPixelsInPupils = p1Idx.size
+    total_sum = 0.0
+    for i in prange(numPixelsInPupils):
+        total_sum += np.float32(image[p1Idx[i]]) + np.float32(image[p2Idx[i]]) \
+                     + np.float32(image[p3Idx[i]]) + np.float32(image[p4Idx[i]])
+    mean_value = total_sum / numPixelsInPupils
+
+    for i in prange(numPixelsInPupils):
+        if mean_value > 0:
+            p1 = np.float32(image[p1Idx[i]])
+            p2 = np.float32(image[p2Idx[i]])
+            p3 = np.float32(image[p3Idx[i]])
+            p4 = np.float32(image[p4Idx[i]])
+            slopes[i] = ((p1 + p2) - (p3 + p4))/mean_value - refSlopes[i]
+            slopes[numPixelsInPupils + i] = ((p1 + p3) - (p2 + p4))/mean_value \
+                - refSlopes[numPixelsInPupils + i]
+        else:
+            slopes[i] = 0
+            slopes[numPixelsInPupils + i] = 0
+    return slopes
+
+@jit(nopython=True, nogil=True, cache=True, parallel=True)
+def computeSlopesSHWFSParallel(image:np.ndarray, 
+                               slopes:np.ndarray, 
+                               unaberratedSlopes:np.ndarray, 
+                               threshold:np.float32, 
+                               spacing:np.float32,
+                               xvals:np.ndarray,
+                               offsetX:int, 
+                               offsetY:int,
+                               intN:int,
+                               ):
+    numRegions = unaberratedSlopes.shape[1]
+
+    # One row of subapertures per iteration
+    for i in prange(numRegions):
+        start_i = int(round(spacing * i)) + offsetY
+        for j in range(numRegions):
+            start_j = int(round(spacing * j)) + offsetX
+
+            norm = np.float32(0)
+            weightX = np.float32(0)
+            weightY = np.float32(0)
+            if start_j + intN <= image.shape[1] and start_i + intN <= image.shape[0]:
+                for m in range(intN):
+                    for n in range(intN):
+                        value = np.float32(image[start_i + m, start_j + n])
+                        if value > threshold:
+                            norm += value
+                            weightX += xvals[m,n] * value
+                            weightY += xvals[n,m] * value
+
+            if norm > 0:
+                slopes[i, j] = weightX/norm - unaberratedSlopes[i, j]
+                slopes[i + numRegions, j] = weightY/norm - unaberratedSlopes[i + numRegions, j]
+            else:
+                slopes[i, j] = 0
+                slopes[i + numRegions, j] = 0
+
+    return slopes
+
 """
 Optimized for best performance with numpy only.
 Does not allow for non-integer spacing.
@@ -328,6 +406,89 @@ def computeSlopesFELIX(image: np.ndarray,
 
     return slopes
 
+def felixPixelIndices(masks: np.ndarray, xvals: np.ndarray, yvals: np.ndarray):
+    """
+    Precompute the pixels each FELIX subaperture mask covers, for 
+    computeSlopesFELIXSparse. The lists are stored back to back (CSR style), the 
+    pixels of mask m being entries starts[m]:starts[m+1].
+
+    Returns
+    -------
+    indices : np.ndarray
+        Flat (row-major) image index of every pixel of every mask.
+    starts : np.ndarray
+        (num_masks+1,) offset of each mask's pixels in indices.
+    xWeights, yWeights : np.ndarray
+        x and y coordinate of every pixel, as used for the centers of mass.
+    """
+    num_masks, H, W = masks.shape
+    maskIdx, rows, cols = np.nonzero(masks)
+    starts = np.zeros(num_masks + 1, dtype=np.int64)
+    starts[1:] = np.cumsum(np.bincount(maskIdx, minlength=num_masks))
+    indices = (rows * W + cols).astype(np.int64)
+    xWeights = np.asarray(xvals, dtype=np.float64)[cols]
+    yWeights = np.asarray(yvals, dtype=np.float64)[rows]
+    return indices, starts, xWeights, yWeights
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def computeSlopesFELIXSparse(image: np.ndarray,
+                             slopes: np.ndarray,
+                             unaberratedSlopes: np.ndarray,
+                             threshold: float,
+                             indices: np.ndarray,
+                             starts: np.ndarray,
+                             xWeights: np.ndarray,
+                             yWeights: np.ndarray,
+                             xoffset: float,
+                             yoffset: float):
+    """
+    Same slopes as computeSlopesFELIX, visiting only the pixels of each mask (see 
+    felixPixelIndices). Thresholding, flux and first moments are done in one pass 
+    and the (2N, N) slopes are written into slopes, which is returned.
+    """
+    img = image.ravel()
+    N = slopes.shape[1]
+    for m in range(starts.size - 1):
+        flux = 0.0
+        sumX = 0.0
+        sumY = 0.0
+        for k in range(starts[m], starts[m+1]):
+            value = img[indices[k]]
+            if value > threshold:
+                flux += value
+                sumX += value * xWeights[k]
+                sumY += value * yWeights[k]
+        i = m // N
+        j = m % N
+        if flux > 0.0:
+            slopes[i, j] = sumX / flux - xoffset - unaberratedSlopes[i, j]
+            slopes[N+i, j] = sumY / flux - yoffset - unaberratedSlopes[N+i, j]
+        else:
+            slopes[i, j] = 0.0
+            slopes[N+i, j] = 0.0
+    return slopes
+
+def felixBoundingBox(masks: np.ndarray, pixels: tuple, stack=None):
+    """
+    Tight bounding box (rowStart, rowStop, colStart, colStop) of the pixels of all 
+    the masks, from their felixPixelIndices, and of the windows of stack if given.
+    A single pixel if the masks are empty.
+    """
+    indices = pixels[0]
+    W = masks.shape[2]
+    if indices.size == 0 and stack is None:
+        return (0, 1, 0, 1)
+    rows, cols = np.divmod(indices, W)
+    rowStarts, rowStops = [rows], [rows + 1]
+    colStarts, colStops = [cols], [cols + 1]
+    if stack is not None:
+        rowStarts.append(stack.rows)
+        rowStops.append(stack.rows + stack.windowSize)
+        colStarts.append(stack.cols)
+        colStops.append(stack.cols + stack.windowSize)
+    return (int(np.concatenate(rowStarts).min()), int(np.concatenate(rowStops).max()),
+            int(np.concatenate(colStarts).min()), int(np.concatenate(colStops).max()))
+
 def quadrant_masks(N, angle_deg=0.0):
     """
     Generate 4 quadrant masks for an NxN image with optional axis rotation. Used
@@ -372,6 +533,386 @@ def quadrant_masks(N, angle_deg=0.0):
 
     return masks
 
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def subtractSlopeOffsets(signal: np.ndarray,
+                         buffer: np.ndarray,
+                         channels: np.ndarray,
+                         steps: np.ndarray,
+                         gains: np.ndarray):
+    """
+    signal -= sum over k of gains[k] * buffer[channels[k], steps[k]], in one pass 
+    over signal. buffer is (numChannels, length, signal.size).
+    """
+    for i in range(signal.size):
+        total = 0.0
+        for k in range(channels.size):
+            total += gains[k] * buffer[channels[k], steps[k], i]
+        signal[i] -= total
+    return signal
+
+class SlopesGeometry:
+    """
+    What computeSignal needs to know about the subapertures (FELIX pixel lists, 
+    valid subaperture indices and output buffers), built once when the masks, ROI 
+    or valid subapertures change instead of on every frame.
+
+    A geometry is not modified once built. SlopesProcess.updateGeometry swaps in a 
+    new one, with the next version number, in a single assignment and computeSignal 
+    takes one reference per frame, so every frame is computed with one consistent 
+    geometry even while chopSubaps changes the masks.
+
+    With FELIX masks, only the bounding box of the pixels the masks (and centroid 
+    windows) cover is read from the WFS image, into crop, and the pixel lists are 
+    rebased onto it (cropPixels).
+    """
+
+    def __init__(self, version, slopesShape, dtype, validSubAps=None, masks=None, 
+                 offsets=(0, 0), xvals=None, yvals=None, pixels=None, engine=None, stack=None, 
+                 imageDType=np.int32) -> None:
+        """
+        Parameters
+        ----------
+        version : int
+            Increases with every new geometry.
+        slopesShape : tuple
+            Shape of the 2D slopes, (2N, N).
+        dtype : data-type
+            Data type of the slopes.
+        validSubAps : numpy.ndarray, optional
+            Boolean valid subaperture mask, of shape slopesShape.
+        masks : numpy.ndarray, optional
+            FELIX subaperture masks (num_masks, H, W).
+        offsets : tuple, optional
+            x and y offsets of the masks from the center of the image.
+        xvals, yvals : numpy.ndarray, optional
+            Pixel coordinates along x and y.
+        pixels : tuple, optional
+            felixPixelIndices(masks, xvals, yvals), if already computed.
+        engine : CentroidEngine, optional
+            Centroid engine the slopes are computed with, None for the direct 
+            centre of gravity kernels.
+        stack : SubapertureStack, optional
+            The subapertures' windows, prepared for engine.
+        imageDType : data-type, optional
+            Data type of the WFS image, for the crop. Default np.int32.
+        """
+        self.version = version
+        self.engine = engine
+        self.stack = stack
+        self.masks = masks
+        self.xOffset, self.yOffset = offsets[0], offsets[1]
+        if masks is not None and pixels is None:
+            pixels = felixPixelIndices(masks, xvals, yvals)
+        self.pixels = pixels
+        #Part of the WFS image computeSignal reads, None for all of it
+        self.bbox = None
+        self.region = None
+        self.origin = (0, 0)
+        self.crop = None
+        self.cropPixels = None
+        if masks is not None:
+            self.bbox = felixBoundingBox(masks, pixels, stack)
+            r0, r1, c0, c1 = self.bbox
+            self.region = (slice(r0, r1), slice(c0, c1))
+            self.origin = (r0, c0)
+            self.crop = np.zeros((r1 - r0, c1 - c0), dtype=imageDType)
+            indices, starts, xWeights, yWeights = pixels
+            rows, cols = np.divmod(indices, masks.shape[2])
+            self.cropPixels = ((rows - r0)*(c1 - c0) + cols - c0, starts, xWeights, yWeights)
+        self.validSubAps = validSubAps
+        self.validIndices = None if validSubAps is None else np.flatnonzero(validSubAps)
+        #Computed into by the real-time thread
+        self.slopes = np.zeros(slopesShape, dtype=dtype)
+        #Default output of computeSignal2D
+        self.signal2D = np.zeros(slopesShape)
+        return
+
+@jit(nopython=True, nogil=True, cache=True, fastmath=True)
+def welfordUpdate(x: np.ndarray,
+                  offset: np.ndarray,
+                  count: float,
+                  mean: np.ndarray,
+                  m2: np.ndarray):
+    """
+    Add x + offset, the count-th sample, to the running mean and sum of squared 
+    deviations m2 (Welford's algorithm).
+    """
+    for i in range(x.size):
+        value = x[i] + offset[i]
+        delta = value - mean[i]
+        mean[i] += delta / count
+        m2[i] += delta * (value - mean[i])
+    return mean
+
+class RunningStats:
+    """
+    Running mean and variance of a stream of arrays (Welford's algorithm), updated 
+    in place from the real-time thread so no frames are kept.
+
+    Readers may see an update in progress, which only mixes the estimates of two 
+    consecutive counts. To restart, swap in a new RunningStats.
+    """
+
+    def __init__(self, size, maxCount=0, offset=None, region=None) -> None:
+        """
+        Parameters
+        ----------
+        size : int
+            Number of elements of the samples.
+        maxCount : int, optional
+            Stop after this many samples, 0 for no limit. Default 0.
+        offset : numpy.ndarray, optional
+            Added to every sample. Default zeros.
+        region : tuple, optional
+            What the samples are taken from (e.g. the image region), for the user 
+            to check before updating.
+        """
+        self.size = int(size)
+        self.maxCount = maxCount
+        self.count = 0
+        self.mean = np.zeros(self.size)
+        self.m2 = np.zeros(self.size)
+        self.offset = np.zeros(self.size, dtype=np.float32) if offset is None else offset
+        self.region = region
+        self.done = threading.Event()
+        return
+
+    def update(self, x):
+        """
+        Add the sample x (any shape, size elements). Returns False if it was not 
+        used, because x has the wrong size or maxCount was reached.
+        """
+        if x.size != self.size or self.done.is_set():
+            return False
+        self.count += 1
+        welfordUpdate(x.ravel(), self.offset, float(self.count), self.mean, self.m2)
+        if self.maxCount > 0 and self.count >= self.maxCount:
+            self.done.set()
+        return True
+
+    def variance(self):
+        """
+        Unbiased variance of every element, zeros before two samples.
+        """
+        if self.count < 2:
+            return np.zeros(self.size)
+        return self.m2 / (self.count - 1)
+
+class ChopSequence:
+    """
+    A sequence of chop positions, each held for a number of WFS frames, played by 
+    SlopesProcess.computeSignal so the chop is synchronous with the exposures.
+    """
+
+    def __init__(self, positions, holdFrames) -> None:
+        """
+        Parameters
+        ----------
+        positions : array_like
+            Chop mask index of each step.
+        holdFrames : array_like
+            Number of frames each step is held for (at least 1).
+        """
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.holdFrames = np.maximum(np.asarray(holdFrames, dtype=np.int64), 1)
+        self.totalFrames = int(self.holdFrames.sum())
+        self.step = -1
+        self.framesLeft = 0
+        self.framesDone = 0
+        self.finished = threading.Event()
+        return
+
+    def advance(self):
+        """
+        Count one frame. Returns the position to switch to before computing it, 
+        None to keep the current one.
+        """
+        newPosition = None
+        if self.framesLeft == 0:
+            self.step += 1
+            self.framesLeft = int(self.holdFrames[self.step])
+            newPosition = int(self.positions[self.step])
+        self.framesLeft -= 1
+        self.framesDone += 1
+        return newPosition
+
+    def isLastFrame(self):
+        return self.framesDone >= self.totalFrames
+
+    def progress(self):
+        return self.framesDone / self.totalFrames
+
+class FusedReconstructor:
+    """
+    Leaky integrator run by SlopesProcess.computeSignal right after the slopes, so
+    one thread goes from the WFS frame to the modal correction in the wfc SHM. Uses
+    the control matrix the Loop publishes in the "cmat" SHM, reloaded whenever it
+    changes. The loop starts open. Every iteration is recorded in the Loop's "loop" 
+    SHM, as Loop's integrators do (see publishLoopParams).
+    """
+
+    def __init__(self, signalSize, gain, leak, gpuDevice=None) -> None:
+        """
+        Parameters
+        ----------
+        signalSize : int
+            Number of elements of the signal.
+        gain : float
+            Integrator gain.
+        leak : float
+            Integrator leak.
+        """
+        self.wfcShm, self.wfcShape, self.wfcDType = initExistingShm("wfc", gpuDevice = gpuDevice)
+        self.cmatShm, self.cmatShape, self.cmatDType = initExistingShm("cmat", gpuDevice = gpuDevice)
+        self.loopParams, self.loopParamsShape, self.loopParamsDtype = initExistingShm("loop", gpuDevice = gpuDevice)
+        self.wfsInfoShm, self.wfsInfoShape, self.wfsInfoDType = initExistingShm("wfsInfo", gpuDevice = gpuDevice)
+        self.loopCounter = 0
+        self.loopState = -1
+        self.numModes = int(np.prod(self.wfcShape))
+        self.signalSize = int(signalSize)
+        self.gain = gain
+        self.leak = leak
+        self.closed = False
+        self.CM = None
+        self.gCM = None
+        self.numActiveModes = -1
+        #Reconstructed modes
+        self.scratch = np.zeros(self.numModes, dtype=np.float32)
+        self.loadCM()
+        return
+
+    def loadCM(self):
+        """
+        Read the control matrix from the "cmat" SHM. Modes after the last non-zero
+        row are dropped, as Loop does with numDroppedModes.
+        """
+        CM = self.cmatShm.read_noblock()
+        if CM.shape != (self.numModes, self.signalSize):
+            print(f"Control matrix is {CM.shape}, expected {(self.numModes, self.signalSize)}. Not integrating.")
+            self.CM, self.gCM = None, None
+            return -1
+        self.CM = np.ascontiguousarray(CM, dtype=np.float32)
+        activeModes = np.flatnonzero(np.any(self.CM != 0, axis=1))
+        self.numActiveModes = int(activeModes[-1]) if activeModes.size > 0 else -1
+        self.setGain(self.gain)
+        return 1
+
+    def setGain(self, gain):
+        self.gain = gain
+        if self.CM is not None:
+            self.gCM = np.float32(self.gain)*self.CM
+        return
+
+    def integrate(self, signal, upstreamId=None):
+        """
+        Integrate signal into the wfc SHM if the loop is closed, tagging the
+        correction with upstreamId. Returns True if the correction was written.
+        """
+        if self.cmatShm.checkNew():
+            self.loadCM()
+        if not self.closed or self.gCM is None or self.numActiveModes < 0:
+            return False
+        with self.wfcShm.writing() as correction:
+            leakyIntegratorInPlaceNumba(signal,
+                                        self.gCM,
+                                        correction.reshape(-1),
+                                        self.scratch,
+                                        np.float32(self.leak),
+                                        self.numActiveModes)
+            self.wfcShm.commit(upstreamId=upstreamId)
+        return True
+
+    def publishLoopParams(self, upstreamId=None):
+        """
+        Write the "loop" SHM for one iteration, stamped with the WFS frame it used, 
+        as Loop's loop_iter does. Called once the signal of the iteration is 
+        published, so readers of "loop" can find it.
+        """
+        wfsInfo = self.wfsInfoShm.read_noblock()
+        self.loopParams.write( np.array(
+            [
+                self.loopCounter,
+                self.loopState,
+                get_time_usec(),
+                wfsInfo[0], # dt since last frame
+                wfsInfo[1] # absolute time
+            ],
+            dtype=self.loopParamsDtype), upstreamId=upstreamId )
+        self.loopCounter += 1
+        return
+
+class SignalPublisher:
+    """
+    Publishes the signal of the fused stage from a background thread, so the
+    real-time thread only waits for the correction. The signal is computed into
+    buffer() and handed over by submit(), which swaps the two buffers. If the
+    previous frame is still being published the new one is not published (counted
+    in dropped), the real-time thread never waits.
+    """
+
+    def __init__(self, publish, shape, dtype) -> None:
+        """
+        Parameters
+        ----------
+        publish : callable
+            Called as publish(signal, upstreamId, geometry, loopIteration) from the 
+            thread.
+        shape : tuple
+            Shape of the signal.
+        dtype : type
+            Data type of the signal.
+        """
+        self.publish = publish
+        self.buffers = [np.zeros(shape, dtype=dtype) for i in range(2)]
+        self.current = 0
+        self.pending = None
+        self.dropped = 0
+        self.idle = threading.Event()
+        self.idle.set()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return
+
+    def buffer(self):
+        """
+        The array to compute the next signal into.
+        """
+        return self.buffers[self.current]
+
+    def submit(self, upstreamId, geometry, loopIteration=False):
+        """
+        Publish the signal in buffer(), computed with geometry from WFS frame
+        upstreamId, and integrated into the correction if loopIteration. Returns 
+        False if it was dropped.
+        """
+        if not self.idle.is_set():
+            self.dropped += 1
+            return False
+        self.idle.clear()
+        self.pending = (self.buffers[self.current], upstreamId, geometry, loopIteration)
+        self.current = 1 - self.current
+        self.ready.set()
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Wait until the last submitted signal is published. Returns False on timeout.
+        """
+        return self.idle.wait(timeout)
+
+    def run(self):
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            signal, upstreamId, geometry, loopIteration = self.pending
+            try:
+                self.publish(signal, upstreamId, geometry, loopIteration)
+            except Exception as e:
+                logging.log(level=logging.ERROR, msg=f"Publishing the signal failed: {e}")
+            finally:
+                self.idle.set()
+
 class SlopesProcess(pyRTCComponent):
     """
     A class to handle real-time slope computation for wavefront sensors.
@@ -406,6 +947,43 @@ class SlopesProcess(pyRTCComponent):
         File containing valid sub-aperture mask. Default is "".
     refSlopesFile : str, optional
         File containing reference slopes. Default is "".
+    signalRingSlots : int, optional
+        If greater than 1, keep this many signal frames in a RingImageSHM so slow 
+        consumers can read every frame. Default is 1.
+    slopeOffsetBufferFile : str, optional
+        FITS file of slope offsets to play back, (channels, steps, slopes). Default is "".
+    slopeOffsetBufferMemmap : bool, optional
+        Memory map the slope offsets file instead of loading it, for long playback 
+        sequences. Only the steps played are read. Default is False.
+    numbaThreads : int, optional
+        Number of numba threads the "PYWFS" and "SHWFS" slope kernels split each 
+        frame between, capped at numba's thread pool size (NUMBA_NUM_THREADS in the 
+        environment the component is launched from, the number of cores if unset). 
+        With 1, "SHWFS" uses the serial kernel. Default is 1.
+    numbaAffinity : list of int, optional
+        Cores for the thread computing the signal and numba's threads when 
+        numbaThreads > 1. Otherwise they all share the thread's single core (see 
+        affinity). Default is [].
+    frameWaitMargin : float, optional
+        Seconds allowed on top of twice the expected time when waiting for frames 
+        (takeRefSlopes, playChopSequence) before giving up. Default is 5.0.
+    centroidEngine : str, optional
+        Centroiding algorithm for "SHWFS" and "FELIX", one of CENTROID_ENGINES 
+        (see pyRTC.Centroiding): "cog", "wcog", "brightest", "correlation" or 
+        "quadcell". Engines read their own centroid* keys. Default is "cog", the 
+        thresholded centre of gravity computed directly from the image. Until 
+        takeCentroidReference is called, engines assume a centered spot in each 
+        subaperture window.
+    fusedReconstruction : bool, optional
+        Integrate the slopes into the wfc SHM from computeSignal, with the control 
+        matrix the Loop publishes in the "cmat" SHM, and publish the signal from a 
+        background thread, followed by the "loop" SHM. Only one of it and the 
+        Loop's integrator can write the wfc SHM at a time. The loop starts open, 
+        see setFusedLoop. Default is False.
+    fusedGain : float, optional
+        Integrator gain of the fused reconstruction. Default is 0.1.
+    fusedLeak : float, optional
+        Integrator leak of the fused reconstruction. Default is 0.0.
 
     Attributes
     ----------
@@ -483,6 +1061,26 @@ class SlopesProcess(pyRTCComponent):
         Mask for pupil 3.
     p4mask : numpy.ndarray
         Mask for pupil 4.
+    p1Idx, p2Idx, p3Idx, p4Idx : numpy.ndarray
+        Flat image indices of the pixels of each pupil, in mask order.
+    numbaThreads : int
+        Number of numba threads used by the slope kernels.
+    geometry : SlopesGeometry
+        Precomputed subaperture geometry used by computeSignal, see updateGeometry.
+    centroidEngine : CentroidEngine or None
+        Engine computing the centroids, None for the direct centre of gravity kernels.
+    signalStats : RunningStats or None
+        Running statistics of the slopes, before reference slopes and offsets, see 
+        startStatistics.
+    imageStats : RunningStats or None
+        Running statistics of the pixels of the WFS image (of its cropped region for 
+        FELIX).
+    fused : FusedReconstructor or None
+        The fused reconstruction, if fusedReconstruction is set.
+    signalPublisher : SignalPublisher or None
+        Publishes the signal SHMs when fusedReconstruction is set.
+    lastGeometryVersion : int
+        Version of the geometry the last published signal was computed with.
     """
     def __init__(self, conf) -> None:
         
@@ -490,7 +1088,43 @@ class SlopesProcess(pyRTCComponent):
         self.conf = conf
         self.name = "Slopes"
 
+        #See ChopSequence, played by computeSignal
+        self.chopSequence = None
+        #See startStatistics, updated by computeSignal
+        self.signalStats = None
+        self.imageStats = None
+        #Smoothed time between computeSignal calls, to convert times to frames
+        self.framePeriod = 0.0
+        self.lastFrameTime = None
+        self.frameWaitMargin = setFromConfig(self.conf, "frameWaitMargin", 5.0)
+
+        #See SlopesGeometry, rebuilt by updateGeometry
+        self.geometry = None
+        self.geometryVersion = 0
+        self.lastGeometryVersion = 0
+        self.geometryLock = threading.Lock()
+
         self.signalDType = np.float32
+        self.numbaThreads = max(1, int(setFromConfig(self.conf, "numbaThreads", 1)))
+        if self.numbaThreads > numba.config.NUMBA_NUM_THREADS:
+            logging.log(level=logging.WARNING, msg=f"numbaThreads is {self.numbaThreads} but numba only has "
+                        f"{numba.config.NUMBA_NUM_THREADS} threads, set NUMBA_NUM_THREADS before launching")
+            self.numbaThreads = numba.config.NUMBA_NUM_THREADS
+        numba.set_num_threads(self.numbaThreads)
+        self.numbaAffinity = setFromConfig(self.conf, "numbaAffinity", [])
+        #numba's thread count is per thread, see useNumbaThreads
+        self.numbaThreadState = threading.local()
+        self.centroidEngineName = setFromConfig(self.conf, "centroidEngine", "cog").lower()
+        self.centroidEngine = None
+        if self.centroidEngineName != "cog":
+            self.centroidEngine = make_centroid_engine(self.centroidEngineName, self.conf)
+        #See setFusedReconstruction, needs the signal SHM
+        self.fusedReconstruction = setFromConfig(self.conf, "fusedReconstruction", False)
+        self.fusedGain = setFromConfig(self.conf, "fusedGain", 0.1)
+        self.fusedLeak = setFromConfig(self.conf, "fusedLeak", 0.0)
+        self.fused = None
+        self.signalPublisher = None
+        self.signalRingSlots = setFromConfig(self.conf, "signalRingSlots", 1)
         self.imageNoise = setFromConfig(self.conf,"imageNoise", 0.0)
         self.centralObscurationRatio = setFromConfig(self.conf,"centralObscurationRatio", 0.0)
 
@@ -530,15 +1164,20 @@ class SlopesProcess(pyRTCComponent):
             self.signalSize = np.sum(self.validSubAps)
             self.signalShape = (self.signalSize,)
 
-            self.signal = ImageSHM("signal", self.signalShape, self.signalDType, gpuDevice = self.gpuDevice, consumer=False)
+            self.signal = self.createSignalShm(self.signalShape)
             self.signal2D = ImageSHM("signal2D", self.signal2DShape, self.signalDType, gpuDevice = self.gpuDevice, consumer=False)
             self.refSlopes = np.zeros(self.signal2DShape, dtype=self.signalDType)
 
             self.chopMasksFile = setFromConfig(self.conf, "chopMasksFile", "")
             self.loadChopMasks()
+            #Chop position in use while a ChopSequence plays, -1 otherwise
+            self.chopIndexShm = ImageSHM("chopIndex", (1,), np.int64, consumer=False)
+            self.chopIndexShm.write(np.array([-1], dtype=np.int64))
         
         elif self.wfsType == "pywfs":
-            raise NotImplementedError("Only Felix is supported. Attempted to initialize a PYWFS SlopesProcess.")
+            if self.centroidEngine is not None:
+                print(f"centroidEngine {self.centroidEngineName} is ignored by the PYWFS")
+                self.centroidEngine = None
             #Check if we have specified a pupil validSubAps
             if "pupils" in self.conf.keys():
                 pupilLocs = [(int(x.split(',')[1]), int(x.split(',')[0])) for x in self.conf["pupils"]]
@@ -555,16 +1194,8 @@ class SlopesProcess(pyRTCComponent):
             #Allocate all of the memory for slope computations
             self.refSlopes = np.zeros(self.signal2DShape, dtype=self.signalDType)
             self.refSlopes1D = np.zeros_like(self.signal.read_noblock())
-            self.slopesArr1D = np.zeros_like(self.refSlopes1D)
-            self.numPixelsInPupils = np.count_nonzero(self.p1mask)
-            self.p1 = np.empty(self.numPixelsInPupils, dtype = self.signalDType)
-            self.p2 = np.empty_like(self.p1)
-            self.p3 = np.empty_like(self.p1)
-            self.p4 = np.empty_like(self.p1)
-            self.tmp1, self.tmp2 = np.empty_like(self.p1), np.empty_like(self.p1)
 
         elif self.wfsType == "shwfs":
-            raise NotImplementedError("Only Felix is supported. Attempted to initialize a SHWFS SlopesProcess.")
             self.shwfsContrast = setFromConfig(self.conf, "contrast", 0)
             self.subApSpacing = self.conf["subApSpacing"]
             self.regionSize = int(np.round(self.subApSpacing,0))
@@ -592,7 +1223,7 @@ class SlopesProcess(pyRTCComponent):
             print(f'signalShape: {self.signalShape}')
             print(f'signalDType: {self.signalDType}')
 
-            self.signal = ImageSHM("signal", self.signalShape, self.signalDType, gpuDevice = self.gpuDevice, consumer=False)
+            self.signal = self.createSignalShm(self.signalShape)
             self.signal2D = ImageSHM("signal2D", self.signal2DShape, self.signalDType, gpuDevice = self.gpuDevice, consumer=False)
             
             self.refSlopes = np.zeros(self.signal2DShape, dtype=self.signalDType)
@@ -601,6 +1232,7 @@ class SlopesProcess(pyRTCComponent):
         # For slope offset buffer length
         self.maxSlopeOffsetsChannels = 9  # max number of channels in soff buffer
         self.slopeOffsetsBufferFile = setFromConfig(self.conf, "slopeOffsetBufferFile", "")
+        self.slopeOffsetsMemmap = setFromConfig(self.conf, "slopeOffsetBufferMemmap", False)
         self.loadSlopeOffsetsBuffer(self.slopeOffsetsBufferFile)
         # keep track of which step in the buffer we are on. updates every time
         # computeSignal() is called.
@@ -610,6 +1242,9 @@ class SlopesProcess(pyRTCComponent):
         self.refSlopesShm = ImageSHM("refSlopes", self.refSlopes.shape, self.refSlopes.dtype, gpuDevice = self.gpuDevice, consumer=False)
         self.loadRefSlopes()
 
+        if self.fusedReconstruction:
+            self.setFusedReconstruction()
+
     def initWFSMemoryFelix(self):
         # So we can reload the WFS SHM if the image size changes without reseting
         # the whole component
@@ -617,12 +1252,21 @@ class SlopesProcess(pyRTCComponent):
         subApMasksShape = (self.numSubAps, self.imageShape[0], self.imageShape[1])
         # store in shared memory for plotting
         self.subApMasksShm = ImageSHM("subApMasks", subApMasksShape, '>i8', gpuDevice = self.gpuDevice, consumer=True)
-        self.makeSubApMasks()
-        
+
+        #Needed by setSubApMasks to index the masks' pixels
         ysize, xsize = self.imageShape
         self.yvals = np.arange(ysize).astype(int) - ysize // 2
         self.xvals = np.arange(xsize).astype(int) - xsize // 2
-    
+        self.makeSubApMasks()
+
+    def createSignalShm(self, shape):
+        """
+        Create the signal SHM, as a RingImageSHM if signalRingSlots > 1.
+        """
+        if self.signalRingSlots > 1:
+            return RingImageSHM("signal", shape, self.signalDType, self.signalRingSlots, consumer=False)
+        return ImageSHM("signal", shape, self.signalDType, gpuDevice = self.gpuDevice, consumer=False)
+
     def makeSubApMasks(self, cx=0, cy=0):
         """
         Generate the sub-aperture quadrant masks. If the generated masks are smaller 
@@ -672,11 +1316,122 @@ class SlopesProcess(pyRTCComponent):
         self.setSubApMasks(final_masks, offsets)
         return
 
-    def setSubApMasks(self, masks, offsets):
+    def setSubApMasks(self, masks, offsets, pixels=None, publish=True, stack=None):
+        """
+        Set the FELIX subaperture masks, taking effect from the next frame.
+
+        Parameters
+        ----------
+        masks : numpy.ndarray
+            (num_masks, H, W) subaperture masks.
+        offsets : tuple
+            x and y offsets of the masks from the center of the image.
+        pixels : tuple, optional
+            felixPixelIndices of the masks, if already computed (see setChopMasks).
+        publish : bool, optional
+            Write the masks to the subApMasks SHM (for display). Default True.
+        stack : SubapertureStack, optional
+            Prepared SubapertureStack of the masks, if already built (see setChopMasks).
+        """
         self.subApMasks = masks
         self.xSubApOffset = offsets[0] # in case the mask isn't centered in the image
         self.ySubApOffset = offsets[1]
-        self.subApMasksShm.write(self.subApMasks)
+        self.updateGeometry(pixels, stack=stack)
+        if publish:
+            self.subApMasksShm.write(self.subApMasks)
+
+    def updateGeometry(self, pixels=None, stack=None):
+        """
+        Rebuild the SlopesGeometry from the current masks, pixel coordinates and 
+        valid subapertures, and swap it in under the next version number. Called 
+        whenever one of those changes.
+
+        Parameters
+        ----------
+        pixels : tuple, optional
+            felixPixelIndices of the current masks, if already computed.
+        stack : SubapertureStack, optional
+            Prepared SubapertureStack of the current masks, if already built.
+        """
+        masks = getattr(self, "subApMasks", None) if self.wfsType == "felix" else None
+        if self.validSubAps is not None:
+            slopesShape = self.validSubAps.shape
+        elif masks is not None:
+            N = int(np.sqrt(masks.shape[0]))
+            slopesShape = (2*N, N)
+        else:
+            return
+        #Windows for the centroid engine, prepared outside the lock as it can be slow
+        engine = self.centroidEngine
+        oldGeometry = self.geometry
+        if engine is None:
+            stack = None
+        elif stack is None:
+            if oldGeometry is not None and oldGeometry.engine is engine and oldGeometry.masks is masks:
+                stack = oldGeometry.stack
+            else:
+                stack = self.makeSubapertureStack(masks)
+        with self.geometryLock:
+            oldGeometry = self.geometry
+            if pixels is None and oldGeometry is not None and masks is not None and oldGeometry.masks is masks:
+                pixels = oldGeometry.pixels
+            self.geometryVersion += 1
+            self.geometry = SlopesGeometry(self.geometryVersion, slopesShape, self.signalDType,
+                                           validSubAps=self.validSubAps, masks=masks,
+                                           offsets=(getattr(self, "xSubApOffset", 0), getattr(self, "ySubApOffset", 0)),
+                                           xvals=getattr(self, "xvals", None), yvals=getattr(self, "yvals", None),
+                                           pixels=pixels, engine=engine, stack=stack,
+                                           imageDType=getattr(self, "imageDType", np.int32))
+        return
+
+    def makeSubapertureStack(self, masks=None):
+        """
+        Build the SubapertureStack of the FELIX masks (default the current ones) 
+        or of the SHWFS grid, prepared for the centroid engine.
+        """
+        if self.wfsType == "felix":
+            if masks is None:
+                masks = self.subApMasks
+            stack = felixSubapertureStack(masks, self.xvals, self.yvals)
+        else:
+            stack = shwfsSubapertureStack(self.imageShape, self.numRegions, self.subApSpacing, 
+                                          self.regionSize, self.offsetX, self.offsetY)
+        self.centroidEngine.prepare(stack)
+        return stack
+
+    def setCentroidEngine(self, name):
+        """
+        Switch to the centroid engine registered under name (see centroidEngine), 
+        taking effect from the next frame.
+        """
+        name = name.lower()
+        self.centroidEngine = None if name == "cog" else make_centroid_engine(name, self.conf)
+        self.centroidEngineName = name
+        self.refreshCentroidStacks()
+        return
+
+    def takeCentroidReference(self):
+        """
+        Use the current WFS image as the centroid engine's reference frame, for the 
+        weighting windows, correlation templates, etc... Take new reference slopes 
+        afterwards.
+        """
+        if self.centroidEngine is None:
+            print("The cog centroid engine does not use a reference frame")
+            return
+        self.centroidEngine.setReference(self.readImage(block=False))
+        self.refreshCentroidStacks()
+        return
+
+    def refreshCentroidStacks(self):
+        """
+        Rebuild the engine's windows of the chop positions and of the current geometry.
+        """
+        if getattr(self, "chopMasks", None) is not None:
+            self.setChopMasks(self.chopMasks, self.chopMasksOffsets)
+        if self.geometry is not None:
+            self.updateGeometry(stack=None if self.centroidEngine is None else self.makeSubapertureStack())
+        return
 
     def read(self, block = True, SAFE=True, GPU=False):
         """
@@ -714,7 +1469,7 @@ class SlopesProcess(pyRTCComponent):
             Valid sub-aperture mask.
         """
         self.validSubAps = validSubAps.astype(bool)
-        self.curSignal2D = np.zeros(validSubAps.shape)
+        self.updateGeometry()
         return
     
     def saveValidSubAps(self,filename=''):
@@ -756,24 +1511,132 @@ class SlopesProcess(pyRTCComponent):
     def takeRefSlopes(self):
         """
         Take reference slopes by averaging multiple slope measurements. Number of measurements
-        set by refSlopeCount variable.
+        set by refSlopeCount variable. The slopes must be running, they are averaged 
+        as they are computed (see startStatistics), which restarts the slopes' 
+        statistics. Raises TimeoutError if the frames stop coming, see waitForFrames.
         """
-        #Reset reference slopes to zero
-        self.setRefSlopes(np.zeros_like(self.refSlopes))
-        refSlopes = np.zeros_like(self.refSlopes)
-
-        oldGains = self.slopeBufferGains.copy()
-        self.slopeBufferGains[:] = 0 #Set gains to zero to avoid applying
-
-        #Average self.refSlopeCount slopes measurements
-        for i in range(self.refSlopeCount):
-            cur_slopes = self.read().astype(refSlopes.dtype)
-            refSlopes += self.computeSignal2D(cur_slopes)
-        refSlopes /= self.refSlopeCount
+        if not self.running:
+            raise RuntimeError("Slopes must be running to take reference slopes.")
+        stats = self.startStatistics(numFrames=self.refSlopeCount, image=False)
+        try:
+            self.waitForFrames(stats.done, self.refSlopeCount, lambda: stats.count/self.refSlopeCount)
+        except (JobCancelled, TimeoutError):
+            #Keep the reference slopes we had
+            stats.done.set()
+            raise
+        count, refSlopes, noise = self.slopeStatistics()
         self.setRefSlopes(refSlopes)
-        self.slopeBufferGains[:] = oldGains #Restore gains        
         return 
 
+    def startStatistics(self, numFrames=0, image=True):
+        """
+        Start (or restart) the running mean and variance of the slopes, and of the 
+        image pixels, over the frames computed from now on. They can be read with 
+        slopeStatistics and imageStatistics at any time.
+
+        Parameters
+        ----------
+        numFrames : int, optional
+            Stop after this many frames, 0 to run until stopStatistics. Default 0.
+        image : bool, optional
+            Also (re)start the statistics of the image pixels. If False, those 
+            already running are left alone. Default True.
+
+        Returns
+        -------
+        RunningStats
+            The slopes' statistics.
+        """
+        geometry = self.geometry
+        if image:
+            region = None if geometry is None else geometry.region
+            size = np.prod(self.imageShape) if geometry is None or geometry.crop is None else geometry.crop.size
+            self.imageStats = RunningStats(size, maxCount=numFrames, region=region)
+        self.signalStats = RunningStats(self.signalSize, maxCount=numFrames, 
+                                        offset=self.referenceSignal())
+        return self.signalStats
+
+    def stopStatistics(self):
+        """
+        Stop updating the running statistics, keeping the estimates so far.
+        """
+        for stats in (self.signalStats, self.imageStats):
+            if stats is not None:
+                stats.done.set()
+        return
+
+    def updateStatistics(self, signal, image, geometry):
+        """
+        Add the frame to the running statistics, if started. Called by computeSignal 
+        before the slope offsets are applied.
+        """
+        signalStats = self.signalStats
+        if signalStats is not None:
+            signalStats.update(signal)
+        imageStats = self.imageStats
+        if imageStats is not None and imageStats.region == geometry.region:
+            imageStats.update(image)
+        return
+
+    def referenceSignal(self):
+        """
+        The reference slopes of the valid subapertures, in the layout of the signal.
+        """
+        if self.wfsType == "pywfs":
+            return self.refSlopes1D.copy()
+        return self.refSlopes.ravel()[self.geometry.validIndices].copy()
+
+    def slopeStatistics(self):
+        """
+        Running statistics of the slopes, before reference slopes and offsets are 
+        removed, in the 2D signal layout.
+
+        Returns
+        -------
+        count : int
+            Number of frames averaged.
+        mean : numpy.ndarray
+            Mean slopes, i.e. the reference slopes of the frames averaged.
+        noise : numpy.ndarray
+            Standard deviation of the slopes of every subaperture.
+        """
+        stats = self.signalStats
+        if stats is None:
+            raise RuntimeError("No statistics, use startStatistics() first.")
+        mean = self.computeSignal2D(stats.mean.astype(self.signalDType), out=np.zeros(self.signal2DShape, dtype=self.signalDType))
+        noise = self.computeSignal2D(np.sqrt(stats.variance()).astype(self.signalDType), out=np.zeros(self.signal2DShape, dtype=self.signalDType))
+        return stats.count, mean, noise
+
+    def imageStatistics(self):
+        """
+        Running statistics of the image pixels (of the masks' bounding box for FELIX, 
+        see SlopesGeometry).
+
+        Returns
+        -------
+        count : int
+            Number of frames averaged.
+        mean, variance : numpy.ndarray
+            Mean and variance of every pixel, in the image (or crop) shape.
+        gain, readNoise : float
+            Photon transfer fit variance = mean/gain + readNoise^2 over the pixels, 
+            in counts. NaN before two frames.
+        """
+        stats = self.imageStats
+        if stats is None:
+            raise RuntimeError("No image statistics, use startStatistics() first.")
+        count = stats.count
+        mean, variance = stats.mean.copy(), stats.variance()
+        gain, readNoise = np.nan, np.nan
+        if count >= 2 and np.ptp(mean) > 0:
+            slope, intercept = np.polyfit(mean, variance, 1)
+            if slope > 0:
+                gain = 1/slope
+            readNoise = np.sqrt(max(intercept, 0.0))
+        shape = self.imageShape if stats.region is None else (stats.region[0].stop - stats.region[0].start, 
+                                                              stats.region[1].stop - stats.region[1].start)
+        return count, mean.reshape(shape), variance.reshape(shape), gain, readNoise
+
     def setRefSlopes(self, refSlopes):
         """
         Set the reference slopes.
@@ -789,6 +1652,12 @@ class SlopesProcess(pyRTCComponent):
             self.refSlopes1D = np.zeros_like(self.signal.read_noblock())
             self.refSlopes1D[:self.refSlopes1D.size//2] = self.refSlopes[:,:self.refSlopes.shape[1]//2][slopemask]
             self.refSlopes1D[self.refSlopes1D.size//2:] = self.refSlopes[:,self.refSlopes.shape[1]//2:][slopemask]
+        #The statistics add the reference back to the slopes
+        stats = getattr(self, "signalStats", None)
+        if stats is not None and self.geometry is not None:
+            refSignal = self.referenceSignal()
+            if refSignal.size == stats.size:
+                np.copyto(stats.offset, refSignal)
         
         self.refSlopesShm.write(self.refSlopes)
         return
@@ -833,78 +1702,212 @@ class SlopesProcess(pyRTCComponent):
         Compute the signal from the WFS image.
         """
         image = self.readImage(SAFE=False, GPU = False)
-        if self.signalType == "slopes":
-            if self.wfsType == "pywfs":
-                if False:#self.gpuDevice is not None:
-                    slope_signal = computeSlopesPYWFSTorch(image.ravel(),
-                                p1Mask=torch.from_numpy(self.p1mask.ravel()).to(self.gpuDevice), 
-                                p2Mask=torch.from_numpy(self.p2mask.ravel()).to(self.gpuDevice),
-                                p3Mask=torch.from_numpy(self.p3mask.ravel()).to(self.gpuDevice), 
-                                p4Mask=torch.from_numpy(self.p4mask.ravel()).to(self.gpuDevice),
-                                numPixelsInPupils = self.numPixelsInPupils, 
-                                slopes = torch.from_numpy(self.slopesArr1D).to(self.gpuDevice),
-                                refSlopes=torch.from_numpy(self.refSlopes1D).to(self.gpuDevice)).cpu().numpy()
-                else:
-                    slope_signal = computeSlopesPYWFSOptimNumba(image=image.ravel(),
-                                p1Mask=self.p1mask.ravel(), 
-                                p2Mask=self.p2mask.ravel(),
-                                p3Mask=self.p3mask.ravel(), 
-                                p4Mask=self.p4mask.ravel(),
-                                p1=self.p1, 
-                                p2=self.p2,
-                                p3=self.p3, 
-                                p4=self.p4,
-                                tmp1=self.tmp1,
-                                tmp2=self.tmp2,
-                                numPixelsInPupils = self.numPixelsInPupils, 
-                                slopes = self.slopesArr1D,
-                                refSlopes=self.refSlopes1D)
+        self.useNumbaThreads()
+        self.timeFrame()
+        if self.chopSequence is not None:
+            self.advanceChopSequence()
+        #The same geometry for the whole frame, even if it is swapped meanwhile
+        geometry = self.geometry
+        if geometry.crop is not None:
+            #Consistent copy of only the part of the frame the masks cover
+            image = self.wfsShm.readConsistent(out=geometry.crop, region=geometry.region)
+        try:
+            if self.signalType == "slopes":
+                if self.wfsType == "pywfs":
+                    #Slopes straight into the signal buffer
+                    signal = self.signalBuffer()
+                    computeSlopesPYWFSParallel(image = image.ravel(),
+                                    p1Idx = self.p1Idx, 
+                                    p2Idx = self.p2Idx,
+                                    p3Idx = self.p3Idx, 
+                                    p4Idx = self.p4Idx,
+                                    slopes = signal,
+                                    refSlopes = self.refSlopes1D)
                 
-                
-            elif self.wfsType == "shwfs":
-
-                slopes = computeSlopesSHWFSOptimNumba(image = image,
-                                            slopes = np.zeros_like(self.refSlopes), 
-                                            unaberratedSlopes = self.refSlopes,
-                                            threshold = self.imageNoise*self.shwfsContrast, 
-                                            spacing = self.subApSpacing,
-                                            xvals = self.xvals,
-                                            offsetX = self.offsetX,
-                                            offsetY = self.offsetY,
-                                            intN = self.regionSize)
-                slope_signal = slopes[self.validSubAps]
-                # self.signal.write(slopes[self.validSubAps])
-                # self.signal2D.write(slopes*self.validSubAps)
-                # slopes = np.zeros_like(self.refSlopes)
-                # self.signal.write(self.refSlopes.flatten()[:np.prod(self.signalShape)].reshape(self.signalShape))
+                elif geometry.stack is not None:
+                    #SHWFS or FELIX through the centroid engine
+                    stack = geometry.stack
+                    stack.extract(image, self.imageNoise*self.shwfsContrast, origin=geometry.origin)
+                    geometry.engine.compute(stack)
+                    slopes = centroidsToSlopes(stack.cx, stack.cy, stack.flux, stack.xOrigin, stack.yOrigin,
+                                               geometry.xOffset, geometry.yOffset, self.refSlopes, geometry.slopes)
+                    signal = self.signalBuffer()
+                    np.take(slopes.ravel(), geometry.validIndices, out=signal)
+
+                elif self.wfsType == "shwfs":
+                    #The serial kernel is faster on one thread, but skips the subapertures 
+                    #without flux. The parallel one writes them all.
+                    if self.numbaThreads > 1:
+                        kernel = computeSlopesSHWFSParallel
+                    else:
+                        kernel = computeSlopesSHWFSOptimNumba
+                        geometry.slopes.fill(0)
+                    slopes = kernel(image = image,
+                                                slopes = geometry.slopes, 
+                                                unaberratedSlopes = self.refSlopes,
+                                                threshold = self.imageNoise*self.shwfsContrast, 
+                                                spacing = self.subApSpacing,
+                                                xvals = self.xvals,
+                                                offsetX = self.offsetX,
+                                                offsetY = self.offsetY,
+                                                intN = self.regionSize)
+                    #Gather the valid slopes straight into the SHM
+                    signal = self.signalBuffer()
+                    np.take(slopes.ravel(), geometry.validIndices, out=signal)
+                    # self.signal.write(slopes[self.validSubAps])
+                    # self.signal2D.write(slopes*self.validSubAps)
+                    # slopes = np.zeros_like(self.refSlopes)
+                    # self.signal.write(self.refSlopes.flatten()[:np.prod(self.signalShape)].reshape(self.signalShape))
             
-            elif self.wfsType == "felix":
-                slopes = computeSlopesFELIX(image = image,
-                                            slopes = np.zeros_like(self.refSlopes), 
-                                            unaberratedSlopes = self.refSlopes,
-                                            threshold = self.imageNoise*self.shwfsContrast, 
-                                            masks = self.subApMasks,
-                                            xvals = self.xvals,
-                                            yvals = self.yvals,
-                                            xoffset = self.xSubApOffset,
-                                            yoffset = self.ySubApOffset,
-                                            rotationMatrix = self.rotationMatrix)
-                slope_signal = slopes[self.validSubAps]
-
-            for chan in range(self.maxSlopeOffsetsChannels):
-                idx = self.slopeOffsetsStep % self.slopeOffsetsBufferLengths[chan]
-                current_offsets = self.slopeOffsetsBuffer[chan,idx,:]
-                current_offsets = current_offsets.reshape(slope_signal.shape) * self.slopeBufferGains[chan]
-                slope_signal -= current_offsets
-            self.slopeOffsetsStep += 1
+                elif self.wfsType == "felix":
+                    indices, starts, xWeights, yWeights = geometry.cropPixels
+                    slopes = computeSlopesFELIXSparse(image = image,
+                                                slopes = geometry.slopes, 
+                                                unaberratedSlopes = self.refSlopes,
+                                                threshold = self.imageNoise*self.shwfsContrast, 
+                                                indices = indices,
+                                                starts = starts,
+                                                xWeights = xWeights,
+                                                yWeights = yWeights,
+                                                xoffset = geometry.xOffset,
+                                                yoffset = geometry.yOffset)
+                    signal = self.signalBuffer()
+                    np.take(slopes.ravel(), geometry.validIndices, out=signal)
+
+                self.updateStatistics(signal, image, geometry)
+                self.applySlopeOffsets(signal)
     
-            self.signal.write(slope_signal)
-            self.signal2D.write(self.computeSignal2D(slope_signal))
+                #Tag the slopes with the WFS frame they came from
+                upstreamId = self.wfsShm.lastUpstreamId
+                if self.fused is not None:
+                    #The correction first, the telemetry from the publisher's thread
+                    self.traceFrame("slopes", upstreamId)
+                    loopIteration = self.fused.integrate(signal, upstreamId)
+                    if loopIteration:
+                        self.traceFrame("loop", upstreamId)
+                    self.signalPublisher.submit(upstreamId, geometry, loopIteration)
+                else:
+                    self.publishSignal(signal, upstreamId, geometry)
+                    self.traceFrame("slopes", upstreamId)
+        except BaseException:
+            #Readers must not wait on a frame that was never finished. With the fused 
+            #reconstruction only the publisher's thread writes the SHM.
+            if self.signalPublisher is None:
+                self.signal.abort_write()
+            raise
+
+    def signalBuffer(self):
+        """
+        The array to compute the signal of this frame into: the signal SHM's write 
+        buffer, or the publisher's buffer with the fused reconstruction.
+        """
+        if self.signalPublisher is not None:
+            return self.signalPublisher.buffer()
+        return self.signal.acquire_write_buffer()
+
+    def publishSignal(self, signal, upstreamId, geometry, loopIteration=False):
+        """
+        Write signal and its 2D version to the signal SHMs, tagged with the WFS frame 
+        they came from, then the "loop" SHM if the fused reconstruction integrated 
+        signal.
+
+        Parameters
+        ----------
+        signal : numpy.ndarray
+            1D signal, the signal SHM's write buffer or a copy.
+        upstreamId : int
+            Id of the WFS frame the signal was computed from.
+        geometry : SlopesGeometry
+            Geometry the signal was computed with.
+        loopIteration : bool, optional
+            Whether the fused reconstruction integrated signal. Default False.
+        """
+        self.signal.write(signal, upstreamId=upstreamId)
+        with self.signal2D.writing() as signal2D:
+            self.computeSignal2D(signal, out=signal2D, geometry=geometry)
+            self.signal2D.commit(upstreamId=upstreamId)
+        self.lastGeometryVersion = geometry.version
+        if loopIteration and self.fused is not None:
+            self.fused.publishLoopParams(upstreamId)
+        return
+
+    def setFusedReconstruction(self):
+        """
+        Start the fused reconstruction (see fusedReconstruction). Needs the "wfc", 
+        "cmat", "loop" and "wfsInfo" SHMs, i.e. the corrector, the Loop and the WFS 
+        running. Cannot be undone 
+        without restarting the component.
+        """
+        if self.fused is not None:
+            return
+        self.fused = FusedReconstructor(self.signalSize, self.fusedGain, self.fusedLeak, 
+                                        gpuDevice = self.gpuDevice)
+        self.signalPublisher = SignalPublisher(self.publishSignal, self.signalShape, self.signalDType)
+        self.fusedReconstruction = True
+        return
+
+    def setFusedLoop(self, closed):
+        """
+        Close (True) or open (False) the fused reconstruction's loop. Closing fails 
+        while another process (i.e. a started Loop) writes the wfc SHM, and the Loop 
+        cannot be started while the fused loop is closed.
+        """
+        if self.fused is None:
+            print("Fused reconstruction is not enabled")
+            return -1
+        #Only one process may write the wfc SHM, the Loop must be stopped
+        if closed and not self.fused.wfcShm.claimWriter():
+            print(f"wfc is being written by PID {self.fused.wfcShm.otherWriter()}, not closing the loop")
+            return -1
+        self.fused.closed = bool(closed)
+        if not closed:
+            self.fused.wfcShm.releaseWriter()
+        return 1
+
+    def setFusedGain(self, gain):
+        """
+        Set the fused reconstruction's integrator gain.
+        """
+        self.fusedGain = gain
+        if self.fused is not None:
+            self.fused.setGain(gain)
+        return
+
+    def setFusedLeak(self, leak):
+        """
+        Set the fused reconstruction's integrator leak.
+        """
+        self.fusedLeak = leak
+        if self.fused is not None:
+            self.fused.leak = leak
+        return
     
+    def useNumbaThreads(self):
+        """
+        Set the number of numba threads the slope kernels use to numbaThreads. 
+        numba keeps this per thread, so it is set once in each thread computing 
+        the signal. With numbaThreads > 1 the thread is first moved to the 
+        numbaAffinity cores, which numba's threads inherit when they are started.
+        """
+        if getattr(self.numbaThreadState, "numThreads", None) != self.numbaThreads:
+            if self.numbaThreads > 1 and len(self.numbaAffinity) > 0 and hasattr(os, "sched_setaffinity"):
+                #0 is the calling thread, not the whole process
+                os.sched_setaffinity(0, [int(core) % os.cpu_count() for core in self.numbaAffinity])
+            numba.set_num_threads(self.numbaThreads)
+            self.numbaThreadState.numThreads = self.numbaThreads
+        return
+
     def computeImageNoise(self):
         """
-        Compute the image noise. Useful to set a good SNR cutoff for SHWFS
+        Compute the image noise. Useful to set a good SNR cutoff for SHWFS. Uses the 
+        median temporal standard deviation of the pixels if the image statistics 
+        have at least two frames (see startStatistics), otherwise the spread of the 
+        negative pixels of the current dark subtracted frame.
         """
+        stats = self.imageStats
+        if stats is not None and stats.count >= 2:
+            self.imageNoise = float(np.median(np.sqrt(stats.variance())))
+            return
         img = self.readImage()
         if img[img < 0].size > 0:
             self.imageNoise = compute_fwhm_dark_subtracted_image(img)/2
@@ -935,7 +1938,8 @@ class SlopesProcess(pyRTCComponent):
             if self.validSubApsFile != "":
                 self.saveValidSubAps()
             self.signal2DShape = (self.validSubAps.shape[0], self.validSubAps.shape[1])
-            self.signal = ImageSHM("signal", (self.signalSize,), self.signalDType, gpuDevice=self.gpuDevice, consumer = False)
+            self.signalShape = (self.signalSize,)
+            self.signal = self.createSignalShm(self.signalShape)
             self.signal2D = ImageSHM("signal2D", self.signal2DShape, self.signalDType, gpuDevice=self.gpuDevice, consumer = False)
             
         return
@@ -974,6 +1978,12 @@ class SlopesProcess(pyRTCComponent):
         self.p2mask = self.pupilMask == 2
         self.p3mask = self.pupilMask == 3
         self.p4mask = self.pupilMask == 4
+        #Pixel lists for computeSlopesPYWFSParallel
+        self.p1Idx = np.flatnonzero(self.p1mask)
+        self.p2Idx = np.flatnonzero(self.p2mask)
+        self.p3Idx = np.flatnonzero(self.p3mask)
+        self.p4Idx = np.flatnonzero(self.p4mask)
+        self.numPixelsInPupils = self.p1Idx.size
         return
 
     def plotPupils(self):
@@ -997,7 +2007,7 @@ class SlopesProcess(pyRTCComponent):
         plt.show()
         return
 
-    def computeSignal2D(self, signal, validSubAps=None):
+    def computeSignal2D(self, signal, validSubAps=None, out=None, geometry=None):
         """
         Compute the 2D signal from the valid sub-aperture mask.
 
@@ -1007,25 +2017,64 @@ class SlopesProcess(pyRTCComponent):
             Signal to process.
         validSubAps : numpy.ndarray, optional
             Valid sub-aperture mask. If not provided, uses the current valid sub-aperture mask.
+        out : numpy.ndarray, optional
+            Array to write the 2D signal into (e.g. the signal2D SHM buffer). Defaults 
+            to an internal buffer.
+        geometry : SlopesGeometry, optional
+            Geometry signal was computed with. Defaults to the current geometry.
 
         Returns
         -------
         numpy.ndarray
             2D signal.
         """
-        if validSubAps is None and isinstance(self.validSubAps, np.ndarray):
-            validSubAps = self.validSubAps
+        if geometry is None:
+            geometry = self.geometry
+        if validSubAps is None and geometry is not None and geometry.validSubAps is not None:
+            validSubAps = geometry.validSubAps
         else:
             return -1
+        if out is None:
+            out = geometry.signal2D
+        else:
+            out.fill(0)
         
         if self.wfsType == "pywfs":
             slopemask = validSubAps[:,:validSubAps.shape[1]//2]
-            self.curSignal2D[:,:validSubAps.shape[1]//2][slopemask] = signal[:signal.size//2]
-            self.curSignal2D[:,validSubAps.shape[1]//2:][slopemask] = signal[signal.size//2:]
+            out[:,:validSubAps.shape[1]//2][slopemask] = signal[:signal.size//2]
+            out[:,validSubAps.shape[1]//2:][slopemask] = signal[signal.size//2:]
         else:
-            self.curSignal2D[self.validSubAps] = signal
-        return self.curSignal2D
+            np.put(out, geometry.validIndices, signal)
+        return out
     
+    def applySlopeOffsets(self, signal):
+        """
+        Subtract the current step of every slope offset channel with a non-zero gain 
+        from signal, weighted by its gain, then advance one step.
+
+        Parameters
+        ----------
+        signal : numpy.ndarray
+            1D signal, modified in place.
+        """
+        numChannels = self.slopeOffsetsBuffer.shape[0]
+        channels = np.flatnonzero(self.slopeBufferGains[:numChannels])
+        if channels.size > 0:
+            steps = self.slopeOffsetsStep % self.slopeOffsetsBufferLengths[channels]
+            gains = self.slopeBufferGains[channels]
+            if self.slopeOffsetsLazy:
+                #Only read the rows we need from the file, into native float32
+                rows = self.slopeOffsetsRows
+                for k in range(channels.size):
+                    rows[k, 0] = self.slopeOffsetsBuffer[channels[k], steps[k]]
+                channels = np.arange(channels.size)
+                steps = np.zeros_like(steps)
+                subtractSlopeOffsets(signal, rows, channels, steps, gains)
+            else:
+                subtractSlopeOffsets(signal, self.slopeOffsetsBuffer, channels, steps, gains)
+        self.slopeOffsetsStep += 1
+        return
+
     def setModalSlopeOffsets(self):
         """
         """
@@ -1040,6 +2089,130 @@ class SlopesProcess(pyRTCComponent):
     def setChopMasks(self, chopMasks, offsets):
         self.chopMasks = chopMasks
         self.chopMasksOffsets = offsets
+        #Index every chop position's pixels up front, so chopping only swaps geometries
+        self.chopMasksPixels = None
+        self.chopMasksStacks = None
+        if chopMasks is not None:
+            self.chopMasksPixels = [felixPixelIndices(masks, self.xvals, self.yvals) for masks in chopMasks]
+            if self.centroidEngine is not None:
+                self.chopMasksStacks = [self.makeSubapertureStack(masks) for masks in chopMasks]
+
+    def setChopPosition(self, n, publish=True):
+        """
+        Set the subaperture masks to chop position n of the loaded chop masks.
+
+        Parameters
+        ----------
+        n : int
+            Index of the chop position.
+        publish : bool, optional
+            Write the masks to the subApMasks SHM. Default True. While a chop 
+            sequence plays only the index is published, to the chopIndex SHM.
+        """
+        self.setSubApMasks(self.chopMasks[n], self.chopMasksOffsets[n], 
+                           pixels=self.chopMasksPixels[n], publish=publish,
+                           stack=None if self.chopMasksStacks is None else self.chopMasksStacks[n])
+        return
+
+    def timeFrame(self):
+        """
+        Update the smoothed time between frames, see frameRate.
+        """
+        now = time.monotonic()
+        if self.lastFrameTime is not None:
+            period = now - self.lastFrameTime
+            if self.framePeriod == 0.0 or period > 10*self.framePeriod:
+                #First frame, or the first after a pause
+                self.framePeriod = period
+            else:
+                self.framePeriod += 0.01*(period - self.framePeriod)
+        self.lastFrameTime = now
+        return
+
+    def frameRate(self):
+        """
+        Rate (Hz) at which computeSignal is currently running, 0 if unknown.
+        """
+        if self.framePeriod <= 0.0:
+            return 0.0
+        return 1/self.framePeriod
+
+    def advanceChopSequence(self):
+        """
+        Called by computeSignal before each frame: switch to the next chop position 
+        when the current one has been held for its frames. Only the chop index is 
+        published while the sequence plays, the final masks once it is finished.
+        """
+        sequence = self.chopSequence
+        position = sequence.advance()
+        if position is not None:
+            self.setChopPosition(position, publish=False)
+            self.chopIndexShm.write(np.array([position], dtype=np.int64))
+        if sequence.isLastFrame():
+            self.chopSequence = None
+            self.subApMasksShm.write(self.subApMasks)
+            self.chopIndexShm.write(np.array([-1], dtype=np.int64))
+            sequence.finished.set()
+        return
+
+    def playChopSequence(self, positions, holdFrames):
+        """
+        Step through chop positions in sync with the WFS frames, holding each for 
+        a number of frames, and wait until done. The slopes must be running. Raises 
+        TimeoutError if the frames stop coming, see waitForFrames.
+
+        Parameters
+        ----------
+        positions : array_like
+            Chop mask index of each step.
+        holdFrames : array_like
+            Number of frames to hold each step for.
+        """
+        if self.chopMasks is None or self.chopMasksOffsets is None:
+            raise ValueError("No chop masks loaded. Use loadChopMasks() to set the chop positions.")
+        if not self.running:
+            raise RuntimeError("Slopes must be running to chop, chop positions advance on WFS frames.")
+        sequence = ChopSequence(positions, holdFrames)
+        if sequence.totalFrames == 0:
+            return
+        self.chopSequence = sequence
+        try:
+            self.waitForFrames(sequence.finished, sequence.totalFrames, sequence.progress)
+        except (JobCancelled, TimeoutError):
+            #Stay at the current chop position
+            if self.chopSequence is sequence:
+                self.chopSequence = None
+            self.subApMasksShm.write(self.subApMasks)
+            self.chopIndexShm.write(np.array([-1], dtype=np.int64))
+            raise
+        return
+
+    def waitForFrames(self, done, numFrames, progress):
+        """
+        Wait until the event done is set by computeSignal after numFrames frames, 
+        reporting progress() (0 to 1) to the job running this, if any.
+
+        Raises TimeoutError after twice the time the frames take at the current frame 
+        rate, plus frameWaitMargin seconds, e.g. if the WFS stopped.
+        """
+        start = time.monotonic()
+        while not done.wait(timeout=0.05):
+            self.reportProgress(progress())
+            deadline = start + 2*numFrames*self.framePeriod + self.frameWaitMargin
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Only {progress():.0%} of {numFrames} frames after "
+                                   f"{time.monotonic() - start:.1f}s, is the WFS running?")
+        return
+
+    def framesFor(self, duration):
+        """
+        Number of WFS frames (at least 1) lasting duration seconds at the current 
+        frame rate.
+        """
+        rate = self.frameRate()
+        if rate == 0.0:
+            raise RuntimeError("Frame rate unknown, the slopes have not run yet.")
+        return max(int(round(duration*rate)), 1)
 
     def loadChopMasks(self,filename=''):
         """
@@ -1075,6 +2248,11 @@ class SlopesProcess(pyRTCComponent):
             Fraction of the time spent ramping between chop positions, including
             both ends of the chop. For example, rampFraction=0.2 means 10% of the time
             is spent ramping up and 10% ramping down.
+        numIter : int
+            Number of chop cycles.
+
+        The masks change on WFS frames (see playChopSequence), the times are 
+        converted to frames at the current frame rate.
         """
         if self.wfsType != "felix":
             raise ValueError("chopSubaps is only implemented for Felix.")
@@ -1087,26 +2265,26 @@ class SlopesProcess(pyRTCComponent):
         # Time at one end of the chop
         dt_ontarget = (1 - rampFraction) / freq / 2
 
-        t = 0.
-        isBackwards = False
-        scheduler = sched.scheduler(time.time, time.sleep)
+        # In WFS frames, so the chop stays in phase with the exposures
+        rampFrames = self.framesFor(dt_ramp)
+        onTargetFrames = int(round(dt_ontarget * self.frameRate()))
 
+        positions = []
+        holdFrames = []
+        isBackwards = False
         for i in range(numIter):
             for j in range(2): # two halves of the chop
                 for n in range(numMasks):
                     if isBackwards:
                         # increment n backwards to chop back to starting position
                         n = numMasks - n - 1
-                    masks = self.chopMasks[n]
-                    offsets = self.chopMasksOffsets[n]
-                    scheduler.enter(t, 1, self.setSubApMasks, (masks, offsets))
-                    t += dt_ramp
+                    positions.append(n)
+                    holdFrames.append(rampFrames)
                 # Stay at the end position
-                t += dt_ontarget
+                holdFrames[-1] += onTargetFrames
                 isBackwards = not isBackwards
 
-        scheduler.run()
-
+        self.playChopSequence(positions, holdFrames)
 
     def chopSubApsToPosition(self, pattern, rampLength):
         """Changes the masks to chop subapertures to position A or B or middle.
@@ -1119,7 +2297,8 @@ class SlopesProcess(pyRTCComponent):
                 "AM" = start to middle (A to M)
                 ""
         rampLength : float
-            Length the full ramp between positions A and B (seconds).
+            Length the full ramp between positions A and B (seconds), converted 
+            to WFS frames at the current frame rate.
         """
         valid_patterns = ["AB", "BA", "AM", "BM", "MA", "MB"]
         pattern = pattern.upper().strip()
@@ -1131,33 +2310,27 @@ class SlopesProcess(pyRTCComponent):
             raise ValueError("No chop masks loaded. Use loadChopMasks() to set the chop positions.")
         numMasks = self.chopMasks.shape[0]
 
-        t = 0.
-        dt_ramp = rampLength / numMasks
-        scheduler = sched.scheduler(time.time, time.sleep)
+        rampFrames = self.framesFor(rampLength / numMasks)
 
+        # Index of the first chop position on the way
         if "M" in pattern:
             niter = numMasks // 2
             if "B" in pattern:
-                masksToPos = self.chopMasks[niter:]
-                offsetsToPos = self.chopMasksOffsets[niter:]
+                firstPos = niter
             else:
-                masksToPos = self.chopMasks[:niter+1]  #add 1 to end at middle mask (same position as above)
-                offsetsToPos = self.chopMasksOffsets[:niter+1]
+                firstPos = 0  #niter+1 positions, to end at middle mask (same position as above)
         else:
             niter = numMasks
-            masksToPos = self.chopMasks
-            offsetsToPos = self.chopMasksOffsets
+            firstPos = 0
 
+        positions = []
         for n in range(niter):
             if pattern.startswith("B") or pattern == "MA":
                 # increment n backwards to chop back to starting position
                 n = niter - n - 1
-            masks = masksToPos[n]
-            offsets = offsetsToPos[n]
-            scheduler.enter(t, 1, self.setSubApMasks, (masks, offsets))
-            t += dt_ramp
+            positions.append(firstPos + n)
 
-        scheduler.run()
+        self.playChopSequence(positions, [rampFrames]*len(positions))
 
     def loadSlopeOffsetsBuffer(self, filename):
         """
@@ -1169,8 +2342,11 @@ class SlopesProcess(pyRTCComponent):
             File to load the slope offsets from.
         """
         # Set up
-        self.slopeOffsetsBuffer = np.zeros((self.maxSlopeOffsetsChannels, 1 ,self.signalShape[0]))
-        self.slopeOffsetsBufferLengths = np.ones(self.maxSlopeOffsetsChannels, dtype=int)
+        self.slopeOffsetsBuffer = np.zeros((self.maxSlopeOffsetsChannels, 1 ,self.signalShape[0]), dtype=np.float32)
+        self.slopeOffsetsBufferLengths = np.ones(self.maxSlopeOffsetsChannels, dtype=np.int64)
+        # Rows gathered from a memory mapped buffer each frame
+        self.slopeOffsetsRows = np.zeros((self.maxSlopeOffsetsChannels, 1, self.signalShape[0]), dtype=np.float32)
+        self.slopeOffsetsLazy = False
         
         if filename == '':
             filename = self.slopeOffsetsBufferFile
@@ -1182,17 +2358,24 @@ class SlopesProcess(pyRTCComponent):
                 return
             
             # Same file format as for imaka RTC
-            soff = fits.getdata(filename, ext=0)
+            soff = fits.getdata(filename, ext=0, memmap=self.slopeOffsetsMemmap)
             numSlopes = soff.shape[2]
             if numSlopes != self.signalShape[0]:
                 print(f"Slope offsets buffer does not match the number of slopes. Got {numSlopes}, expected {self.signalShape[0]}. Setting to zeros.")
                 return
 
-            self.slopeOffsetsBuffer = soff
+            # Extra channels are never played
+            soff = soff[:self.maxSlopeOffsetsChannels]
+            if self.slopeOffsetsMemmap:
+                self.slopeOffsetsBuffer = soff
+            else:
+                # Native float32, as the kernel reads it
+                self.slopeOffsetsBuffer = np.ascontiguousarray(soff, dtype=np.float32)
+            self.slopeOffsetsLazy = self.slopeOffsetsMemmap
             header = fits.getheader(filename, ext=0)
             maxLength = self.slopeOffsetsBuffer.shape[1]
 
-            for i in range(self.maxSlopeOffsetsChannels):
+            for i in range(self.slopeOffsetsBuffer.shape[0]):
                 key = 'PBSOFF' + str(i).zfill(2)
                 if key in header.keys():
                     self.slopeOffsetsBufferLengths[i] = header[key]
@@ -7,7 +7,7 @@ os.environ["OPENBLAS_NUM_THREADS"] = "1"
 os.environ["MKL_NUM_THREADS"] = "1" 
 os.environ["VECLIB_MAXIMUM_THREADS"] = "1" 
 os.environ["NUMEXPR_NUM_THREADS"] = "1" 
-os.environ['NUMBA_NUM_THREADS'] = '1'
+os.environ.setdefault('NUMBA_NUM_THREADS', '1') # the slopes may need more, see SlopesProcess
 os.environ['TBB_NUM_THREADS'] = '1'
 
 from pyRTC.Pipeline import *
@@ -359,7 +359,9 @@ class WavefrontCorrector(pyRTCComponent):
         #If we have a 2D SHM instance, update it 
         if isinstance(self.correctionVector2D, ImageSHM):
             self.correctionVector2D_template[self.layout] = self.currentShape - self.flat
-            self.correctionVector2D.write(self.correctionVector2D_template)
+            self.correctionVector2D.write(self.correctionVector2D_template, 
+                                          upstreamId=self.correctionVector.lastUpstreamId)
+        self.traceFrame("wfc", self.correctionVector.lastUpstreamId)
         #Overwrite with hardware instructions after this to send to hardware
         return
 
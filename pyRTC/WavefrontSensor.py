@@ -166,11 +166,11 @@ class WavefrontSensor(pyRTCComponent):
 
         self.initWFSMemory()
         
-        # param 1 is difference from previous timestamp
+        # param 1 is difference from previous timestamp (monotonic clock)
         # param 2 is absolute time
         self.wfsInfo = ImageSHM("wfsInfo", (2,), 'i8', gpuDevice = self.gpuDevice, consumer=False)
-        self.oldTimestamp = get_time_usec()
-        self.wfsInfo.write(np.array([0, self.oldTimestamp], dtype='i8'))
+        self.oldTimestamp = get_monotonic_usec()
+        self.wfsInfo.write(np.array([0, get_time_usec()], dtype='i8'))
         self.loadDark()
 
         return
@@ -263,18 +263,24 @@ class WavefrontSensor(pyRTCComponent):
         """
         Writes the current image data to shared memory. Both raw, and dark subtracted.
         """
-        newTime = get_time_usec()
-        dt = newTime - self.oldTimestamp
-        self.wfsInfo.write( np.array([dt, newTime], dtype='i8') )
-        self.oldTimestamp = newTime
+        newTimestamp = get_monotonic_usec()
+        dt = newTimestamp - self.oldTimestamp
+        self.wfsInfo.write( np.array([dt, get_time_usec()], dtype='i8') )
+        self.oldTimestamp = newTimestamp
 
+        #The raw frame starts the pipeline, everything downstream carries its id
         self.imageRaw.write(self.data)
-        img = self.data.astype(self.imageDType)
+        rawFrameId = self.imageRaw.lastWrittenId
         if self.downsampleFactor > 0:
-            self.image.write(downsample_int32_image_jit(img - self.dark, 
-                                                        self.downsampleFactor))
+            img = self.data.astype(self.imageDType)
+            self.image.write(downsample_int32_image_jit(img - self.dark,
+                                                        self.downsampleFactor), upstreamId=rawFrameId)
         else:
-            self.image.write(img - self.dark)
+            #Dark subtract straight into the SHM
+            with self.image.writing() as img:
+                np.subtract(self.data, self.dark, out=img, casting="unsafe")
+                self.image.commit(upstreamId=rawFrameId)
+        self.traceFrame("expose", rawFrameId)
         return
 
     def read(self, block = True) -> None:
@@ -309,10 +315,16 @@ class WavefrontSensor(pyRTCComponent):
         """
         Captures and sets the dark frame.
         """
+        oldDark = self.dark
         self.setDark(np.zeros_like(self.dark))
         dark = np.zeros(self.imageRawShape, dtype=np.float64)
-        for i in range(self.darkCount):
-            dark += self.readRaw().astype(np.float64)
+        try:
+            for i in range(self.darkCount):
+                self.reportProgress(i/self.darkCount)
+                dark += self.readRaw().astype(np.float64)
+        except JobCancelled:
+            self.dark = oldDark
+            raise
         dark /= self.darkCount
         self.setDark(dark)        
         return 
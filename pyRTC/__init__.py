@@ -8,6 +8,7 @@ from .Modulator import *
 from .Optimizer import *
 from .utils import *
 from .Pipeline import *
+from .LatencyTrace import *
 from .pyRTCComponent import *
 from .Telemetry import *
 from .ImakaTelemetry import *
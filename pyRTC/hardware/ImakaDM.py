@@ -4,7 +4,7 @@ os.environ["OPENBLAS_NUM_THREADS"] = "1"
 os.environ["MKL_NUM_THREADS"] = "1" 
 os.environ["VECLIB_MAXIMUM_THREADS"] = "1" 
 os.environ["NUMEXPR_NUM_THREADS"] = "1" 
-os.environ['NUMBA_NUM_THREADS'] = '1'
+os.environ.setdefault('NUMBA_NUM_THREADS', '1') # the slopes may need more, see SlopesProcess
 
 from pyRTC.WavefrontCorrector import *
 from pyRTC.Pipeline import *
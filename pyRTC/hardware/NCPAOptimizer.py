@@ -48,12 +48,13 @@ class NCPAOptimizer(Optimizer):
             refSlopes = self.origRefSlopes + refSlopesAdjust
             #save to file so process can load
             np.save(self.newRefSlopesFile, refSlopes)
-            #Load new reference slopes
-            self.slopes.setProperty("refSlopesFile", self.newRefSlopesFile)
-            self.slopes.run("loadRefSlopes")
-            #Reset where we get our reference slopes from. This is to ensure
-            #that for subsequent optimizations we have the same initial starting point
-            self.slopes.setProperty("refSlopesFile", self.refSlopesFile)
+            #Load new reference slopes, then reset where we get our reference slopes 
+            #from. This is to ensure that for subsequent optimizations we have the same 
+            #initial starting point. Sent as one batch, the slopes apply them in order
+            with self.slopes.batch() as b:
+                b.setProperty("refSlopesFile", self.newRefSlopesFile)
+                b.run("loadRefSlopes")
+                b.setProperty("refSlopesFile", self.refSlopesFile)
         # In OL, just write directly to mirror shape
         else:
             self.wfcShm.write(modalCoefs)
@@ -143,5 +144,4 @@ if __name__ == "__main__":
 
     l = Listener(component, port = int(args.port))
     while l.running:
-        l.listen()
-        time.sleep(1e-3)
\ No newline at end of file
+        l.listen()
\ No newline at end of file
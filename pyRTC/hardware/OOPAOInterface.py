@@ -303,5 +303,4 @@ if __name__ == "__main__":
     
     l = Listener(sim, port= int(args.port))
     while l.running:
-        l.listen()
-        time.sleep(1e-3)
\ No newline at end of file
+        l.listen()
\ No newline at end of file
@@ -613,7 +613,7 @@ class basicPredictLoop(Loop):
         if self.gpuDevice is None:
             newCorrection = newCorrection.cpu().numpy()
         #Send to the WFC
-        self.sendToWfc(newCorrection, slopes=None)
+        self.sendToWfc(newCorrection, slopes=None, upstreamId=self.signalShm.lastUpstreamId)
 
         return
 
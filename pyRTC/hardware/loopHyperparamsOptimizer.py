@@ -61,9 +61,7 @@ class loopOptimizer(Optimizer):
 
     def objective(self, trial):
         
-        self.loop.run("stop")
-        for i in range(10):
-            self.loop.run("flatten")
+        wait_all([self.loop.runAsync("stop")] + [self.loop.runAsync("flatten") for i in range(10)])
         self.applyTrial(trial)
         self.loop.run("start")
 
@@ -77,13 +75,14 @@ class loopOptimizer(Optimizer):
     
     def applyTrial(self, trial):
 
-        for i, param in enumerate(self.params):
-            if self.types[i] == float:
-                self.loop.setProperty(param, trial.suggest_float(param, self.mins[i], self.maxs[i]))
-            elif self.types[i] == int:
-                self.loop.setProperty(param, trial.suggest_int(param, self.mins[i], self.maxs[i]))
-
-        self.loop.run("loadIM")
+        #Send every parameter and the reload as one batch, the loop applies them in order
+        with self.loop.batch() as b:
+            for i, param in enumerate(self.params):
+                if self.types[i] == float:
+                    b.setProperty(param, trial.suggest_float(param, self.mins[i], self.maxs[i]))
+                elif self.types[i] == int:
+                    b.setProperty(param, trial.suggest_int(param, self.mins[i], self.maxs[i]))
+            b.run("loadIM")
 
         return super().applyTrial(trial)
 
@@ -138,5 +137,4 @@ if __name__ == "__main__":
 
     l = Listener(component, port = int(args.port))
     while l.running:
-        l.listen()
-        time.sleep(1e-3)
\ No newline at end of file
+        l.listen()
\ No newline at end of file
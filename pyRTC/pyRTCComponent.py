@@ -2,6 +2,7 @@
 pyRTC Component Superclass
 """
 from pyRTC.Pipeline import *
+from pyRTC.LatencyTrace import LatencyTrace
 from pyRTC.utils import *
 import threading
 import argparse
@@ -33,6 +34,25 @@ class pyRTCComponent:
         The CPU affinity for the component. Default is 0.
     functions : list
         A list of functions to run in separate threads. Default is an empty list.
+    shmNotify : bool
+        Block on event driven wakeups when waiting for new shared memory data, 
+        instead of sleep-polling. Default is True.
+    latencyTrace : bool
+        Stamp the frames this component processes into the shared LatencyTrace, 
+        see pyRTCView/traceLatency.py. Default is False.
+    rpcTransport : str
+        How the component is controlled when launched by a hardwareLauncher: "tcp" 
+        (the default, also works remotely) or "unix" for a unix socket named after 
+        the component, which is faster and needs no port.
+    shmPrefault : bool
+        Touch every page of the shared memory this component maps, so the first 
+        writes and reads do not page fault. Default is False.
+    shmLock : bool
+        mlock the shared memory this component maps so it is never swapped out. 
+        Needs a large enough memlock limit (ulimit -l). Default is False.
+    shmHugePages : bool
+        Ask for the shared memory this component maps to be backed by transparent 
+        huge pages, where the kernel allows it. Default is False.
 
     Attributes
     ----------
@@ -47,6 +67,8 @@ class pyRTCComponent:
         Start the registered real-time functions.
     stop():
         Stop the registered real-time functions.
+    reportProgress(fraction):
+        Report the progress of a function running as a job.
     """
     def __init__(self, conf) -> None:
         """
@@ -58,11 +80,25 @@ class pyRTCComponent:
             Configuration dictionary for the component. The following keys are used:
             - affinity (int, optional): The CPU affinity for the component. Default 0.
             - functions (list, optional): A list of functions to run in separate threads. Default is an empty list.
+            - shmNotify (bool, optional): Use event driven wakeups for shared memory reads. Default True.
+            - latencyTrace (bool, optional): Stamp processed frames into the shared LatencyTrace. Default False.
+            - shmPrefault (bool, optional): Prefault shared memory when it is mapped. Default False.
+            - shmLock (bool, optional): mlock shared memory when it is mapped. Default False.
+            - shmHugePages (bool, optional): Back shared memory with huge pages where possible. Default False.
         """
         self.alive = True
         self.running = False
         self.affinity = setFromConfig(conf, "affinity", 0)
         self.gpuDevice = setFromConfig(conf, "gpuDevice", None)
+        #Applies to every ImageSHM opened by this process from now on
+        self.shmNotify = setFromConfig(conf, "shmNotify", ImageSHM.NOTIFY)
+        ImageSHM.NOTIFY = self.shmNotify
+        ImageSHM.PREFAULT = setFromConfig(conf, "shmPrefault", ImageSHM.PREFAULT)
+        ImageSHM.LOCK_MEMORY = setFromConfig(conf, "shmLock", ImageSHM.LOCK_MEMORY)
+        ImageSHM.HUGE_PAGES = setFromConfig(conf, "shmHugePages", ImageSHM.HUGE_PAGES)
+        self.latencyTrace = None
+        if setFromConfig(conf, "latencyTrace", False):
+            self.latencyTrace = LatencyTrace()
 
         # if self.gpuDevice is not None:
         #     self.gpuDevice = torch.device(self.gpuDevice)
@@ -106,6 +142,25 @@ class pyRTCComponent:
         self.running = False
         return
 
+    def traceFrame(self, stage, frameId):
+        """
+        Stamp frameId (an upstream WFS frame id) for stage into the LatencyTrace, if 
+        tracing is enabled.
+        """
+        if self.latencyTrace is not None:
+            self.latencyTrace.stamp(stage, frameId)
+        return
+
+    def reportProgress(self, fraction):
+        """
+        Report how much (0 to 1) of a long running function is done, when it was 
+        started as a job (hardwareLauncher.startJob). Raises JobCancelled if the job 
+        has been cancelled, so call it where stopping is safe. Does nothing 
+        otherwise.
+        """
+        report_progress(fraction)
+        return
+
 if __name__ == "__main__":
 
     launchComponent(pyRTCComponent, "component", start = True)
\ No newline at end of file
@@ -10,6 +10,8 @@ import socket
 from datetime import datetime
 import time 
 import logging
+import ctypes
+import platform
 import matplotlib
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
 
@@ -26,6 +28,104 @@ NP_DATA_TYPES = [
 ]
 
 
+# futex(2) syscall numbers, used for cross-process wakeups on shared memory
+FUTEX_SYSCALL_NUMBERS = {
+    "x86_64": 202,
+    "amd64": 202,
+    "aarch64": 98,
+    "arm64": 98,
+    "i386": 240,
+    "i686": 240,
+}
+FUTEX_WAIT = 0
+FUTEX_WAKE = 1
+FUTEX_WAKE_ALL = 2**31 - 1
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+try:
+    if sys.platform != 'linux':
+        raise OSError("futex is only available on linux")
+    _SYS_futex = FUTEX_SYSCALL_NUMBERS[platform.machine().lower()]
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _libc.syscall.restype = ctypes.c_long
+    FUTEX_AVAILABLE = True
+except (OSError, KeyError, AttributeError):
+    FUTEX_AVAILABLE = False
+
+def futex_wait(address, expected, timeout=None):
+    """
+    Block until the 32 bit word at address is woken, or timeout seconds elapse. Returns
+    immediately if the word no longer holds the expected value. The GIL is released
+    while waiting.
+    """
+    if timeout is None:
+        ts = None
+    else:
+        timeout = max(float(timeout), 0.0)
+        ts = ctypes.byref(_timespec(int(timeout), int((timeout % 1) * 1e9)))
+    return _libc.syscall(_SYS_futex, ctypes.c_void_p(address), FUTEX_WAIT,
+                         ctypes.c_int(expected), ts, None, 0)
+
+def futex_wake(address, count=FUTEX_WAKE_ALL):
+    """
+    Wake up to count processes/threads waiting on the 32 bit word at address.
+    """
+    return _libc.syscall(_SYS_futex, ctypes.c_void_p(address), FUTEX_WAKE,
+                         ctypes.c_int(count), None, None, 0)
+
+def mlock_memory(address, size):
+    """
+    Lock size bytes at address (page aligned) into RAM with mlock(2), so they are 
+    never swapped out. Returns True on success, False if the platform or the 
+    RLIMIT_MEMLOCK limit does not allow it.
+    """
+    if sys.platform != 'linux':
+        return False
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.mlock(ctypes.c_void_p(address), ctypes.c_size_t(size)) != 0:
+        logging.log(level=logging.WARNING, msg=f"mlock of {size} bytes failed: {os.strerror(ctypes.get_errno())}")
+        return False
+    return True
+
+def shmem_huge_page_size():
+    """
+    Size in bytes of the transparent huge pages shared memory (tmpfs) mappings get 
+    after madvise(MADV_HUGEPAGE), 0 if /sys/kernel/mm/transparent_hugepage/shmem_enabled 
+    does not allow them (never, deny) or the platform has none.
+    """
+    try:
+        with open("/sys/kernel/mm/transparent_hugepage/shmem_enabled") as file:
+            #The mode in use is in brackets, e.g. "always within_size advise [never] deny force"
+            mode = file.read().split("[")[1].split("]")[0]
+        with open("/sys/kernel/mm/transparent_hugepage/hpage_pmd_size") as file:
+            size = int(file.read())
+    except (OSError, IndexError, ValueError):
+        return 0
+    if mode not in ("always", "within_size", "advise", "force"):
+        return 0
+    return size
+
+def mapped_huge_page_bytes(address):
+    """
+    Bytes of the shared memory mapping containing address which are mapped with 
+    huge pages (ShmemPmdMapped in /proc/self/smaps), 0 if it cannot be read.
+    """
+    try:
+        with open("/proc/self/smaps") as file:
+            inMapping = False
+            for line in file:
+                fields = line.split()
+                if "-" in fields[0] and not fields[0].endswith(":"):
+                    start, end = (int(x, 16) for x in fields[0].split("-"))
+                    inMapping = start <= address < end
+                elif inMapping and fields[0] == "ShmemPmdMapped:":
+                    return int(fields[1])*1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
 def precise_delay(microseconds):
     target_time = time.perf_counter() + microseconds / 1_000_000
     while np.float64(time.perf_counter()) < target_time:
@@ -437,4 +537,10 @@ def is_numeric(s):
 def get_time_usec():
     """Returns UNIX time as an integer in microseconds.
     """
-    return int( time.time() * 1_000_000 )
+    return time.time_ns() // 1_000
+
+def get_monotonic_usec():
+    """Returns CLOCK_MONOTONIC time as an integer in microseconds. Unlike 
+    get_time_usec(), it never jumps, so use it for time differences.
+    """
+    return time.monotonic_ns() // 1_000
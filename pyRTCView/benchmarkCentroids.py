@@ -0,0 +1,88 @@
+"""
+Per frame cost and noise propagation of the centroid engines, on simulated
+SHWFS frames with Gaussian spots, photon noise and read noise.
+
+    python benchmarkCentroids.py [--subaps 20] [--spacing 8] [--fwhm 2.5] [--frames 500]
+
+For every engine, reports the time to extract the subapertures and compute the
+slopes of one frame, then for each flux level the centroid error against the
+true spot positions: the RMS error, the noise (RMS about the best linear fit)
+and the response (slope of the fit, 1 for an unbiased engine).
+"""
+import argparse
+import time
+import numpy as np
+from pyRTC.Centroiding import (CENTROID_ENGINES, centroidsToSlopes, gaussianSpot,
+                               make_centroid_engine, shwfsSubapertureStack)
+
+PERCENTILES = [50, 99]
+
+def makeFrame(shifts, numRegions, spacing, fwhm, photons, readNoise, rng):
+    size = numRegions*spacing
+    center = (spacing - 1)/2
+    image = np.zeros((size, size))
+    for k, (dx, dy) in enumerate(shifts):
+        i, j = divmod(k, numRegions)
+        spot = gaussianSpot(spacing, center + dx, center + dy, fwhm)
+        image[i*spacing:(i+1)*spacing, j*spacing:(j+1)*spacing] = photons*spot/spot.sum()
+    image = rng.poisson(image) + rng.normal(0, readNoise, image.shape)
+    return np.round(image).astype(np.int32)
+
+parser = argparse.ArgumentParser(description="Benchmark the centroid engines")
+parser.add_argument("--subaps", type=int, default=20, help="Subapertures across")
+parser.add_argument("--spacing", type=int, default=8, help="Subaperture size in pixels")
+parser.add_argument("--fwhm", type=float, default=2.5, help="Spot FWHM in pixels")
+parser.add_argument("--readNoise", type=float, default=3.0, help="Read noise in electrons")
+parser.add_argument("--threshold", type=float, default=0.0, help="Pixel threshold")
+parser.add_argument("--flux", type=float, nargs="+", default=[50, 200, 1000, 10000], help="Photons per spot")
+parser.add_argument("--frames", type=int, default=500, help="Frames per measurement")
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+numRegions, spacing = args.subaps, args.spacing
+K = numRegions*numRegions
+refSlopes = np.zeros((2*numRegions, numRegions), dtype=np.float32)
+slopes = np.zeros_like(refSlopes)
+origin = (spacing - 1)/2
+
+frames = []
+for i in range(args.frames):
+    shifts = rng.uniform(-0.5, 0.5, size=(K, 2))
+    frames.append([(shifts, makeFrame(shifts, numRegions, spacing, args.fwhm, flux, args.readNoise, rng))
+                   for flux in args.flux])
+
+print(f"{K} subapertures of {spacing} pixels, spot FWHM {args.fwhm}, read noise {args.readNoise}e-")
+for name in CENTROID_ENGINES:
+    engine = make_centroid_engine(name, {"centroidFWHM": args.fwhm})
+    stack = shwfsSubapertureStack((numRegions*spacing, numRegions*spacing), numRegions, spacing,
+                                  spacing, 0, 0)
+    engine.prepare(stack)
+
+    def computeSlopes(image):
+        stack.extract(image, args.threshold)
+        engine.compute(stack)
+        return centroidsToSlopes(stack.cx, stack.cy, stack.flux, stack.xOrigin, stack.yOrigin,
+                                 0, 0, refSlopes, slopes)
+
+    computeSlopes(frames[0][-1][1])
+    times = np.empty(len(frames))
+    for i, frame in enumerate(frames):
+        image = frame[-1][1]
+        start = time.perf_counter_ns()
+        computeSlopes(image)
+        times[i] = time.perf_counter_ns() - start
+    p = np.percentile(times/1e3, PERCENTILES)
+    print(f"--- {name}: p50={p[0]:8.1f}us  p99={p[1]:8.1f}us per frame")
+
+    for f, flux in enumerate(args.flux):
+        true, measured = [], []
+        for frame in frames:
+            shifts, image = frame[f]
+            result = computeSlopes(image)
+            measured.append(np.concatenate([result[:numRegions].ravel(), result[numRegions:].ravel()]))
+            true.append(np.concatenate([shifts[:, 0], shifts[:, 1]]) - (spacing // 2 - origin))
+        true, measured = np.concatenate(true), np.concatenate(measured)
+        response, intercept = np.polyfit(true, measured, 1)
+        noise = np.std(measured - (response*true + intercept))
+        rms = np.sqrt(np.mean((measured - true)**2))
+        print(f"{flux:>10.0f} photons: rms={rms:7.3f}px  noise={noise:7.3f}px  response={response:6.3f}")
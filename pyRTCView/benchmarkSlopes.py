@@ -0,0 +1,99 @@
+"""
+Per frame cost of the PYWFS and SHWFS slope kernels: numpy, serial numba and
+parallel numba with each thread count, on typical pupil and lenslet sizes.
+
+    python benchmarkSlopes.py [--frames 2000] [--threads 1 2 4]
+
+Thread counts above numba's thread pool size (NUMBA_NUM_THREADS, by default the
+number of cores) are skipped.
+"""
+import argparse
+import time
+import numba
+import numpy as np
+from pyRTC.utils import generate_circular_aperture_mask
+from pyRTC.SlopesProcess import (computeSlopesPYWFSOptimNumpy, computeSlopesPYWFSOptimNumba,
+                                 computeSlopesPYWFSParallel, computeSlopesSHWFSOptimNumpy,
+                                 computeSlopesSHWFSOptimNumba, computeSlopesSHWFSParallel)
+
+PERCENTILES = [50, 99]
+
+def timeKernel(kernel, frames):
+    kernel()
+    times = np.empty(frames)
+    for i in range(frames):
+        start = time.perf_counter_ns()
+        kernel()
+        times[i] = time.perf_counter_ns() - start
+    return np.percentile(times/1e3, PERCENTILES)
+
+def report(label, kernels, frames, threads, reference):
+    print(f"--- {label}")
+    for name, kernel, result, parallel in kernels:
+        for numThreads in (threads if parallel else [None]):
+            if numThreads is not None:
+                numba.set_num_threads(numThreads)
+            p = timeKernel(kernel, frames)
+            name_ = name if numThreads is None else f"{name} x{numThreads}"
+            error = np.abs(result() - reference).max()
+            print(f"{name_:>20}: p50={p[0]:9.1f}us  p99={p[1]:9.1f}us  max|diff|={error:.1e}")
+
+def pywfsCase(pupilRadius, frames, threads):
+    size = 4*pupilRadius + 8
+    pupilMask = np.zeros((size, size))
+    template = generate_circular_aperture_mask(2*pupilRadius, pupilRadius, 0.1)
+    centers = [pupilRadius + 2, size - pupilRadius - 2]
+    n = 1
+    for y in centers:
+        for x in centers:
+            pupilMask[y-pupilRadius:y+pupilRadius, x-pupilRadius:x+pupilRadius] += template*n
+            n += 1
+    masks = [(pupilMask == i).ravel() for i in range(1, 5)]
+    idx = [np.flatnonzero(mask) for mask in masks]
+    numPixels = idx[0].size
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 4000, size=size*size).astype(np.int32)
+    refSlopes = np.zeros(2*numPixels, dtype=np.float32)
+    scratch = [np.empty(numPixels, dtype=np.float32) for _ in range(6)]
+    slopes = np.empty(2*numPixels, dtype=np.float32)
+
+    numpyK = lambda: computeSlopesPYWFSOptimNumpy(image, *masks, *scratch, numPixels, slopes, refSlopes)
+    serialK = lambda: computeSlopesPYWFSOptimNumba(image, *masks, *scratch, numPixels, slopes, refSlopes)
+    parallelK = lambda: computeSlopesPYWFSParallel(image, *idx, slopes, refSlopes)
+    reference = numpyK().copy()
+    report(f"PYWFS, pupil radius {pupilRadius} ({numPixels} pixels per pupil, {size}x{size} image)",
+           [("numpy", numpyK, numpyK, False),
+            ("numba serial", serialK, serialK, False),
+            ("numba parallel", parallelK, parallelK, True)], frames, threads, reference)
+
+def shwfsCase(numRegions, spacing, frames, threads):
+    size = numRegions*spacing
+    xvals = np.arange(spacing) - spacing // 2
+    xvals = np.meshgrid(xvals, xvals)[0].astype(np.float32)
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 4000, size=(size, size)).astype(np.int32)
+    refSlopes = np.zeros((2*numRegions, numRegions), dtype=np.float32)
+    slopes = np.zeros_like(refSlopes)
+    threshold = 100.0
+
+    numpyK = lambda: computeSlopesSHWFSOptimNumpy(image, slopes, refSlopes, threshold, spacing, xvals)
+    serialK = lambda: computeSlopesSHWFSOptimNumba(image, slopes, refSlopes, threshold, spacing, xvals, 0, 0, spacing)
+    parallelK = lambda: computeSlopesSHWFSParallel(image, slopes, refSlopes, threshold, spacing, xvals, 0, 0, spacing)
+    reference = serialK().copy()
+    report(f"SHWFS, {numRegions}x{numRegions} subapertures of {spacing} pixels ({size}x{size} image)",
+           [("numpy", numpyK, numpyK, False),
+            ("numba serial", serialK, serialK, False),
+            ("numba parallel", parallelK, parallelK, True)], frames, threads, reference)
+
+parser = argparse.ArgumentParser(description="Benchmark the PYWFS and SHWFS slope kernels")
+parser.add_argument("--frames", type=int, default=2000, help="Frames timed per kernel")
+parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8], help="numba thread counts to try")
+args = parser.parse_args()
+
+threads = [n for n in args.threads if 0 < n <= numba.config.NUMBA_NUM_THREADS]
+print(f"numba thread pool: {numba.config.NUMBA_NUM_THREADS}, trying {threads}")
+for pupilRadius in [16, 32, 60]:
+    pywfsCase(pupilRadius, args.frames, threads)
+for numRegions, spacing in [(20, 8), (40, 10)]:
+    shwfsCase(numRegions, spacing, args.frames, threads)
@@ -3,4 +3,6 @@ from pyRTC.utils import *
 from pyRTC.hardware import *
 shm_names = ["wfs", "wfsRaw", "wfc", "wfc2D", "wfcShape", "signal", "signal2D", "psfShort", "psfLong", "pol",
              "loop", "refSlopes", "subApMasks", "cmat", "m2c"] #list of SHMs to reset
+#Also clear everything producers have registered
+shm_names = set(shm_names) | {entry["name"] for entry in list_shms()}
 clear_shms(shm_names)
@@ -18,29 +18,25 @@ shm2, _, _ = initExistingShm("wfc2D")
 # %% Measure Jitter
 N = 1000
 
-shm1WriteTimes = np.empty(N)
-shm2WriteTimes = np.empty(N)
-shm1Counts = np.empty(N)
-shm2Counts = np.empty(N)
+#Monotonic write times of shm1 frames, by frame id
+shm1WriteTimes = {}
+sysLatency = []
 for i in tqdm.trange(N):
     #Wait for new write to shm1
     shm1.hold()
     #Get write time
-    shm1Counts[i] = shm1.metadata[0]
-    shm1WriteTimes[i] = shm1.metadata[1]
-    #Wait for new write to shm1
+    info1 = shm1.frameInfo()
+    shm1WriteTimes[info1.frameId] = info1.timestamp
+    #Wait for new write to shm2
     shm2.hold()
-    #Get write time
-    shm2Counts[i] = shm2.metadata[0]
-    shm2WriteTimes[i] = shm2.metadata[1]
+    #Match it to the shm1 frame it was computed from
+    info2 = shm2.frameInfo()
+    if info2.upstreamId in shm1WriteTimes:
+        sysLatency.append(1e-9*(info2.timestamp - shm1WriteTimes[info2.upstreamId]))
 
 # %%
-print(np.min(shm1Counts-shm2Counts), np.max(shm1Counts-shm2Counts))
-sysLatency = shm2WriteTimes-shm1WriteTimes
-frameShift = 0
-while np.mean(sysLatency) < 0:
-    frameShift += 1
-    sysLatency = shm2WriteTimes[frameShift:]-shm1WriteTimes[:-frameShift]
+sysLatency = np.array(sysLatency)
+print(f"Matched {sysLatency.size}/{N} frames by upstream frame id")
 
 
 # Create histogram plot
@@ -0,0 +1,87 @@
+"""
+Live per stage and end-to-end latency report from the shared LatencyTrace.
+
+Set latencyTrace: True in the config of every component to trace, then run
+    python traceLatency.py [--interval 1] [--history 100000] [--plot]
+Only stages which have stamped frames are reported.
+"""
+import argparse
+import time
+import numpy as np
+import matplotlib.pyplot as plt
+from pyRTC.LatencyTrace import LatencyTrace
+
+PERCENTILES = [50, 99, 99.9]
+
+def summarize(label, latencies):
+    if latencies.size == 0:
+        return f"{label:>16}: no frames"
+    p = np.percentile(latencies, PERCENTILES)
+    return (f"{label:>16}: n={latencies.size:<8d} p50={p[0]:9.1f}us  p99={p[1]:9.1f}us  "
+            f"p99.9={p[2]:9.1f}us  max={latencies.max():9.1f}us")
+
+parser = argparse.ArgumentParser(description="Report pipeline latency from the shared LatencyTrace")
+parser.add_argument("--interval", type=float, default=1.0, help="Seconds between reports")
+parser.add_argument("--history", type=int, default=100000, help="Number of frames the statistics cover")
+parser.add_argument("--plot", action="store_true", help="Show live jitter histograms")
+args = parser.parse_args()
+
+trace = LatencyTrace()
+history = None
+lastFrame = None
+
+if args.plot:
+    plt.ion()
+    fig, axes = None, None
+
+while True:
+    time.sleep(args.interval)
+
+    #Stages that are being traced, in pipeline order
+    stages = [s for s in LatencyTrace.STAGES if trace.newestFrame(s) > 0]
+    if len(stages) < 2:
+        print(f"Waiting for at least two traced stages (have: {stages})")
+        continue
+    labels = [f"{a}->{b}" for a, b in zip(stages[:-1], stages[1:])] + ["total"]
+    if history is None or len(history) != len(labels):
+        history = [np.empty(0) for _ in labels]
+        fig = None
+
+    newest = trace.newestFrame(stages[-1])
+    if lastFrame is None or lastFrame > newest:
+        lastFrame = newest
+        continue
+    if newest == lastFrame:
+        print("No new frames")
+        continue
+    #Older frames have been overwritten in the trace
+    first = max(lastFrame + 1, newest - LatencyTrace.TRACE_DEPTH + 1)
+    stageLatencies, totalLatency = trace.latencies(np.arange(first, newest + 1), stages=stages)
+    lastFrame = newest
+
+    for i, latencies in enumerate(list(stageLatencies) + [totalLatency]):
+        history[i] = np.concatenate([history[i], latencies/1e3])[-args.history:]
+
+    print(f"--- frames {first}-{newest}, {totalLatency.size} complete")
+    for label, latencies in zip(labels, history):
+        print(summarize(label, latencies))
+
+    if args.plot:
+        if fig is None:
+            plt.close("all")
+            fig, axes = plt.subplots(len(labels), 1, figsize=(10, 2.5*len(labels)), squeeze=False)
+            axes = axes[:, 0]
+        for ax, label, latencies in zip(axes, labels, history):
+            ax.clear()
+            if latencies.size > 0 and latencies.max() > 0:
+                bins = np.logspace(np.log10(max(latencies.min(), 1)), np.log10(latencies.max()) + 0.01, 200)
+                ax.hist(latencies, bins=bins, log=True, color='k', histtype='step')
+                for q, color in zip(PERCENTILES, ['green', 'orange', 'red']):
+                    ax.axvline(np.percentile(latencies, q), color=color, label=f"p{q}")
+                ax.set_xscale('log')
+                ax.legend(loc="upper right")
+            ax.set_ylabel(label)
+            ax.grid(True, which='both', linestyle='--', linewidth=0.5)
+        axes[-1].set_xlabel("Latency [us]")
+        fig.tight_layout()
+        plt.pause(0.01)
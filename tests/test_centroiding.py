@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from pyRTC.Pipeline import ImageSHM, clear_shms
+from pyRTC.Centroiding import (CENTROID_ENGINES, CoGEngine, gaussianSpot, make_centroid_engine,
+                               register_centroid_engine, shwfsSubapertureStack)
+from pyRTC.SlopesProcess import SlopesProcess
+
+
+def spot_grid(numRegions=3, spacing=12, fwhm=3.0, seed=0):
+    rng = np.random.default_rng(seed)
+    shifts = rng.uniform(-1.5, 1.5, size=(numRegions*numRegions, 2))
+    image = np.zeros((numRegions*spacing, numRegions*spacing), dtype=np.float32)
+    center = (spacing - 1)/2
+    for k, (dx, dy) in enumerate(shifts):
+        i, j = divmod(k, numRegions)
+        image[i*spacing:(i+1)*spacing, j*spacing:(j+1)*spacing] = 1000*gaussianSpot(spacing, center + dx, center + dy, fwhm)
+    return image, shifts
+
+
+@pytest.mark.parametrize("name", list(CENTROID_ENGINES))
+def test_engines_find_spots(name):
+    image, shifts = spot_grid()
+    stack = shwfsSubapertureStack(image.shape, 3, 12, 12, 0, 0)
+    engine = make_centroid_engine(name, {"centroidFWHM": 3.0})
+    engine.prepare(stack)
+    stack.extract(image, 0.0)
+    engine.compute(stack)
+    center = (12 - 1)/2
+    assert np.abs(stack.cx - center - shifts[:, 0]).max() < 0.1
+    assert np.abs(stack.cy - center - shifts[:, 1]).max() < 0.1
+    assert (stack.flux > 0).all()
+
+
+def test_engine_reference_frame():
+    image, shifts = spot_grid()
+    stack = shwfsSubapertureStack(image.shape, 3, 12, 12, 0, 0)
+    engine = make_centroid_engine("correlation", {})
+    engine.setReference(image)
+    engine.prepare(stack)
+    stack.extract(image, 0.0)
+    engine.compute(stack)
+    #The templates are the spots themselves, so there is no shift to find
+    assert np.allclose(stack.cx, stack.state["templateX"], atol=1e-6)
+    assert np.allclose(stack.cy, stack.state["templateY"], atol=1e-6)
+
+
+def test_slopes_with_engine():
+    clear_shms(["wfs", "signal", "signal2D", "refSlopes"])
+    wfs = ImageSHM("wfs", (36, 36), np.int32, consumer=False)
+    slopes = SlopesProcess({"type": "shwfs", "signalType": "slopes", "subApSpacing": 12,
+                            "subApOffsetX": 0, "subApOffsetY": 0})
+    image, shifts = spot_grid()
+    wfs.write(image.astype(np.int32))
+    slopes.computeSignal()
+    direct = slopes.read(block=False).copy()
+
+    #The stack based centre of gravity matches the direct kernel
+    register_centroid_engine("stackcog", CoGEngine)
+    slopes.setCentroidEngine("stackcog")
+    assert slopes.geometry.stack is not None
+    wfs.write(image.astype(np.int32))
+    slopes.computeSignal()
+    assert np.allclose(slopes.read(block=False), direct, atol=1e-4)
+
+    slopes.setCentroidEngine("cog")
+    assert slopes.geometry.stack is None
+    del CENTROID_ENGINES["stackcog"]
+    clear_shms(["wfs", "signal", "signal2D", "refSlopes"])
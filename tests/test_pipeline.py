@@ -0,0 +1,638 @@
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import numpy as np
+import pytest
+from pyRTC.Pipeline import *
+from pyRTC.LatencyTrace import LatencyTrace
+from pyRTC.utils import FUTEX_AVAILABLE
+
+
+def make_shm(name, shape=(8,), dtype=np.float32, **kwargs):
+    clear_shms([name])
+    return ImageSHM(name, shape, dtype, consumer=False, **kwargs)
+
+
+@pytest.mark.parametrize("notify", [True, False])
+def test_hold_wakes_on_write(notify):
+    producer = make_shm("test_notify")
+    consumer = ImageSHM("test_notify", (8,), np.float32, notify=notify)
+    if notify:
+        assert consumer.notify == FUTEX_AVAILABLE
+
+    def delayed_write():
+        time.sleep(0.05)
+        producer.write(np.ones(8, dtype=np.float32))
+
+    writer = threading.Thread(target=delayed_write)
+    writer.start()
+    start = time.time()
+    arr = consumer.read()
+    elapsed = time.time() - start
+    writer.join()
+
+    assert (arr == 1).all()
+    assert elapsed < 1.0
+
+    clear_shms(["test_notify"])
+
+
+def test_hold_timeout():
+    producer = make_shm("test_notify_timeout")
+    consumer = ImageSHM("test_notify_timeout", (8,), np.float32)
+
+    start = time.time()
+    consumer.hold(timeout=0.05)
+    elapsed = time.time() - start
+    assert 0.04 < elapsed < 1.0
+
+    #Any real number of seconds waits, anything else is refused
+    start = time.time()
+    consumer.hold(timeout=np.float32(0.05))
+    assert 0.04 < time.time() - start < 1.0
+    with pytest.raises((TypeError, ValueError)):
+        consumer.hold(timeout="soon")
+
+    clear_shms(["test_notify_timeout"])
+
+
+def hammer_shm(name, shape, numWrites):
+    shm = ImageSHM(name, shape, np.float64, consumer=False)
+    frame = np.empty(shape, dtype=np.float64)
+    for i in range(numWrites):
+        frame.fill(i)
+        shm.write(frame)
+
+
+def test_seqlock_no_torn_reads():
+    name, shape = "test_seqlock", (256, 256)
+    make_shm(name, shape, np.float64)
+    #Not fork, numba's OpenMP pool (started by the parallel kernels) deadlocks forked children
+    ctx = multiprocessing.get_context("spawn")
+    writer = ctx.Process(target=hammer_shm, args=(name, shape, 5000))
+    writer.start()
+
+    reader = ImageSHM(name, shape, np.float64)
+    numReads = 0
+    while writer.is_alive() or numReads == 0:
+        frame = reader.read_noblock()
+        #Every write fills the frame with one value, so any mix is a torn read
+        assert frame.min() == frame.max()
+        numReads += 1
+    writer.join()
+
+    assert writer.exitcode == 0
+    assert reader.readRetries >= 0
+    clear_shms([name])
+
+
+def test_ring_cursor_and_drops():
+    name = "test_ring"
+    clear_shms([name])
+    producer = RingImageSHM(name, (4,), np.float32, 8, consumer=False)
+    consumer, dims, dtype = initExistingShm(name)
+    assert isinstance(consumer, RingImageSHM)
+    assert dims == [4]
+
+    for i in range(3):
+        producer.write(np.full(4, i, dtype=np.float32))
+    for i in range(3):
+        assert (consumer.readNext() == i).all()
+        assert consumer.frameIndex == i
+    assert consumer.droppedFrames == 0
+    assert consumer.readNext(timeout=0.01) is None
+
+    #Lap the consumer, only the last numSlots-1 frames are still readable
+    for i in range(3, 23):
+        producer.write(np.full(4, i, dtype=np.float32))
+    assert (consumer.readNext() == 16).all()
+    assert consumer.droppedFrames == 13
+    assert (consumer.read_noblock() == 22).all()
+
+    clear_shms([name])
+
+
+def test_ring_batch_is_contiguous_view():
+    name = "test_ring_batch"
+    clear_shms([name])
+    producer = RingImageSHM(name, (2, 3), np.float64, 4, consumer=False)
+    consumer = RingImageSHM(name, (2, 3), np.float64, 4)
+
+    #Write enough frames that the batch wraps around the end of the ring
+    for i in range(6):
+        producer.write(np.full((2, 3), i, dtype=np.float64))
+    batch = consumer.readBatch(3)
+    assert batch.shape == (3, 2, 3)
+    assert np.shares_memory(batch, consumer.arr)
+    assert list(batch[:, 0, 0]) == [3, 4, 5]
+    assert consumer.batchStart == 3
+    assert consumer.isValid(consumer.batchStart)
+
+    producer.write(np.full((2, 3), 6, dtype=np.float64))
+    assert list(consumer.readBatch()[:, 0, 0]) == [6]
+    producer.write(np.full((2, 3), 7, dtype=np.float64))
+    assert not consumer.isValid(3)
+
+    clear_shms([name])
+
+
+def test_acquire_commit_in_place():
+    name = "test_inplace"
+    producer = make_shm(name)
+    consumer = ImageSHM(name, (8,), np.float32)
+    producer.write(np.ones(8, dtype=np.float32))
+    consumer.read_noblock()
+
+    buffer = producer.acquire_write_buffer()
+    assert np.shares_memory(buffer, producer.arr)
+    assert (buffer == 1).all()
+    buffer *= 3
+    #Nothing is published until commit
+    assert not consumer.checkNew()
+    assert producer.header[ImageSHM.SEQ_IDX] % 2 == 1
+    assert producer.commit() == 1
+    assert producer.header[ImageSHM.SEQ_IDX] % 2 == 0
+    assert (consumer.read() == 3).all()
+
+    #Writing the acquired buffer just commits it
+    buffer = producer.acquire_write_buffer()
+    buffer += 1
+    assert producer.write(buffer) == 1
+    assert (consumer.read() == 4).all()
+    assert producer.commit() == -1
+
+    #A failed frame is not published, and readers are not left waiting on it
+    with pytest.raises(ValueError):
+        with producer.writing() as buffer:
+            raise ValueError
+    assert producer.header[ImageSHM.SEQ_IDX] % 2 == 0
+    assert not consumer.checkNew()
+    assert consumer.readConsistent() is not None
+    assert consumer.readRetries == 0
+    assert producer.commit() == -1
+
+    clear_shms([name])
+
+
+def test_producer_reopen_after_dead_writer():
+    name = "test_dead_writer"
+    producer = make_shm(name)
+    producer.write(np.ones(8, dtype=np.float32))
+    #The producer dies between acquire and commit
+    producer.acquire_write_buffer()
+    assert producer.header[ImageSHM.SEQ_IDX] % 2 == 1
+
+    producer = ImageSHM(name, (8,), np.float32, consumer=False)
+    assert producer.header[ImageSHM.SEQ_IDX] % 2 == 0
+    consumer = ImageSHM(name, (8,), np.float32)
+    assert (consumer.readConsistent() == 1).all()
+    assert consumer.readRetries == 0
+    producer.write(np.full(8, 2, dtype=np.float32))
+    assert (consumer.readConsistent() == 2).all()
+    assert consumer.readRetries == 0
+
+    clear_shms([name])
+
+
+def test_ring_acquire_commit():
+    name = "test_ring_inplace"
+    clear_shms([name])
+    producer = RingImageSHM(name, (4,), np.float32, 4, consumer=False)
+    consumer = RingImageSHM(name, (4,), np.float32, 4)
+
+    for i in range(6):
+        buffer = producer.acquire_write_buffer()
+        buffer[:] = i
+        producer.commit()
+    assert list(consumer.readBatch(3)[:, 0]) == [3, 4, 5]
+    assert (consumer.read_noblock() == 5).all()
+
+    clear_shms([name])
+
+
+def test_frame_info_and_upstream_ids():
+    producer = make_shm("test_frameinfo")
+    downstream = make_shm("test_frameinfo_out")
+    consumer = ImageSHM("test_frameinfo", (8,), np.float32)
+
+    start = time.monotonic_ns()
+    producer.write(np.ones(8, dtype=np.float32))
+    producer.write(np.ones(8, dtype=np.float32))
+    info = producer.frameInfo()
+    assert isinstance(info, FrameInfo)
+    assert info.frameId == 2
+    #A stage with no input is its own upstream
+    assert info.upstreamId == info.frameId
+    assert start <= info.timestamp <= time.monotonic_ns()
+
+    consumer.read()
+    assert consumer.lastFrameId == 2
+    downstream.write(np.zeros(8, dtype=np.float32), upstreamId=consumer.lastUpstreamId)
+    assert downstream.frameInfo().upstreamId == 2
+    assert downstream.frameInfo().frameId == 1
+
+    clear_shms(["test_frameinfo", "test_frameinfo_out"])
+
+
+def test_ring_frame_info():
+    name = "test_ring_frameinfo"
+    clear_shms([name])
+    producer = RingImageSHM(name, (4,), np.float32, 4, consumer=False)
+    consumer = RingImageSHM(name, (4,), np.float32, 4)
+
+    for i in range(5):
+        producer.write(np.full(4, i, dtype=np.float32), upstreamId=100 + i)
+    assert consumer.frameInfo().upstreamId == 104
+    assert consumer.frameInfo(2).upstreamId == 102
+    assert consumer.frameInfo(0) is None
+    consumer.readNext()
+    assert consumer.lastUpstreamId == consumer.frameIndex + 100
+
+    clear_shms([name])
+
+
+def test_latency_trace():
+    clear_shms([LatencyTrace.SHM_NAME])
+    trace = LatencyTrace()
+    reader = LatencyTrace()
+    for frameId in range(1, 11):
+        for stage in LatencyTrace.STAGES:
+            trace.stamp(stage, frameId)
+    #Frame 11 has not made it through the pipeline yet
+    trace.stamp("expose", 11)
+
+    assert reader.newestFrame("expose") == 11
+    assert reader.newestFrame("wfc") == 10
+    stageLatencies, total = reader.latencies(np.arange(1, 12))
+    assert stageLatencies.shape == (len(LatencyTrace.STAGES) - 1, 10)
+    assert (stageLatencies >= 0).all()
+    assert np.array_equal(total, stageLatencies.sum(axis=0))
+
+    #Entries are reused once the trace wraps
+    trace.stamp("expose", 1 + LatencyTrace.TRACE_DEPTH)
+    assert reader.timestamps([1])[0, 0] == -1
+
+    clear_shms([LatencyTrace.SHM_NAME])
+
+
+def test_registry_lookup():
+    name = "test_registry"
+    clear_shms([name])
+    assert get_registry().lookup(name) is None
+    producer = ImageSHM(name, (3, 5), np.int32, consumer=False)
+    entry = get_registry().lookup(name)
+    assert entry["shape"] == [3, 5]
+    assert entry["dtype"] == np.int32
+    assert entry["numSlots"] == 1
+    assert entry["pid"] == os.getpid()
+    assert name in [e["name"] for e in list_shms()]
+
+    producer.write(np.ones((3, 5), dtype=np.int32))
+    assert get_registry().lookup(name)["lastWrite"] > 0
+
+    shm, shmDims, shmDType = initExistingShm(name)
+    assert shmDims == [3, 5] and shmDType == np.int32
+    assert np.array_equal(shm.read_noblock(), np.ones((3, 5)))
+
+    clear_shms([name])
+    assert get_registry().lookup(name) is None
+
+
+def test_registry_ring():
+    name = "test_registry_ring"
+    clear_shms([name])
+    RingImageSHM(name, (4,), np.float32, 8, consumer=False)
+    assert get_registry().lookup(name)["numSlots"] == 8
+    assert get_registry().lookup(name)["shape"] == [4]
+    shm, _, _ = initExistingShm(name)
+    assert isinstance(shm, RingImageSHM)
+    assert shm.numSlots == 8
+    clear_shms([name])
+
+
+def _exiting_producer(name):
+    ImageSHM(name, (4,), np.float32, consumer=False)
+
+
+def test_clear_stale_shms():
+    name = "test_registry_stale"
+    clear_shms([name])
+    proc = multiprocessing.get_context("spawn").Process(target=_exiting_producer, args=(name,))
+    proc.start()
+    proc.join()
+    assert get_registry().lookup(name)["pid"] == proc.pid
+
+    assert name in clear_stale_shms()
+    assert get_registry().lookup(name) is None
+    assert not unlink_shm(name)
+
+
+def test_group_snapshot():
+    names = ["test_group_loop", "test_group_signal", "test_group_wfc"]
+    clear_shms(names)
+    loop = ImageSHM(names[0], (2,), np.int64, consumer=False)
+    signal = RingImageSHM(names[1], (4,), np.float32, 4, consumer=False)
+    wfc = ImageSHM(names[2], (3,), np.float32, consumer=False)
+    group = ImageSHMGroup([ImageSHM(names[0], (2,), np.int64),
+                           RingImageSHM(names[1], (4,), np.float32, 4),
+                           ImageSHM(names[2], (3,), np.float32)], timeout=0.5)
+
+    def iteration(frameId, publishWfc=True):
+        signal.write(np.full(4, frameId, dtype=np.float32), upstreamId=frameId)
+        loop.write(np.full(2, frameId, dtype=np.int64), upstreamId=frameId)
+        if publishWfc:
+            wfc.write(np.full(3, frameId, dtype=np.float32), upstreamId=frameId)
+
+    iteration(1)
+    snapshot = group.snapshot()
+    assert snapshot.consistent and snapshot.upstreamId == 1
+    assert all((frame == 1).all() for frame in snapshot.frames)
+
+    #The ring still holds an older iteration of the slopes
+    iteration(2)
+    signal.write(np.full(4, 3, dtype=np.float32), upstreamId=3)
+    snapshot = group.snapshot(upstreamId=2)
+    assert snapshot.consistent
+    assert (snapshot.frames[1] == 2).all()
+
+    #Wait for a stream which lags behind
+    iteration(4, publishWfc=False)
+    timer = threading.Timer(0.05, wfc.write, args=(np.full(3, 4, dtype=np.float32),), kwargs={"upstreamId": 4})
+    timer.start()
+    snapshot = group.read()
+    timer.join()
+    assert snapshot.consistent and snapshot.upstreamId == 4
+    assert (snapshot.frames[2] == 4).all()
+
+    #A stream that never catches up is flagged
+    iteration(5, publishWfc=False)
+    snapshot = group.snapshot(timeout=0.01)
+    assert not snapshot.consistent
+    assert group.inconsistentSnapshots == 1
+
+    clear_shms(names)
+
+
+def test_prepare_memory(monkeypatch):
+    monkeypatch.setattr(ImageSHM, "PREFAULT", True)
+    monkeypatch.setattr(ImageSHM, "HUGE_PAGES", True)
+    producer = make_shm("test_memory", shape=(64, 1024), dtype=np.int64)
+    producer.write(np.arange(64*1024, dtype=np.int64).reshape(64, 1024))
+    consumer = ImageSHM("test_memory", (64, 1024), np.int64)
+    #Prefaulting must not change the data
+    assert np.array_equal(consumer.read_noblock().ravel(), np.arange(64*1024))
+    status = consumer.memoryStatus()
+    assert status["prefaulted"] and not status["locked"]
+    #Only reported if they took effect, never for a segment smaller than a huge page
+    assert not status["hugePages"]
+
+    #Whether locking works depends on ulimit -l, but it is always reported
+    monkeypatch.setattr(ImageSHM, "LOCK_MEMORY", True)
+    locked = make_shm("test_memory_locked", shape=(16,))
+    assert locked.memoryStatus()["locked"] == bool(locked.memoryFlags & ImageSHM.MEMORY_LOCKED)
+
+    clear_shms(["test_memory", "test_memory_locked"])
+
+
+def test_message_framing():
+    a, b = socket.socketpair()
+    big = np.arange(100000, dtype=np.float32).reshape(250, 400)
+    message = {"type": "set", "value": big, "nested": [np.int16(3), (1, 2), {"flags": np.array([True, False])}],
+               "text": "x"*10000}
+    sender = threading.Thread(target=send_message, args=(a, message))
+    sender.start()
+    received = recv_message(b)
+    sender.join()
+    assert np.array_equal(received["value"], big) and received["value"].dtype == np.float32
+    assert received["nested"][0] == 3 and received["nested"][1] == [1, 2]
+    assert np.array_equal(received["nested"][2]["flags"], [True, False])
+    assert received["text"] == message["text"]
+    a.close()
+    b.close()
+
+
+class _Hardware:
+    name = "testHardware"
+
+    def __init__(self):
+        self.gain = 0.5
+        self.mask = np.zeros(4, dtype=np.float32)
+        self.measuring = False
+
+    def scaled(self, x, scale):
+        return np.asarray(x)*scale
+
+    def reset(self):
+        self.gain = 0.0
+
+    def measure(self, duration):
+        self.measuring = True
+        time.sleep(duration)
+        self.measuring = False
+
+    def calibrate(self, numSteps, stepTime):
+        for i in range(numSteps):
+            report_progress(i/numSteps)
+            time.sleep(stepTime)
+        return np.full(2, numSteps)
+
+
+def connect_listener(port, socketPath=None):
+    listeners = []
+    thread = threading.Thread(target=lambda: listeners.append(Listener(_Hardware(), port, socketPath=socketPath)))
+    thread.start()
+    launcher = hardwareLauncher("unused.py", "unused.yaml", port, timeout=5.0)
+    for attempt in range(100):
+        try:
+            if socketPath is None:
+                launcher.processSocket = socket.create_connection(("127.0.0.1", port))
+            else:
+                launcher.processSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                launcher.processSocket.connect(socketPath)
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            time.sleep(0.01)
+    launcher.running = True
+    launcher.startReceiver()
+    thread.join()
+    listener = listeners[0]
+    threading.Thread(target=serve, args=(listener,), daemon=True).start()
+    return launcher, listener
+
+
+def serve(listener):
+    #Until the test closes the connection
+    try:
+        while listener.running:
+            listener.listen()
+    except (OSError, ValueError):
+        pass
+
+
+@pytest.mark.parametrize("transport", ["tcp", "unix"])
+def test_listener_rpc(transport, tmp_path):
+    socketPath = str(tmp_path / "rpc.sock") if transport == "unix" else None
+    launcher, listener = connect_listener(36000 + os.getpid() % 1000, socketPath=socketPath)
+
+    assert launcher.getProperty("gain") == 0.5
+    assert launcher.setProperty("mask", np.ones(4)) == 1
+    assert np.array_equal(launcher.getProperty("mask"), np.ones(4, dtype=np.float32))
+    #run returns whether the function ran, call what it returned
+    assert launcher.run("scaled", np.arange(3), 2) == 1
+    assert np.array_equal(launcher.call("scaled", np.arange(3), 2), [0, 2, 4])
+    assert launcher.run("reset") == 1
+    assert launcher.call("reset") is None
+    assert launcher.run("missingFunction") == -1
+    with pytest.raises(RemoteError):
+        launcher.call("missingFunction")
+
+    launcher.processSocket.close()
+    listener.RTCsocket.close()
+
+
+def test_pipelined_requests():
+    launcher, listener = connect_listener(37000 + os.getpid() % 1000)
+
+    #A batch is applied in order, so the get sees the set sent before it
+    results = wait_all([launcher.setPropertyAsync("gain", 0.25),
+                        launcher.callAsync("scaled", [1, 2], 2),
+                        launcher.getPropertyAsync("gain")])
+    assert results[0] == 1 and list(results[1]) == [2, 4] and results[2] == 0.25
+
+    #A get is answered while a long function runs
+    start = time.monotonic()
+    measurement = launcher.runAsync("measure", 0.5)
+    time.sleep(0.05)
+    assert launcher.getProperty("measuring") == True
+    assert time.monotonic() - start < 0.4
+    assert launcher.result(measurement) == 1
+    assert launcher.getProperty("measuring") == False
+
+    #A request given up on is forgotten, its late reply dropped
+    launcher.timeout = 0.05
+    assert launcher.run("measure", 0.2) == -1
+    assert len(launcher.pendingReplies) == 0
+    launcher.timeout = None
+    assert launcher.run("measure", 0.2, timeout=0.05) == -1
+    assert len(launcher.pendingReplies) == 0
+    assert launcher.result(launcher.runAsync("measure", 0.01)) == 1
+
+    launcher.processSocket.close()
+    listener.RTCsocket.close()
+
+
+def test_batched_requests():
+    launcher, listener = connect_listener(38000 + os.getpid() % 1000)
+
+    with launcher.batch() as b:
+        b.setProperty("gain", 0.1)
+        b.call("scaled", np.ones(2), 3)
+        gain = b.getProperty("gain")
+        b.run("missingFunction")
+        b.run("reset")
+        b.call("missingFunction")
+    assert b.results[0] == 1
+    assert np.array_equal(b.results[1], [3, 3])
+    assert b.results[gain] == 0.1
+    assert b.results[3] == -1
+    assert b.results[4] == 1
+    assert isinstance(b.results[5], RemoteError)
+    assert launcher.getProperty("gain") == 0.0
+
+    launcher.processSocket.close()
+    listener.RTCsocket.close()
+
+
+def test_jobs():
+    launcher, listener = connect_listener(39000 + os.getpid() % 1000)
+
+    #Progress is reported while the component keeps serving requests
+    jobId = launcher.startJob("calibrate", 20, 0.02)
+    assert launcher.setProperty("gain", 0.2) == 1
+    time.sleep(0.1)
+    status = launcher.jobStatus(jobId)
+    assert status["state"] == "running" and 0 < status["progress"] < 1
+    status = launcher.waitJob(jobId, timeout=5.0)
+    assert status["state"] == "done" and status["progress"] == 1.0
+    assert np.array_equal(status["return"], [20, 20])
+    #Forgotten once its final status has been read
+    assert launcher.jobStatus(jobId) == -1
+
+    jobId = launcher.startJob("calibrate", 1000, 0.01)
+    time.sleep(0.05)
+    launcher.cancelJob(jobId)
+    assert launcher.waitJob(jobId, timeout=5.0)["state"] == "cancelled"
+    assert launcher.startJob("missingFunction") == -1
+    assert launcher.jobStatus(12345) == -1
+
+    #Only the newest finished jobs are kept for status requests which never come
+    listener.MAX_FINISHED_JOBS = 1
+    first, second = launcher.startJob("reset"), launcher.startJob("reset")
+    time.sleep(0.1)
+    third = launcher.startJob("reset")
+    assert len({jobId, first, second, third}) == 4
+    assert launcher.jobStatus(first) == -1
+    assert launcher.jobStatus(second)["state"] == "done"
+    assert launcher.waitJob(third, timeout=5.0)["state"] == "done"
+    assert len(listener.jobs) == 0
+
+    launcher.processSocket.close()
+    listener.RTCsocket.close()
+
+
+DUMMY_COMPONENT = """
+from pyRTC.Pipeline import launchComponent
+
+class Dummy:
+    def __init__(self, conf):
+        self.name = conf["name"]
+        self.value = conf["value"]
+
+    def start(self):
+        pass
+
+    def say(self, text):
+        print(text)
+
+    def __del__(self):
+        pass
+
+if __name__ == "__main__":
+    launchComponent(Dummy, "dummy", start=True)
+"""
+
+
+def test_launch_all(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("PYTHONPATH", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    hardwareFile = tmp_path / "dummy.py"
+    hardwareFile.write_text(DUMMY_COMPONENT)
+    launchers = {}
+    basePort = 39000 + os.getpid() % 1000
+    for i, name in enumerate(["first", "broken", "dependent"]):
+        config = tmp_path / f"{name}.yaml"
+        config.write_text(f"dummy:\n  name: {name}\n  value: {i}\n  rpcTransport: unix\n" if name != "broken" else "other: {}\n")
+        launchers[name] = hardwareLauncher(str(hardwareFile), str(config), basePort + 10*i, timeout=5.0)
+
+    results = launch_all(launchers, dependencies={"dependent": ["broken"]})
+    assert results == {"first": True, "broken": False, "dependent": False}
+    #Never started, since what it depends on failed
+    assert not hasattr(launchers["dependent"], "process")
+    #The component asked for a unix socket in its config
+    assert launchers["first"].socketPath == unix_socket_path("first")
+    assert launchers["first"].getProperty("value") == 0
+    #What the component prints once it is running is forwarded
+    assert launchers["first"].run("say", "hello from first") == 1
+    for attempt in range(100):
+        if "[dummy] hello from first" in capsys.readouterr().out:
+            break
+        time.sleep(0.05)
+    else:
+        pytest.fail("The component's output was not forwarded")
+    assert launchers["first"].shutdown() == 1
+    launchers["first"].process.wait(timeout=10)
+    assert not os.path.exists(unix_socket_path("first"))
+
+    with pytest.raises(ValueError):
+        launch_all(launchers, dependencies={"first": ["broken"], "broken": ["first"]})
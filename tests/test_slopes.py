@@ -0,0 +1,328 @@
+import os
+import threading
+import time
+import numba
+import numpy as np
+import pytest
+from astropy.io import fits
+from pyRTC.Pipeline import ImageSHM, clear_shms
+from pyRTC.SlopesProcess import (SlopesProcess, RunningStats, computeSlopesFELIX, computeSlopesFELIXSparse, felixPixelIndices, quadrant_masks,
+                                 computeSlopesPYWFSOptimNumpy, computeSlopesPYWFSParallel,
+                                 computeSlopesSHWFSOptimNumba, computeSlopesSHWFSParallel)
+
+
+def felix_geometry(size=64, maskSize=40, rotation=10.0):
+    masks = np.zeros((4, size, size), dtype=">i8")
+    start = (size - maskSize) // 2
+    masks[:, start:start+maskSize, start:start+maskSize] = quadrant_masks(maskSize, rotation)
+    xvals = np.arange(size) - size // 2
+    yvals = np.arange(size) - size // 2
+    return masks, xvals, yvals
+
+
+def test_felix_sparse_matches_dense():
+    masks, xvals, yvals = felix_geometry()
+    rng = np.random.default_rng(0)
+    image = rng.integers(-20, 500, size=masks.shape[1:]).astype(np.int32)
+    refSlopes = rng.normal(size=(4, 2)).astype(np.float32)
+
+    dense = computeSlopesFELIX(image, None, refSlopes, 50.0, masks, xvals, yvals, 1, -2, np.eye(2))
+    slopes = np.full((4, 2), np.nan, dtype=np.float32)
+    sparse = computeSlopesFELIXSparse(image, slopes, refSlopes, 50.0, *felixPixelIndices(masks, xvals, yvals), 1, -2)
+
+    assert sparse is slopes
+    assert np.allclose(sparse, dense, atol=1e-4)
+
+
+def test_felix_sparse_empty_subaperture():
+    masks, xvals, yvals = felix_geometry()
+    image = np.zeros(masks.shape[1:], dtype=np.int32)
+    slopes = computeSlopesFELIXSparse(image, np.ones((4, 2), dtype=np.float32), np.ones((4, 2), dtype=np.float32),
+                                      0.0, *felixPixelIndices(masks, xvals, yvals), 0, 0)
+    assert (slopes == 0).all()
+
+
+def make_felix_slopes(size=32, maskSize=16):
+    clear_shms(["wfs", "signal", "signal2D", "subApMasks", "refSlopes"])
+    wfs = ImageSHM("wfs", (size, size), np.int32, consumer=False)
+    slopes = SlopesProcess({"type": "felix", "signalType": "slopes", "maskSize": maskSize})
+    return wfs, slopes
+
+
+def test_geometry_versions():
+    wfs, slopes = make_felix_slopes()
+    image = np.zeros((32, 32), dtype=np.int32)
+    image[10, 12] = 100
+    wfs.write(image)
+    slopes.computeSignal()
+    first = slopes.geometry
+    assert slopes.lastGeometryVersion == first.version
+    assert np.allclose(slopes.read(block=False), computeSlopesFELIX(
+        image, None, slopes.refSlopes, 0.0, slopes.subApMasks, slopes.xvals, slopes.yvals, 0, 0, np.eye(2)).ravel())
+
+    #Moving the masks swaps in a new geometry for the next frame
+    slopes.makeSubApMasks(2, -1)
+    assert slopes.geometry.version == first.version + 1
+    assert first.xOffset == 0 and slopes.geometry.xOffset == 2
+    wfs.write(image)
+    slopes.computeSignal()
+    assert slopes.lastGeometryVersion == first.version + 1
+
+    #Changing the valid subapertures keeps the masks' pixel lists
+    validSubAps = np.ones((4, 2), dtype=bool)
+    validSubAps[0, 0] = False
+    pixels = slopes.geometry.pixels
+    slopes.setValidSubAps(validSubAps)
+    assert slopes.geometry.pixels is pixels
+    assert list(slopes.geometry.validIndices) == list(range(1, 8))
+
+    clear_shms(["wfs", "signal", "signal2D", "subApMasks", "refSlopes"])
+
+
+@pytest.mark.parametrize("memmap", [False, True])
+def test_slope_offsets(memmap, tmp_path):
+    wfs, slopes = make_felix_slopes()
+    rng = np.random.default_rng(1)
+    soff = rng.normal(size=(3, 5, 8)).astype(">f4")
+    header = fits.Header()
+    header["PBSOFF01"] = 3
+    filename = str(tmp_path / "soff.fits")
+    fits.writeto(filename, soff, header)
+    slopes.slopeOffsetsMemmap = memmap
+    slopes.loadSlopeOffsetsBuffer(filename)
+    slopes.slopeBufferGains[:] = [0.5, 0.0, 2.0, 0, 0, 0, 0, 0, 0]
+
+    for step in range(7):
+        signal = np.ones(8, dtype=np.float32)
+        slopes.applySlopeOffsets(signal)
+        expected = 1 - 0.5*soff[0, step % 5] - 2.0*soff[2, step % 5]
+        assert np.allclose(signal, expected, atol=1e-5)
+
+    clear_shms(["wfs", "signal", "signal2D", "subApMasks", "refSlopes"])
+
+
+def test_chop_sequence_follows_frames():
+    wfs, slopes = make_felix_slopes()
+    chopMasks = np.stack([slopes.subApMasks, np.roll(slopes.subApMasks, 1, axis=2), np.roll(slopes.subApMasks, 2, axis=2)])
+    slopes.setChopMasks(chopMasks, np.zeros((3, 2), dtype=int))
+    chopIndex = ImageSHM("chopIndex", (1,), np.int64)
+    slopes.running = True
+
+    player = threading.Thread(target=slopes.playChopSequence, args=([0, 2, 1], [2, 1, 3]), daemon=True)
+    player.start()
+    for attempt in range(1000):
+        if slopes.chopSequence is not None:
+            break
+        time.sleep(1e-3)
+    #Each frame is computed with the masks of the step it falls in
+    seen = []
+    for frame in range(6):
+        wfs.write(np.ones((32, 32), dtype=np.int32))
+        slopes.computeSignal()
+        seen.append(slopes.geometry.masks)
+        if frame < 5:
+            assert (chopMasks[chopIndex.read_noblock()[0]] == seen[-1]).all()
+    player.join(timeout=5.0)
+
+    assert all((chopMasks[n] == masks).all() for n, masks in zip([0, 0, 2, 1, 1, 1], seen))
+    assert not player.is_alive() and slopes.chopSequence is None
+    assert chopIndex.read_noblock()[0] == -1
+    assert (slopes.subApMasksShm.read_noblock() == chopMasks[1]).all()
+
+    #Without frames the sequence gives up and stays at the current position
+    slopes.frameWaitMargin = 0.2
+    with pytest.raises(TimeoutError):
+        slopes.playChopSequence([0, 2], [1, 1])
+    assert slopes.chopSequence is None
+    assert chopIndex.read_noblock()[0] == -1
+
+    clear_shms(["wfs", "signal", "signal2D", "subApMasks", "refSlopes", "chopIndex"])
+
+
+def test_pywfs_slopes():
+    clear_shms(["wfs", "signal", "signal2D", "refSlopes"])
+    wfs = ImageSHM("wfs", (64, 64), np.int32, consumer=False)
+    slopes = SlopesProcess({"type": "pywfs", "signalType": "slopes", "pupils": ["16,16", "16,48", "48,16", "48,48"],
+                            "pupilsRadius": 12, "numbaThreads": 2})
+    #Capped at the size of numba's thread pool
+    assert slopes.numbaThreads == min(2, numba.config.NUMBA_NUM_THREADS)
+    rng = np.random.default_rng(2)
+    image = rng.integers(0, 1000, size=(64, 64)).astype(np.int32)
+    refSlopes = rng.normal(size=slopes.refSlopes1D.size).astype(np.float32)
+    slopes.refSlopes1D[:] = refSlopes
+    wfs.write(image)
+    slopes.computeSignal()
+
+    n = slopes.numPixelsInPupils
+    expected = computeSlopesPYWFSOptimNumpy(image.ravel(), slopes.p1mask.ravel(), slopes.p2mask.ravel(),
+                                            slopes.p3mask.ravel(), slopes.p4mask.ravel(),
+                                            None, None, None, None, None, None, n, np.empty(2*n), refSlopes)
+    assert np.allclose(slopes.read(block=False), expected, atol=1e-4)
+
+    #No flux gives zero slopes rather than NaNs
+    out = np.full(2*n, np.nan, dtype=np.float32)
+    computeSlopesPYWFSParallel(np.zeros(64*64, dtype=np.int32), slopes.p1Idx, slopes.p2Idx, slopes.p3Idx,
+                               slopes.p4Idx, out, refSlopes)
+    assert (out == 0).all()
+
+    clear_shms(["wfs", "signal", "signal2D", "refSlopes"])
+
+
+def test_shwfs_parallel_matches_serial():
+    rng = np.random.default_rng(3)
+    image = rng.integers(-20, 500, size=(64, 64)).astype(np.int32)
+    image[:10, :10] = 0
+    regionSize, numRegions = 7, 9
+    xvals = np.arange(regionSize) - regionSize // 2
+    xvals = np.meshgrid(xvals, xvals)[0].astype(np.float32)
+    refSlopes = rng.normal(size=(2*numRegions, numRegions)).astype(np.float32)
+    args = (refSlopes, 50.0, 7.1, xvals, 1, 0, regionSize)
+
+    serial = computeSlopesSHWFSOptimNumba(image, np.zeros_like(refSlopes), *args)
+    parallel = computeSlopesSHWFSParallel(image, np.full_like(refSlopes, np.nan), *args)
+    assert np.allclose(parallel, serial, atol=1e-4)
+    assert parallel[0, 0] == 0 and parallel[numRegions, 0] == 0
+
+
+def test_crop_follows_masks():
+    wfs, slopes = make_felix_slopes()
+    #16 pixel masks centered in the 32 pixel frame
+    assert slopes.geometry.bbox == (8, 24, 8, 24)
+    assert slopes.geometry.crop.shape == (16, 16)
+
+    slopes.makeSubApMasks(3, -2)
+    assert slopes.geometry.bbox == (6, 22, 11, 27)
+    rng = np.random.default_rng(4)
+    image = rng.integers(0, 100, size=(32, 32)).astype(np.int32)
+    wfs.write(image)
+    slopes.computeSignal()
+    expected = computeSlopesFELIX(image, None, slopes.refSlopes, 0.0, slopes.subApMasks,
+                                  slopes.xvals, slopes.yvals, 3, -2, np.eye(2))
+    assert np.allclose(slopes.read(block=False), expected.ravel(), atol=1e-4)
+
+    clear_shms(["wfs", "signal", "signal2D", "subApMasks", "refSlopes"])
+
+
+def test_running_stats():
+    rng = np.random.default_rng(5)
+    samples = rng.normal(3.0, 2.0, size=(50, 6)).astype(np.float32)
+    offset = np.arange(6, dtype=np.float32)
+    stats = RunningStats(6, maxCount=40, offset=offset)
+    for sample in samples:
+        stats.update(sample)
+    assert stats.count == 40 and stats.done.is_set()
+    assert np.allclose(stats.mean, samples[:40].mean(axis=0) + offset, atol=1e-5)
+    assert np.allclose(stats.variance(), samples[:40].var(axis=0, ddof=1), atol=1e-4)
+
+
+def test_streaming_ref_slopes():
+    wfs, slopes = make_felix_slopes()
+    rng = np.random.default_rng(6)
+    slopes.setRefSlopes(rng.normal(size=slopes.refSlopes.shape).astype(np.float32))
+    slopes.running = True
+
+    images = [rng.integers(0, 200, size=(32, 32)).astype(np.int32) for i in range(20)]
+    rawSlopes = [computeSlopesFELIX(image, None, np.zeros_like(slopes.refSlopes), 0.0, slopes.subApMasks,
+                                    slopes.xvals, slopes.yvals, 0, 0, np.eye(2)) for image in images]
+    slopes.refSlopeCount = len(images)
+    taker = threading.Thread(target=slopes.takeRefSlopes, daemon=True)
+    taker.start()
+    for attempt in range(1000):
+        if slopes.signalStats is not None:
+            break
+        time.sleep(1e-3)
+    for image in images + images[:3]:
+        wfs.write(image)
+        slopes.computeSignal()
+    taker.join(timeout=5.0)
+    assert not taker.is_alive()
+
+    #The average of the raw slopes, without pausing or stacking frames
+    assert slopes.signalStats.count == len(images)
+    assert np.allclose(slopes.refSlopes, np.mean(rawSlopes, axis=0), atol=1e-4)
+    count, mean, noise = slopes.slopeStatistics()
+    assert np.allclose(noise, np.std(rawSlopes, axis=0, ddof=1), atol=1e-4)
+    assert slopes.imageStats is None
+
+    #The image is accumulated over the masks' bounding box
+
+    slopes.startStatistics()
+    for image in images:
+        wfs.write(image)
+        slopes.computeSignal()
+    count, imageMean, imageVariance, gain, readNoise = slopes.imageStatistics()
+    assert count == len(images)
+    assert np.allclose(imageMean, np.mean(images, axis=0)[8:24, 8:24])
+    assert np.allclose(imageVariance, np.var(images, axis=0, ddof=1)[8:24, 8:24])
+
+    #Taking reference slopes leaves the image statistics alone, and gives up if 
+    #the frames stop coming
+    imageStats = slopes.imageStats
+    slopes.frameWaitMargin = 0.2
+    with pytest.raises(TimeoutError):
+        slopes.takeRefSlopes()
+    assert slopes.imageStats is imageStats and slopes.signalStats.done.is_set()
+    assert np.allclose(slopes.refSlopes, np.mean(rawSlopes, axis=0), atol=1e-4)
+
+    clear_shms(["wfs", "signal", "signal2D", "subApMasks", "refSlopes"])
+
+
+def test_fused_reconstruction():
+    shms = ["wfs", "signal", "signal2D", "subApMasks", "refSlopes", "wfc", "cmat", "loop", "wfsInfo"]
+    clear_shms(shms)
+    rng = np.random.default_rng(7)
+    wfs = ImageSHM("wfs", (32, 32), np.int32, consumer=False)
+    wfc = ImageSHM("wfc", (5,), np.float32, consumer=False)
+    loop = ImageSHM("loop", (5,), "i8", consumer=False)
+    ImageSHM("wfsInfo", (2,), "i8", consumer=False)
+    #The last mode is dropped
+    CM = rng.normal(size=(5, 8)).astype(np.float32)
+    CM[4] = 0
+    cmat = ImageSHM("cmat", CM.shape, CM.dtype, consumer=False)
+    cmat.write(CM)
+    slopes = SlopesProcess({"type": "felix", "signalType": "slopes", "maskSize": 16,
+                            "fusedReconstruction": True, "fusedGain": 0.5})
+    assert slopes.fused.numActiveModes == 3
+
+    image = rng.integers(0, 200, size=(32, 32)).astype(np.int32)
+    expected = computeSlopesFELIX(image, None, slopes.refSlopes, 0.0, slopes.subApMasks,
+                                  slopes.xvals, slopes.yvals, 0, 0, np.eye(2)).ravel()
+    #Open loop, only the signal is published
+    wfs.write(image)
+    slopes.computeSignal()
+    assert slopes.signalPublisher.flush(timeout=5.0)
+    assert np.allclose(slopes.read(block=False), expected, atol=1e-4)
+    assert (wfc.read_noblock() == 0).all()
+    assert loop.frameInfo().frameId == 0
+
+    slopes.setFusedLoop(True)
+    for i in range(2):
+        wfs.write(image)
+        slopes.computeSignal()
+        assert slopes.signalPublisher.flush(timeout=5.0)
+    assert np.allclose(wfc.read_noblock(), -2*0.5*CM@expected, atol=1e-4)
+    assert wfc.lastUpstreamId == slopes.wfsShm.lastUpstreamId
+    slopes.read(block=False)
+    assert slopes.signal.lastUpstreamId == slopes.wfsShm.lastUpstreamId
+    #Each iteration is recorded in the loop SHM, as the Loop does
+    assert loop.read_noblock()[0] == 1
+    assert loop.lastUpstreamId == slopes.wfsShm.lastUpstreamId
+
+    #A new control matrix is picked up on the next frame
+    cmat.write(2*CM)
+    wfc.write(np.zeros(5, dtype=np.float32))
+    wfs.write(image)
+    slopes.computeSignal()
+    assert np.allclose(wfc.read_noblock(), -0.5*2*CM@expected, atol=1e-4)
+
+    #wfc has one writer, the loop cannot be closed while another process (a Loop) holds it
+    assert slopes.setFusedLoop(False) == 1
+    assert wfc.header[ImageSHM.WRITER_PID_IDX] == 0
+    wfc.header[ImageSHM.WRITER_PID_IDX] = os.getppid()
+    assert slopes.setFusedLoop(True) == -1
+    assert not slopes.fused.closed
+    wfc.header[ImageSHM.WRITER_PID_IDX] = 0
+    assert slopes.setFusedLoop(True) == 1
+    assert wfc.header[ImageSHM.WRITER_PID_IDX] == os.getpid()
+
+    clear_shms(shms)